@@ -21,6 +21,14 @@
 /* would be nice to move this into the submodule init, but that needs python 3.5 for PyModule_AddFunctions */ 
 static PyMethodDef methods[] = {
     { "crc", modescrc_crc, METH_VARARGS, "Calculate the Mode S CRC over a buffer. Don't include the message's trailing CRC bytes in the provided buffer." },
+    { "crc_many", (PyCFunction)modescrc_crc_many, METH_VARARGS|METH_KEYWORDS, "Calculate the CRC residual (or the CRC) of each record of a packed array of frames." },
+    { "detect_format", modesreader_detect_format, METH_VARARGS, "Detect the input format of some data. Returns (offset, mode, confidence)." },
+    { "decode_file", (PyCFunction)modesreader_decode_file, METH_VARARGS|METH_KEYWORDS, "Decode a file of receiver data via mmap, returning an iterator over batches of messages." },
+    { "append_json_mlat", modesjson_append_mlat, METH_VARARGS, "Append a JSON mlat line for each of a sequence of messages to a bytearray." },
+    { "append_json_sync", modesjson_append_sync, METH_VARARGS, "Append a JSON sync line for an even/odd pair of messages to a bytearray." },
+    { "append_json_ssync", modesjson_append_ssync, METH_VARARGS, "Append a JSON split sync line for a message to a bytearray." },
+    { "pack_batch", modesbatch_pack, METH_VARARGS, "Pack a sequence of messages into a compact binary batch." },
+    { "unpack_batch", modesbatch_unpack, METH_VARARGS, "Unpack a binary batch made by pack_batch into a list of messages." },
     { "EventMessage", (PyCFunction)modesmessage_eventmessage, METH_VARARGS|METH_KEYWORDS,  "Constructs a new event message with a given type, timestamp, and event data." },
     { NULL, NULL, 0, NULL }
 };
@@ -61,6 +69,14 @@ PyInit__modes(void)
         goto error;
     }
 
+    if (modesthread_module_init(m) < 0) {
+        goto error;
+    }
+
+    if (modesudp_module_init(m) < 0) {
+        goto error;
+    }
+
     return m;
 
  error:
@@ -70,6 +86,8 @@ PyInit__modes(void)
 
 void free_modes(PyObject *m)
 {
+    modesudp_module_free(m);
+    modesthread_module_free(m);
     modesreader_module_free(m);
     modesmessage_module_free(m);
     modescrc_module_free(m);
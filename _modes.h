@@ -24,6 +24,38 @@
 
 #include <stdint.h>
 
+/* the decoded fields of a Mode S / Mode A/C frame, as plain C values */
+typedef struct {
+    unsigned int df;
+    unsigned int nuc;
+    char even_cpr;
+    char odd_cpr;
+    char valid;
+    char has_crc;        /* is crc meaningful? */
+    char has_address;    /* is address meaningful? */
+    char has_altitude;   /* is altitude meaningful? */
+    char repaired;       /* was a single-bit error corrected? */
+    uint32_t crc;
+    uint32_t address;
+    int altitude;
+} modesfields;
+
+/* a small direct-mapped cache of address -> python int, so that the
+ * same few thousand addresses come back as the same objects
+ */
+#define ADDRCACHE_BITS 12
+#define ADDRCACHE_SIZE (1 << ADDRCACHE_BITS)
+
+typedef struct {
+    uint32_t address[ADDRCACHE_SIZE];
+    PyObject *obj[ADDRCACHE_SIZE];     /* NULL if the slot is empty */
+    unsigned int hits;
+    unsigned int misses;
+} modesaddrcache;
+
+/* the longest Mode S frame; messages up to this size need no separate data buffer */
+#define MODES_INLINE_DATA 14
+
 /* a modesmessage object */
 typedef struct {
     PyObject_HEAD
@@ -36,16 +68,165 @@ typedef struct {
     char even_cpr;
     char odd_cpr;
     char valid;
-    PyObject *crc;
-    PyObject *address;
-    PyObject *altitude;
+    char repaired;
+
+    /* decoded values, only meaningful if the corresponding has_* flag is set */
+    char has_crc;
+    char has_address;
+    char has_altitude;
+    uint32_t crc;
+    uint32_t address;
+    int altitude;
+
+    /* python versions of the above, created on first access */
+    PyObject *crc_obj;
+    PyObject *address_obj;
+    PyObject *altitude_obj;
+
+    /* if not NULL, the address cache to take crc_obj / address_obj from,
+     * and a reference to the object that owns it, to keep it alive
+     */
+    modesaddrcache *addrcache;
+    PyObject *addrcache_owner;
 
-    uint8_t *data;
+    uint8_t *data;       /* points at inline_data for frames that fit there */
     int datalen;
+    uint8_t inline_data[MODES_INLINE_DATA];
 
     PyObject *eventdata;
+
+    PyObject *partner;   /* for DF17 sync candidates, the opposite-format position frame */
 } modesmessage;
 
+/* a compiled set of addresses: an open-addressing hash set of 32-bit values */
+typedef struct {
+    uint32_t *slots;
+    uint32_t mask;     /* number of slots - 1 */
+    int shift;         /* 32 - log2(number of slots) */
+    uint32_t count;
+} modesaddrset;
+
+#define ADDRSET_EMPTY 0xFFFFFFFFU
+
+/* compiled receiver filters, built from the Python-level filter objects */
+typedef struct {
+    char has_default;                 /* is a per-DF filter installed? */
+    char has_specific;                /* is a per-DF, per-address filter installed? */
+    char has_modeac;                  /* is a Mode A/C filter installed? */
+    uint32_t default_mask;            /* DFs wanted for all aircraft */
+    uint32_t specific_mask;           /* DFs wanted for the aircraft in specific[df] */
+    modesaddrset *specific[32];       /* per-DF address sets, possibly shared between DFs */
+    modesaddrset *sets[32];           /* the distinct sets in specific[], for cleanup */
+    int n_sets;
+    uint8_t *modeac;                  /* bitmap of wanted Mode A/C codes, 65536 bits */
+    char has_sync;                    /* is a DF17 sync candidate filter installed? */
+    modesaddrset *sync;               /* aircraft wanted as sync candidates */
+} modesfilter;
+
+/* per-aircraft summary of the valid DF11/17/18 frames seen since the last snapshot */
+typedef struct {
+    uint32_t address;
+    uint32_t count;                   /* number of frames */
+    uint32_t df_mask;                 /* bitmask of the DFs seen */
+    unsigned long long first_timestamp;
+    unsigned long long last_timestamp;
+} modesseenentry;
+
+typedef struct {
+    modesseenentry *entries;          /* in order of first appearance */
+    uint32_t n_entries;
+    uint32_t allocated;
+    int32_t *index;                   /* open-addressed hash of address -> entry index, -1 if empty */
+    uint32_t mask;
+    int shift;
+} modesseen;
+
+/* per-aircraft ADS-B position state, for aircraft that have sent DF17 frames */
+typedef struct {
+    uint32_t address;
+    uint32_t messages;                        /* DF17 frames seen */
+    uint32_t positions;                       /* usable positions since the last snapshot */
+    unsigned long long last_seen;             /* monotonic ms of the last DF17 frame */
+    unsigned long long last_good[2];          /* monotonic ms of the last usable even/odd position, 0 if none */
+    char has_cpr[2];                          /* have we seen an even/odd position frame? */
+    unsigned cpr_signal[2];
+    unsigned long long cpr_timestamp[2];      /* the last even/odd position frame */
+    uint8_t cpr_data[2][14];
+} modesadsbentry;
+
+typedef struct {
+    modesadsbentry *entries;
+    uint32_t n_entries;
+    uint32_t allocated;
+    int32_t *index;                   /* open-addressed hash of address -> entry index, -1 if empty */
+    uint32_t mask;
+    int shift;
+} modesadsb;
+
+/* a recently seen frame, for duplicate suppression */
+typedef struct {
+    unsigned long long timestamp;
+    uint8_t datalen;                  /* 0 if the slot is unused */
+    uint8_t data[14];
+} modesdedupentry;
+
+typedef struct {
+    modesdedupentry *entries;         /* direct-mapped on a hash of the frame bytes, allocated on first use */
+} modesdedup;
+
+static inline int modesaddrset_contains(const modesaddrset *set, uint32_t address)
+{
+    uint32_t i;
+
+    if (address == ADDRSET_EMPTY)
+        return 0;
+
+    for (i = (uint32_t)(address * 2654435761U) >> set->shift; set->slots[i] != ADDRSET_EMPTY; i = (i + 1) & set->mask) {
+        if (set->slots[i] == address)
+            return 1;
+    }
+
+    return 0;
+}
+
+/* does the filter accept all frames of this (Mode S) DF, regardless of address? */
+static inline int modesfilter_want_df(const modesfilter *filter, unsigned df)
+{
+    return (!filter->has_default && !filter->has_specific) || (filter->default_mask & (1U << df));
+}
+
+/* might the filter accept any frame of this (Mode S) DF? */
+static inline int modesfilter_maybe_df(const modesfilter *filter, unsigned df)
+{
+    return (!filter->has_default && !filter->has_specific) || ((filter->default_mask | filter->specific_mask) & (1U << df));
+}
+
+/* does the filter accept this (Mode S) DF / address combination? */
+static inline int modesfilter_want(const modesfilter *filter, unsigned df, uint32_t address)
+{
+    if (modesfilter_want_df(filter, df))
+        return 1;
+    if (filter->specific_mask & (1U << df))
+        return modesaddrset_contains(filter->specific[df], address);
+    return 0;
+}
+
+/* does the filter accept this Mode A/C code? */
+static inline int modesfilter_want_modeac(const modesfilter *filter, uint32_t address)
+{
+    if (!filter->has_modeac)
+        return 1;
+    return (address < 65536 && (filter->modeac[address >> 3] & (1 << (address & 7))));
+}
+
+/* is this aircraft wanted as a DF17 sync candidate? */
+static inline int modesfilter_want_sync(const modesfilter *filter, uint32_t address)
+{
+    if (!filter->has_sync)
+        return 1;
+    return modesaddrset_contains(filter->sync, address);
+}
+
 /* special DF types for non-Mode-S messages */
 #define DF_MODEAC 32
 #define DF_EVENT_TIMESTAMP_JUMP 33
@@ -54,16 +235,113 @@ typedef struct {
 #define DF_EVENT_RADARCAPE_STATUS 36
 #define DF_EVENT_RADARCAPE_POSITION 37
 
+/* decode a raw frame without creating any python objects */
+void modesmessage_decode_fields(uint8_t *data, int datalen, modesfields *fields);
+/* try to correct a single-bit error in an invalid DF11/DF17 frame; on success, writes
+ * the corrected frame to repaired, updates fields to match it and returns 1
+ */
+int modesmessage_repair_fields(uint8_t *data, int datalen, uint8_t *repaired, modesfields *fields);
 /* factory function to build a modesmessage from a provided buffer */
 PyObject *modesmessage_from_buffer(unsigned long long timestamp, unsigned signal, uint8_t *data, int datalen);
+/* factory function to build a modesmessage from a provided buffer that has already been decoded;
+ * if cache is not NULL, the message's address object is taken from it when first needed,
+ * and the message keeps a reference to cache_owner until then
+ */
+PyObject *modesmessage_from_fields(unsigned long long timestamp, unsigned signal, uint8_t *data, int datalen, modesfields *fields,
+                                   modesaddrcache *cache, PyObject *cache_owner);
 /* factory function to build an event message */
 PyObject *modesmessage_new_eventmessage(int type, unsigned long long timestamp, PyObject *eventdata);
+/* is this a modesmessage? */
+int modesmessage_check(PyObject *o);
 /* python entry point */
 PyObject *modesmessage_eventmessage(PyObject *self, PyObject *args, PyObject *kwds);
 
+/* address cache helpers */
+void modesaddrcache_init(modesaddrcache *cache);
+void modesaddrcache_clear(modesaddrcache *cache);
+PyObject *modesaddrcache_get(modesaddrcache *cache, uint32_t address);
+
+/* input format detection */
+PyObject *modesreader_detect_format(PyObject *self, PyObject *args);
+
+/* TCP JSON line encoding */
+PyObject *modesjson_append_mlat(PyObject *self, PyObject *args);
+PyObject *modesjson_append_sync(PyObject *self, PyObject *args);
+PyObject *modesjson_append_ssync(PyObject *self, PyObject *args);
+
+/* message batch serialization */
+PyObject *modesbatch_pack(PyObject *self, PyObject *args);
+PyObject *modesbatch_unpack(PyObject *self, PyObject *args);
+
+/* offline decoding */
+PyObject *modesreader_decode_file(PyObject *self, PyObject *args, PyObject *kwds);
+
 /* crc helpers */
 uint32_t modescrc_buffer_crc(uint8_t *buf, Py_ssize_t len); /* internal interface */
+int modescrc_syndrome_bit(uint32_t syndrome, int len);      /* position of a single-bit error, or -1 */
 PyObject *modescrc_crc(PyObject *self, PyObject *args);   /* external interface */
+PyObject *modescrc_crc_many(PyObject *self, PyObject *args, PyObject *kwds);
+
+/* filter helpers; the compile functions leave the filter unchanged on error */
+void modesfilter_init(modesfilter *filter);
+void modesfilter_free(modesfilter *filter);
+int modesfilter_compile_default(modesfilter *filter, PyObject *default_filter);
+int modesfilter_compile_specific(modesfilter *filter, PyObject *specific_filter);
+int modesfilter_compile_modeac(modesfilter *filter, PyObject *modeac_filter);
+int modesfilter_compile_sync(modesfilter *filter, PyObject *sync_filter);
+
+/* Beast framing, usable without the GIL */
+#define BEAST_MAX_PAYLOAD (7 + 21)
+#define BEAST_FRAME_OK 1
+#define BEAST_FRAME_MORE 0
+#define BEAST_FRAME_BAD_MARKER -1
+#define BEAST_FRAME_BAD_TYPE -2
+#define BEAST_FRAME_BAD_ESCAPE -3
+int modesbeast_frame(uint8_t *p, uint8_t *eod, uint8_t *scratch, uint8_t *type, uint8_t **payload, uint8_t **next);
+
+/* length of the unescaped payload of a Beast frame of a known-good type */
+static inline int modesbeast_payload_len(uint8_t type)
+{
+    switch (type) {
+    case '1': return 7 + 2;
+    case '2': return 7 + 7;
+    case '5': return 21;
+    default: return 7 + 14;
+    }
+}
+
+/* a Beast frame queued by a ReaderThread */
+typedef struct {
+    uint8_t type;
+    uint8_t payload[BEAST_MAX_PAYLOAD];
+} modesrawframe;
+
+/* ReaderThread helpers, for Reader.drain() */
+int modesthread_check(PyObject *o);
+void modesthread_clear_wakeup(PyObject *thread);
+unsigned modesthread_available(PyObject *thread);
+unsigned modesthread_take(PyObject *thread, modesrawframe **frames);
+void modesthread_release(PyObject *thread, unsigned n);
+int modesthread_finished(PyObject *thread);
+int modesthread_raise_if_stopped(PyObject *thread);
+
+/* seen-aircraft table helpers */
+void modesseen_init(modesseen *seen);
+void modesseen_free(modesseen *seen);
+int modesseen_add(modesseen *seen, uint32_t address, unsigned df, unsigned long long timestamp);
+PyObject *modesseen_take(modesseen *seen);
+
+/* ADS-B position tracker helpers */
+void modesadsb_init(modesadsb *adsb);
+void modesadsb_free(modesadsb *adsb);
+int modesadsb_update(modesadsb *adsb, modesfields *fields, unsigned long long timestamp, unsigned signal, uint8_t *data,
+                     unsigned long long pair_window, unsigned long long now, modesadsbentry **entry);
+PyObject *modesadsb_take(modesadsb *adsb, unsigned long long now);
+
+/* duplicate suppression helpers */
+void modesdedup_init(modesdedup *dedup);
+void modesdedup_free(modesdedup *dedup);
+int modesdedup_check(modesdedup *dedup, unsigned long long timestamp, uint8_t *data, int datalen, unsigned long long window);
 
 /* submodule init/cleanup */
 int modescrc_module_init(PyObject *m);
@@ -72,5 +350,9 @@ int modesreader_module_init(PyObject *m);
 void modesreader_module_free(PyObject *m);
 int modesmessage_module_init(PyObject *m);
 void modesmessage_module_free(PyObject *m);
+int modesthread_module_init(PyObject *m);
+void modesthread_module_free(PyObject *m);
+int modesudp_module_init(PyObject *m);
+void modesudp_module_free(PyObject *m);
 
 #endif
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+#   Decoder micro-benchmark suite with machine-readable results.
+#
+#   build the _modes module in place, then run from the top of the tree:
+#    $ python3 ./setup.py build_ext --inplace
+#    $ PYTHONPATH=. ./benchmarks/decoder.py --output results.json
+#    $ PYTHONPATH=. ./benchmarks/decoder.py --baseline results.json [--tolerance 10]
+#
+#   Deterministic Beast, Radarcape, AVR-MLAT and SBS streams (see streams.py)
+#   are fed through Reader.feed with four filter setups:
+#
+#     off       no filtering; every frame becomes a Message
+#     discard   filters set so that nothing is returned, so the figures are
+#               dominated by input parsing and frame decoding rather than
+#               by building Message objects
+#     typical   what the client asks for while connected to a server: a
+#               default filter, per-aircraft specific filters, ADS-B
+#               tracking with a sync filter, and a small Mode A/C filter
+#     seen      typical, plus the seen-aircraft table
+#
+#   and the CRC is timed on its own: _modes.crc on 4- and 11-byte frame
+#   bodies, one call each, and _modes.crc_many on packed arrays of 7- and
+#   14-byte frames, with the cost per frame in nanoseconds so that machines
+#   (e.g. x86 and ARM receivers) can be compared. Each figure is the best of
+#   --rounds passes. With --baseline, each throughput is compared with the same
+#   figure from an earlier --output file and the exit status is 1 if any of
+#   them fell by more than --tolerance percent. Baselines are only
+#   meaningful on the machine (and with the options) they were taken with.
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import _modes
+
+import streams
+
+
+STREAMS = [
+    ('beast', _modes.BEAST, streams.beast),
+    ('radarcape', _modes.BEAST, streams.radarcape),
+    ('avrmlat', _modes.AVRMLAT, streams.avrmlat),
+    ('sbs', _modes.SBS, streams.sbs),
+]
+
+CONFIGS = ['off', 'discard', 'typical', 'seen']
+
+
+def configure(reader, config, addresses):
+    """Set up a reader's filters for one of CONFIGS."""
+    reader.want_events = False
+    if config == 'off':
+        return
+
+    if config == 'discard':
+        reader.set_filter(default_filter=[False] * 32,
+                          modeac_filter=set())
+        return
+
+    # roughly what the coordinator requests: all-call and surveillance
+    # replies from a quarter of the aircraft, sync candidates from an
+    # eighth of them, and a couple of Mode A/C codes
+    wanted = set(addresses[::4])
+    default_filter = [False] * 32
+    specific_filter = [None] * 32
+    for df in (0, 4, 5, 11, 16, 20, 21):
+        specific_filter[df] = wanted
+
+    reader.track_adsb = True
+    reader.set_filter(default_filter=default_filter,
+                      specific_filter=specific_filter,
+                      modeac_filter={0x1200, 0x7700},
+                      sync_filter=set(addresses[::8]))
+    reader.track_seen = (config == 'seen')
+
+
+def feed_throughput(mode, data, config, addresses, rounds):
+    """Return the best (frames/s, bytes/s) over several passes."""
+    best = None
+    frames = 0
+
+    for _ in range(rounds):
+        reader = _modes.Reader(mode)
+        configure(reader, config, addresses)
+
+        start = time.perf_counter()
+        pos = 0
+        while pos < len(data):
+            # the text formats can't be split at arbitrary points, so
+            # always feed everything that is left
+            n, batch, pending_error = reader.feed(data, start=pos)
+            if n == pos:
+                break
+            pos = n
+        elapsed = time.perf_counter() - start
+
+        frames = reader.received_messages
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return frames / best, len(data) / best
+
+
+def crc_throughput(length, count, rounds):
+    """Return the best (calls/s, bytes/s) of _modes.crc over count bodies of a given length."""
+    bodies = [bytes((i * 7 + j) & 0xFF for j in range(length)) for i in range(256)]
+    bodies = (bodies * (count // len(bodies) + 1))[:count]
+    crc = _modes.crc
+
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for body in bodies:
+            crc(body)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return count / best, count * length / best
+
+
+def crc_many_throughput(length, count, rounds):
+    """Return the best (frames/s, bytes/s) of _modes.crc_many over count packed frames of a given length."""
+    frames = bytes((i * 7 + j) & 0xFF for i in range(256) for j in range(length))
+    frames = (frames * (count // 256 + 1))[:count * length]
+
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        _modes.crc_many(frames, length)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return count / best, count * length / best
+
+
+def run(args):
+    mix = {'seed': args.seed, 'aircraft': args.aircraft, 'modeac': args.modeac}
+    addresses = streams.aircraft_addresses(**mix)
+    results = {}
+
+    for name, mode, generate in STREAMS:
+        if name in ('beast', 'radarcape'):
+            data = generate(args.frames, escapes=args.escapes, **mix)
+        else:
+            data = generate(args.frames, **mix)
+
+        for config in CONFIGS:
+            fps, bps = feed_throughput(mode, data, config, addresses, args.rounds)
+            results['feed.{0}.{1}'.format(name, config)] = {'frames_per_s': fps, 'bytes_per_s': bps}
+            print('{0:28s} {1:12.0f} frames/s {2:8.1f} MB/s'.format('feed.' + name + '.' + config, fps, bps / 1e6))
+
+    for length in (4, 11):
+        cps, bps = crc_throughput(length, args.frames, args.rounds)
+        results['crc.{0}'.format(length)] = {'calls_per_s': cps, 'bytes_per_s': bps, 'ns_per_call': 1e9 / cps}
+        print('{0:28s} {1:12.0f} calls/s  {2:8.1f} MB/s {3:7.1f} ns/call'.format(
+            'crc.' + str(length), cps, bps / 1e6, 1e9 / cps))
+
+    for length in (7, 14):
+        fps, bps = crc_many_throughput(length, args.frames, args.rounds)
+        results['crc_many.{0}'.format(length)] = {'frames_per_s': fps, 'bytes_per_s': bps, 'ns_per_frame': 1e9 / fps}
+        print('{0:28s} {1:12.0f} frames/s {2:8.1f} MB/s {3:7.1f} ns/frame'.format(
+            'crc_many.' + str(length), fps, bps / 1e6, 1e9 / fps))
+
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'options': dict(mix, frames=args.frames, rounds=args.rounds, escapes=args.escapes),
+        'results': results
+    }
+
+
+def compare(current, baseline, tolerance):
+    """Print current/baseline ratios; return the names of the figures that regressed."""
+    if baseline.get('options') != current['options']:
+        print('warning: baseline was taken with different options: {0}'.format(baseline.get('options')))
+
+    regressed = []
+    print()
+    for name, figures in sorted(current['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            print('{0:28s} (not in baseline)'.format(name))
+            continue
+
+        # the first figure of each result is the headline throughput
+        key = 'frames_per_s' if 'frames_per_s' in figures else 'calls_per_s'
+        ratio = figures[key] / old[key]
+        flag = ''
+        if ratio < 1.0 - tolerance / 100.0:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        print('{0:28s} {1:6.2f}x{2}'.format(name, ratio, flag))
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decoder micro-benchmarks.")
+    parser.add_argument('--frames', type=int, default=100000, help="number of synthetic frames per stream")
+    parser.add_argument('--rounds', type=int, default=5, help="passes over each stream; the best is reported")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the synthetic streams")
+    parser.add_argument('--aircraft', type=int, default=200, help="number of distinct aircraft in the streams")
+    parser.add_argument('--modeac', type=float, default=0.0, help="share of Mode A/C frames (0..1)")
+    parser.add_argument('--escapes', type=float, default=None,
+                        help="share of Beast frames with an escaped signal byte (0..1; default random)")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare with the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help="allowed throughput drop relative to the baseline, in percent")
+    args = parser.parse_args()
+
+    current = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(current, baseline, args.tolerance)
+        if regressed:
+            print('{0} figure(s) regressed by more than {1}%'.format(len(regressed), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
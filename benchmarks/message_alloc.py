@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+#   Measure the allocation cost of decoding frames into _modes.Message objects.
+#
+#   build the _modes module in place, then run from the top of the tree:
+#    $ python3 ./setup.py build_ext --inplace
+#    $ PYTHONPATH=. ./benchmarks/message_alloc.py [--input capture.beast]
+#
+#   Without --input a synthetic Beast stream is used (see streams.py).
+#   Run it against two builds to compare them. Reported figures:
+#
+#     traced blocks/frame   Python-allocator blocks still held per message
+#                           while the decoded messages are kept alive
+#     malloc bytes/frame    C heap bytes held per message (glibc only);
+#                           this is where per-message data buffers show up
+#     ns/frame              steady-state decode time when each batch of
+#                           messages is dropped before the next feed
+
+import argparse
+import ctypes
+import ctypes.util
+import time
+import tracemalloc
+
+import _modes
+
+import streams
+
+
+class _mallinfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks',
+                                                     'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+
+def malloc_in_use():
+    """Bytes currently allocated from the C heap, or None if we can't tell."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        mallinfo2 = libc.mallinfo2
+    except (OSError, AttributeError, TypeError):
+        return None
+    mallinfo2.restype = _mallinfo2
+    return mallinfo2().uordblks
+
+
+def decode_all(reader, data):
+    messages = []
+    pos = 0
+    while pos < len(data):
+        n, batch, pending_error = reader.feed(data[pos:])
+        messages.extend(batch)
+        pos += n
+        if n == 0:
+            break
+    return messages
+
+
+def retained_cost(data):
+    """Decode everything, keeping the messages, and see what is held per message."""
+    reader = _modes.Reader(_modes.BEAST)
+    reader.want_events = False
+
+    heap_before = malloc_in_use()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    messages = decode_all(reader, data)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    heap_after = malloc_in_use()
+
+    # ignore the list holding the messages
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename')) - 1
+    n = len(messages)
+    heap = (heap_after - heap_before) / n if heap_before is not None else None
+    return n, blocks / n, heap
+
+
+def steady_state(data, rounds):
+    """Time decoding when each batch is discarded, as the client does."""
+    reader = _modes.Reader(_modes.BEAST)
+    reader.want_events = False
+    view = memoryview(data)
+    count = 0
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        reader.last_timestamp = 0
+        pos = 0
+        while pos < len(data):
+            n, batch, pending_error = reader.feed(view[pos:pos + 16384])
+            count += len(batch)
+            if n == 0:
+                break
+            pos += n
+        del batch
+    elapsed = time.perf_counter() - start
+    return elapsed * 1e9 / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure allocations per decoded frame.")
+    parser.add_argument('--input', help="raw Beast-format capture to decode (default: synthetic stream)")
+    parser.add_argument('--frames', type=int, default=200000, help="number of synthetic frames to generate")
+    parser.add_argument('--rounds', type=int, default=5, help="passes over the stream for the timing run")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'rb') as f:
+            data = f.read()
+    else:
+        data = streams.beast(args.frames)
+
+    n, blocks, heap = retained_cost(data)
+    ns = steady_state(data, args.rounds)
+
+    print('frames decoded:      {0}'.format(n))
+    print('traced blocks/frame: {0:.2f}'.format(blocks))
+    if heap is None:
+        print('malloc bytes/frame:  unavailable')
+    else:
+        print('malloc bytes/frame:  {0:.1f}'.format(heap))
+    print('ns/frame:            {0:.0f}'.format(ns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+"""Deterministic synthetic receiver streams for the benchmarks.
+
+The streams are generated from a fixed seed so that results from different
+builds are comparable. Frames are built with correct CRCs (DF11/17/18) or
+correct address/parity (the other DFs) for a fixed population of aircraft.
+
+All generators take the keyword arguments of frames() (seed, number of
+aircraft, share of Mode A/C frames); the Beast-style generators also take
+the share of frames whose signal byte needs escaping.
+"""
+
+import random
+
+import _modes
+
+# rough mix of DFs seen from a busy receiver
+DF_MIX = (0, 4, 5, 11, 11, 17, 17, 17, 17, 20, 21)
+
+
+def _crc_bytes(crc):
+    return bytes(((crc >> 16) & 255, (crc >> 8) & 255, crc & 255))
+
+
+def mode_s_frame(rnd, df, address):
+    """Build one Mode S frame for the given DF and address."""
+    if df in (11, 17, 18):
+        body = bytes(((df << 3) | 5, address >> 16, (address >> 8) & 255, address & 255))
+        if df != 11:
+            # airborne position, so that altitude/CPR decoding gets exercised
+            body += bytes((11 << 3, rnd.randrange(256), rnd.randrange(256) | (rnd.randrange(2) << 2),
+                           rnd.randrange(1, 256), rnd.randrange(256), rnd.randrange(1, 256), rnd.randrange(256)))
+        return body + _crc_bytes(_modes.crc(body))
+
+    n = 7 if df < 16 else 14
+    body = bytes([df << 3] + [rnd.randrange(256) for _ in range(n - 4)])
+    return body + _crc_bytes(_modes.crc(body) ^ address)
+
+
+def aircraft_addresses(*, seed=1, aircraft=200, **kwargs):
+    """Return the aircraft addresses used by frames() with the same arguments."""
+    rnd = random.Random(seed)
+    return [rnd.randrange(1, 1 << 24) for _ in range(aircraft)]
+
+
+def frames(n, *, seed=1, aircraft=200, modeac=0.0):
+    """Yield (timestamp, data) for n frames; timestamps are 12MHz ticks."""
+    rnd = random.Random(seed)
+    addresses = [rnd.randrange(1, 1 << 24) for _ in range(aircraft)]
+    timestamp = 1000000
+    for _ in range(n):
+        timestamp += rnd.randrange(100, 3000)
+        if rnd.random() < modeac:
+            yield timestamp, bytes((rnd.randrange(256), rnd.randrange(256)))
+        else:
+            yield timestamp, mode_s_frame(rnd, rnd.choice(DF_MIX), rnd.choice(addresses))
+
+
+def _beast_frame(t, timestamp, signal, data):
+    payload = timestamp.to_bytes(6, 'big') + bytes((signal,)) + data
+    return b'\x1a' + t + payload.replace(b'\x1a', b'\x1a\x1a')
+
+
+def _beast_type(data):
+    return {2: b'1', 7: b'2'}.get(len(data), b'3')
+
+
+def beast(n, *, escapes=None, **kwargs):
+    """Return n frames as a Beast-format byte stream.
+
+    If escapes is given, it is the share of frames whose signal byte is
+    0x1A (and so needs escaping); otherwise the signal byte is random.
+    """
+    rnd = random.Random(kwargs.get('seed', 1))
+    out = bytearray()
+    for timestamp, data in frames(n, **kwargs):
+        signal = rnd.randrange(256)
+        if escapes is not None:
+            signal = 0x1a if rnd.random() < escapes else (signal | 0x80)
+        out += _beast_frame(_beast_type(data), timestamp, signal, data)
+    return bytes(out)
+
+
+def radarcape(n, *, escapes=None, status_interval=10000, **kwargs):
+    """Return n frames as a Radarcape (GPS timestamp) Beast-format byte stream.
+
+    Timestamps are seconds-since-midnight and nanoseconds, and a status
+    frame announcing GPS timestamps is sent first and then every
+    status_interval frames, as a Radarcape does once a second.
+    """
+    rnd = random.Random(kwargs.get('seed', 1))
+    status = bytes((0x10, 0, 0)) + bytes(11)
+    out = bytearray()
+    for i, (timestamp, data) in enumerate(frames(n, **kwargs)):
+        ns = timestamp * 1000 // 12
+        timestamp = ((ns // 1000000000) << 30) | (ns % 1000000000)
+        if i % status_interval == 0:
+            out += _beast_frame(b'4', timestamp, 0, status)
+        signal = rnd.randrange(256)
+        if escapes is not None:
+            signal = 0x1a if rnd.random() < escapes else (signal | 0x80)
+        out += _beast_frame(_beast_type(data), timestamp, signal, data)
+    return bytes(out)
+
+
+def avrmlat(n, **kwargs):
+    """Return n frames as an AVR-MLAT ('@' + 12MHz timestamp) text stream."""
+    out = []
+    for timestamp, data in frames(n, **kwargs):
+        out.append('@{0:012X}{1};\n'.format(timestamp, data.hex().upper()))
+    return ''.join(out).encode('ascii')
+
+
+def _sbs_stuff(data):
+    return data.replace(b'\x10', b'\x10\x10')
+
+
+def sbs(n, **kwargs):
+    """Return n frames as a Kinetic SBS binary stream with a 20MHz 24-bit timestamp."""
+    out = bytearray()
+    for timestamp, data in frames(n, **kwargs):
+        if len(data) == 2:
+            t = 0x09
+        elif len(data) == 7:
+            t = 0x07
+        else:
+            t = 0x05 if (data[0] >> 3) != 17 else 0x01
+
+        ts = (timestamp * 20 // 12) & 0xFFFFFF
+        if len(data) > 2:
+            # SBS sends the CRC residual rather than the CRC itself
+            crc = _modes.crc(data[:-3])
+            data = data[:-3] + bytes(a ^ b for a, b in zip(data[-3:], _crc_bytes(crc)))
+        body = bytes((t, 0)) + ts.to_bytes(3, 'little') + data
+        out += b'\x10\x02' + _sbs_stuff(body) + b'\x10\x03' + _sbs_stuff(b'\x00\x00')
+    return bytes(out)
@@ -9,34 +9,16 @@ import socket
 import errno
 import sys
 import itertools
-import struct
 
+import _modes
 from mlat.client import net, util, stats, version
 
-# UDP protocol submessages
+# UDP datagrams are built by _modes.UdpEncoder.
 # TODO: This needs merging with mlat-client's variant
 # (they are not quite identical so it'll need a new
 # udp protocol version - this version has the decoded
 # ICAO address at the start of MLAT/SYNC to ease the
-# work of the server doing fan-out)
-
-TYPE_SYNC = 1
-TYPE_MLAT_SHORT = 2
-TYPE_MLAT_LONG = 3
-# TYPE_SSYNC = 4
-TYPE_REBASE = 5
-TYPE_ABS_SYNC = 6
-TYPE_MLAT_MODEAC = 7
-
-STRUCT_HEADER = struct.Struct(">IHQ")
-STRUCT_SYNC = struct.Struct(">B3Bii14s14s")
-# STRUCT_SSYNC = struct.Struct(">Bi14s")
-STRUCT_MLAT_SHORT = struct.Struct(">B3Bi7s")
-STRUCT_MLAT_LONG = struct.Struct(">B3Bi14s")
-STRUCT_REBASE = struct.Struct(">BQ")
-STRUCT_ABS_SYNC = struct.Struct(">B3BQQ14s14s")
-STRUCT_MLAT_MODEAC = struct.Struct(">Bi2s")
-
+# work of the server doing fan-out; see addresses=True)
 
 if sys.platform == 'linux':
     IP_MTU = 14   # not defined in the socket module, unfortunately
@@ -59,14 +41,9 @@ class UdpServerConnection:
         self.port = port
         self.key = key
 
-        self.base_timestamp = None
-        self.header_timestamp = None
-        self.buf = bytearray(1500)
-        self.used = 0
-        self.seq = 0
+        self.encoder = _modes.UdpEncoder(key, addresses=True, mtu=1400)
         self.count = 0
         self.sock = None
-        self.mtu = 1400
         self.route_mtu = -1
 
     def start(self):
@@ -97,109 +74,43 @@ class UdpServerConnection:
         if new_mtu is not None and new_mtu != self.route_mtu:
             util.log('Route MTU changed to {0}', new_mtu)
             self.route_mtu = new_mtu
-            self.mtu = max(100, self.route_mtu - 100)
-
-    def prepare_header(self, timestamp):
-        self.base_timestamp = timestamp
-        STRUCT_HEADER.pack_into(self.buf, 0,
-                                self.key, self.seq, self.base_timestamp)
-        self.used += STRUCT_HEADER.size
-
-    def rebase(self, timestamp):
-        self.base_timestamp = timestamp
-        STRUCT_REBASE.pack_into(self.buf, self.used,
-                                TYPE_REBASE,
-                                self.base_timestamp)
-        self.used += STRUCT_REBASE.size
+            self.flush()    # the new MTU may be smaller than the datagram in progress
+            self.encoder.mtu = max(100, self.route_mtu - 100)
 
     def send_mlat(self, message):
-        if not self.used:
-            self.prepare_header(message.timestamp)
-
-        delta = message.timestamp - self.base_timestamp
-        if abs(delta) > 0x7FFFFFF0:
-            self.rebase(message.timestamp)
-            delta = 0
-
-        if len(message) == 2:
-            STRUCT_MLAT_MODEAC.pack_into(self.buf, self.used,
-                                         TYPE_MLAT_MODEAC,
-                                         delta, bytes(message))
-            self.used += STRUCT_MLAT_MODEAC.size
-        elif len(message) == 7:
-            STRUCT_MLAT_SHORT.pack_into(self.buf, self.used,
-                                        TYPE_MLAT_SHORT,
-                                        message.address >> 16,
-                                        (message.address >> 8) & 255,
-                                        message.address & 255,
-                                        delta, bytes(message))
-            self.used += STRUCT_MLAT_SHORT.size
-
-        elif len(message) == 14:
-            STRUCT_MLAT_LONG.pack_into(self.buf, self.used,
-                                       TYPE_MLAT_LONG,
-                                       message.address >> 16,
-                                       (message.address >> 8) & 255,
-                                       message.address & 255,
-                                       delta, bytes(message))
-            self.used += STRUCT_MLAT_LONG.size
-
-        if self.used > self.mtu:
-            self.flush()
+        datagram = self.encoder.mlat(message)
+        if datagram:
+            self.send_datagram(datagram)
+
+    def send_many(self, messages):
+        for datagram in self.encoder.mlat_many(messages):
+            self.send_datagram(datagram)
 
     def send_sync(self, em, om):
-        if not self.used:
-            self.prepare_header(int((em.timestamp + om.timestamp) / 2))
-
-        if abs(em.timestamp - om.timestamp) > 0xFFFFFFF0:
-            # use abs sync
-            STRUCT_ABS_SYNC.pack_into(self.buf, self.used,
-                                      TYPE_ABS_SYNC,
-                                      em.address >> 16,
-                                      (em.address >> 8) & 255,
-                                      em.address & 255,
-                                      em.timestamp, om.timestamp, bytes(em), bytes(om))
-            self.used += STRUCT_ABS_SYNC.size
-        else:
-            edelta = em.timestamp - self.base_timestamp
-            odelta = om.timestamp - self.base_timestamp
-            if abs(edelta) > 0x7FFFFFF0 or abs(odelta) > 0x7FFFFFF0:
-                self.rebase(int((em.timestamp + om.timestamp) / 2))
-                edelta = em.timestamp - self.base_timestamp
-                odelta = om.timestamp - self.base_timestamp
-
-            STRUCT_SYNC.pack_into(self.buf, self.used,
-                                  TYPE_SYNC,
-                                  em.address >> 16,
-                                  (em.address >> 8) & 255,
-                                  em.address & 255,
-                                  edelta, odelta, bytes(em), bytes(om))
-            self.used += STRUCT_SYNC.size
-
-        if self.used > self.mtu:
-            self.flush()
+        datagram = self.encoder.sync(em, om)
+        if datagram:
+            self.send_datagram(datagram)
 
     def flush(self):
-        if not self.used:
-            return
+        datagram = self.encoder.flush()
+        if datagram:
+            self.send_datagram(datagram)
 
+    def send_datagram(self, datagram):
         try:
-            self.sock.send(memoryview(self.buf)[0:self.used])
+            self.sock.send(datagram)
         except socket.error:
             pass
 
-        stats.global_stats.server_udp_bytes += self.used
+        stats.global_stats.server_udp_bytes += len(datagram)
 
-        self.used = 0
-        self.base_timestamp = None
-        self.seq = (self.seq + 1) & 0xffff
         self.count += 1
 
         if self.count % 50 == 0:
             self.refresh_socket()
 
     def close(self):
-        self.used = 0
+        self.encoder.clear()
         if self.sock:
             self.sock.close()
 
@@ -439,6 +350,7 @@ class AdeptConnection:
 
         self.udp_transport.start()
         self.send_mlat = self.udp_transport.send_mlat
+        self.send_mlat_many = self.udp_transport.send_many
         self.send_sync = self.udp_transport.send_sync
         self.send_split_sync = None
         self.send_seen = self.writer.send_seen
@@ -0,0 +1,80 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-client - an ADS-B multilateration client.
+# Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Capture files of raw receiver input.
+
+A capture file is a sequence of records, one per read from the receiver:
+
+    8 bytes   wall-clock arrival time, seconds since the epoch (little-endian double)
+    4 bytes   length n (little-endian unsigned)
+    n bytes   the data exactly as it was read
+
+A record with no data marks the start of a new receiver connection. Files
+are only ever appended to, so a capture spanning several connections or
+several runs is just a longer capture.
+"""
+
+import struct
+import time
+
+__all__ = ('CaptureWriter', 'read_capture')
+
+_record_header = struct.Struct('<dI')
+
+
+class CaptureWriter:
+    """Appends receiver input to a capture file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'ab')
+
+    def new_connection(self):
+        """Note that the following data comes from a new connection."""
+        self.f.write(_record_header.pack(time.time(), 0))
+
+    def write(self, data):
+        """Append one chunk of input, stamped with the current time."""
+        self.f.write(_record_header.pack(time.time(), len(data)))
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_capture(f):
+    """Yield (arrival time, data) for each record in a capture file
+    opened for binary reading. data is empty for a new-connection mark.
+    A truncated record at the end of the file (e.g. from a capture that
+    is still being written) is ignored."""
+
+    while True:
+        header = f.read(_record_header.size)
+        if len(header) < _record_header.size:
+            return
+
+        arrival, length = _record_header.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            return
+
+        yield arrival, data
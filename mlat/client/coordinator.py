@@ -41,8 +41,6 @@ class Aircraft:
         self.last_even_time = 0
         self.last_odd_time = 0
         self.adsb_good = False
-        self.even_message = None
-        self.odd_message = None
         self.reported = False
         self.requested = True
         self.measurement_start = None
@@ -90,6 +88,7 @@ class Coordinator:
         self.next_aircraft_update = self.last_aircraft_update = monotonic_time()
         self.recent_jumps = 0
         self.last_jump_message = 0
+        self.pending_mlat = []
 
         self.server_send = 1
 
@@ -162,7 +161,7 @@ class Coordinator:
         # process aircraft the receiver has seen
         # (we have not necessarily seen any messages,
         # due to the receiver filter)
-        for icao in self.receiver.recent_aircraft():
+        for icao, count, _ in self.receiver.recent_aircraft():
             ac = self.aircraft.get(icao)
             if not ac:
                 ac = Aircraft(icao)
@@ -171,11 +170,22 @@ class Coordinator:
                 self.aircraft[icao] = ac
 
             if ac.last_message_time <= self.last_aircraft_update:
-                # fudge it a bit, receiver has seen messages
-                # but they were all filtered
-                ac.messages += 1
+                # receiver has seen messages but they were
+                # all filtered; count them anyway
+                ac.messages += count
                 ac.last_message_time = now
 
+        # process the ADS-B position state tracked by the receiver
+        for icao, positions, even_age, odd_age in self.receiver.recent_positions():
+            ac = self.aircraft.get(icao)
+            if not ac:
+                continue
+
+            ac.recent_adsb_positions += positions
+            ac.last_even_time = now - even_age
+            ac.last_odd_time = now - odd_age
+
+        for ac in self.aircraft.values():
             if now - ac.last_even_time < self.position_expiry_age and now - ac.last_odd_time < self.position_expiry_age:
                 ac.adsb_good = True
             else:
@@ -305,6 +315,7 @@ class Coordinator:
                 mlat.add(icao)
 
         self.receiver.update_filter(mlat)
+        self.receiver.update_sync_filter(self.requested_traffic)
         self.receiver.update_modeac_filter(self.requested_modeac)
 
     # callbacks from receiver input
@@ -327,6 +338,11 @@ class Coordinator:
             if handler:
                 handler(message, now)
 
+        # the handlers collect mlat messages; send them in one batch
+        if self.pending_mlat:
+            self.server.send_mlat_many(self.pending_mlat)
+            self.pending_mlat.clear()
+
     # handlers for input messages
 
     def received_mode_change_event(self, message, now):
@@ -380,7 +396,7 @@ class Coordinator:
         # Candidate for MLAT
         if ac.adsb_good:
             return   # reported position recently, no need for mlat
-        self.server.send_mlat(message)
+        self.pending_mlat.append(message)
 
     def received_df11(self, message, now):
         ac = self.aircraft.get(message.address)
@@ -404,59 +420,21 @@ class Coordinator:
         # Candidate for MLAT
         if ac.adsb_good:
             return   # reported position recently, no need for mlat
-        self.server.send_mlat(message)
+        self.pending_mlat.append(message)
 
     def received_df17(self, message, now):
+        # the receiver tracks ADS-B positions itself (see update_aircraft)
+        # and only passes on usable positions from requested aircraft,
+        # along with the latest position of the other CPR format
         ac = self.aircraft.get(message.address)
         if not ac:
             ac = Aircraft(message.address)
             ac.requested = (message.address in self.requested_traffic)
-            ac.messages += 1
-            ac.last_message_time = now
             ac.rate_measurement_start = now
             self.aircraft[message.address] = ac
-            return   # wait for more messages
 
         ac.messages += 1
         ac.last_message_time = now
-        if ac.messages < 10:
-            return
-
-        if not message.even_cpr and not message.odd_cpr:
-            # not a position message
-            return
-
-        if not message.valid:
-            # invalid message
-            return
-
-        if message.even_cpr:
-            ac.even_message = message
-        else:
-            ac.odd_message = message
-
-        if not ac.even_message or not ac.odd_message:
-            return
-        if abs(ac.even_message.timestamp - ac.odd_message.timestamp) > 5 * self.freq:
-            return
-
-        if message.altitude is None:
-            return    # need an altitude
-
-        if message.nuc < 6:
-            return    # need NUCp >= 6
-
-        ac.recent_adsb_positions += 1
-
-        if message.even_cpr:
-            ac.last_even_time = now
-        else:
-            ac.last_odd_time = now
-
-        if now - ac.last_even_time < self.position_expiry_age and now - ac.last_odd_time < self.position_expiry_age:
-            ac.adsb_good = True
-        else:
-            ac.adsb_good = False
 
         if not ac.requested:
             return
@@ -464,12 +442,14 @@ class Coordinator:
         if self.server.send_split_sync:
             # this is a useful reference message
             self.server.send_split_sync(message)
-        else:
+        elif message.even_cpr:
             # this is a useful reference message pair
-            self.server.send_sync(ac.even_message, ac.odd_message)
+            self.server.send_sync(message, message.sync_partner)
+        else:
+            self.server.send_sync(message.sync_partner, message)
 
     def received_modeac(self, message, now):
         if message.address not in self.requested_modeac:
             return
 
-        self.server.send_mlat(message)
+        self.pending_mlat.append(message)
@@ -28,6 +28,7 @@ import socket
 import errno
 import json
 
+import _modes
 import mlat.client.version
 import mlat.client.net
 import mlat.profile
@@ -38,25 +39,11 @@ from mlat.client.stats import global_stats
 
 DEBUG = False
 
-# UDP protocol submessages
-
-TYPE_SYNC = 1
-TYPE_MLAT_SHORT = 2
-TYPE_MLAT_LONG = 3
-TYPE_SSYNC = 4
-TYPE_REBASE = 5
-TYPE_ABS_SYNC = 6
-
-STRUCT_HEADER = struct.Struct(">IHQ")
-STRUCT_SYNC = struct.Struct(">Bii14s14s")
-STRUCT_SSYNC = struct.Struct(">Bi14s")
-STRUCT_MLAT_SHORT = struct.Struct(">Bi7s")
-STRUCT_MLAT_LONG = struct.Struct(">Bi14s")
-STRUCT_REBASE = struct.Struct(">BQ")
-STRUCT_ABS_SYNC = struct.Struct(">BQQ14s14s")
-
 
 class UdpServerConnection:
+    """Sends mlat/sync messages to the server as UDP datagrams.
+    The datagrams themselves are built by _modes.UdpEncoder."""
+
     def __init__(self, host, port, key):
         self.host = host
         self.port = port
@@ -65,109 +52,42 @@ class UdpServerConnection:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.connect((host, port))
 
-        self.base_timestamp = None
-        self.header_timestamp = None
-        self.buf = bytearray(1500)
-        self.used = 0
-        self.seq = 0
-
-    def prepare_header(self, timestamp):
-        self.base_timestamp = timestamp
-        STRUCT_HEADER.pack_into(self.buf, 0,
-                                self.key, self.seq, self.base_timestamp)
-        self.used += STRUCT_HEADER.size
-
-    def rebase(self, timestamp):
-        self.base_timestamp = timestamp
-        STRUCT_REBASE.pack_into(self.buf, self.used,
-                                TYPE_REBASE,
-                                self.base_timestamp)
-        self.used += STRUCT_REBASE.size
+        self.encoder = _modes.UdpEncoder(key)
 
     def send_mlat(self, message):
-        if not self.used:
-            self.prepare_header(message.timestamp)
-
-        delta = message.timestamp - self.base_timestamp
-        if abs(delta) > 0x7FFFFFF0:
-            self.rebase(message.timestamp)
-            delta = 0
+        datagram = self.encoder.mlat(message)
+        if datagram:
+            self.send_datagram(datagram)
 
-        if len(message) == 7:
-            STRUCT_MLAT_SHORT.pack_into(self.buf, self.used,
-                                        TYPE_MLAT_SHORT,
-                                        delta, bytes(message))
-            self.used += STRUCT_MLAT_SHORT.size
-
-        else:
-            STRUCT_MLAT_LONG.pack_into(self.buf, self.used,
-                                       TYPE_MLAT_LONG,
-                                       delta, bytes(message))
-            self.used += STRUCT_MLAT_LONG.size
-
-        if self.used > 1400:
-            self.flush()
+    def send_many(self, messages):
+        for datagram in self.encoder.mlat_many(messages):
+            self.send_datagram(datagram)
 
     def send_sync(self, em, om):
-        if not self.used:
-            self.prepare_header(int((em.timestamp + om.timestamp) / 2))
-
-        if abs(em.timestamp - om.timestamp) > 0xFFFFFFF0:
-            # use abs sync
-            STRUCT_ABS_SYNC.pack_into(self.buf, self.used,
-                                      TYPE_ABS_SYNC,
-                                      em.timestamp, om.timestamp, bytes(em), bytes(om))
-            self.used += STRUCT_ABS_SYNC.size
-        else:
-            edelta = em.timestamp - self.base_timestamp
-            odelta = om.timestamp - self.base_timestamp
-            if abs(edelta) > 0x7FFFFFF0 or abs(odelta) > 0x7FFFFFF0:
-                self.rebase(int((em.timestamp + om.timestamp) / 2))
-                edelta = em.timestamp - self.base_timestamp
-                odelta = om.timestamp - self.base_timestamp
-
-            STRUCT_SYNC.pack_into(self.buf, self.used,
-                                  TYPE_SYNC,
-                                  edelta, odelta, bytes(em), bytes(om))
-            self.used += STRUCT_SYNC.size
-
-        if self.used > 1400:
-            self.flush()
+        datagram = self.encoder.sync(em, om)
+        if datagram:
+            self.send_datagram(datagram)
 
     def send_split_sync(self, m):
-        if not self.used:
-            self.prepare_header(m.timestamp)
-
-        delta = m.timestamp - self.base_timestamp
-        if abs(delta) > 0x7FFFFFF0:
-            self.rebase(m.timestamp)
-            delta = 0
-
-        STRUCT_SSYNC.pack_into(self.buf, self.used,
-                               TYPE_SSYNC,
-                               delta, bytes(m))
-        self.used += STRUCT_SSYNC.size
-
-        if self.used > 1400:
-            self.flush()
+        datagram = self.encoder.split_sync(m)
+        if datagram:
+            self.send_datagram(datagram)
 
     def flush(self):
-        if not self.used:
-            return
+        datagram = self.encoder.flush()
+        if datagram:
+            self.send_datagram(datagram)
 
+    def send_datagram(self, datagram):
         try:
-            self.sock.send(memoryview(self.buf)[0:self.used])
+            self.sock.send(datagram)
         except socket.error:
             pass
 
-        global_stats.server_udp_bytes += self.used
-
-        self.used = 0
-        self.base_timestamp = None
-        self.seq = (self.seq + 1) & 0xffff
+        global_stats.server_udp_bytes += len(datagram)
 
     def close(self):
-        self.used = 0
+        self.encoder.clear()
         self.sock.close()
 
     def __str__(self):
@@ -198,7 +118,7 @@ class JsonServerConnection(mlat.client.net.ReconnectingConnection):
     def reset_connection(self):
         self.readbuf = bytearray()
         self.writebuf = bytearray()
-        self.linebuf = []
+        self.linebuf = bytearray()  # complete lines waiting for fill_writebuf
         self.fill_writebuf = None
         self.handle_server_line = None
         self.server_heartbeat_at = None
@@ -235,19 +155,26 @@ class JsonServerConnection(mlat.client.net.ReconnectingConnection):
         if not self.linebuf:
             return
 
-        lines = '\n'.join(self.linebuf)
-        self.writebuf.extend(lines.encode('ascii'))
-        self.writebuf.extend(b'\n')
-        self.linebuf = []
+        self.writebuf.extend(self.linebuf)
+        del self.linebuf[:]
 
     def fill_zlib(self):
         if not self.linebuf:
             return
 
+        # compress up to 4k of whole lines at a time, so the packets stay
+        # under 64k and each packet carries only complete lines
         data = bytearray()
         pending = False
-        for line in self.linebuf:
-            data.extend(self.compressor.compress((line + '\n').encode('ascii')))
+        lines = memoryview(self.linebuf)
+        start = 0
+        while start < len(lines):
+            end = self.linebuf.rfind(b'\n', start, start + 4096) + 1
+            if end <= start:
+                # a single line longer than a slice
+                end = self.linebuf.find(b'\n', start + 4096) + 1 or len(lines)
+            data.extend(self.compressor.compress(lines[start:end]))
+            start = end
             pending = True
 
             if len(data) >= 32768:
@@ -257,6 +184,7 @@ class JsonServerConnection(mlat.client.net.ReconnectingConnection):
                 del data[-4:]
                 self.writebuf.extend(struct.pack('!H', len(data)))
                 self.writebuf.extend(data)
+                del data[:]
                 pending = False
 
         if pending:
@@ -267,33 +195,30 @@ class JsonServerConnection(mlat.client.net.ReconnectingConnection):
             self.writebuf.extend(struct.pack('!H', len(data)))
             self.writebuf.extend(data)
 
-        self.linebuf = []
+        lines.release()
+        del self.linebuf[:]
 
     def _send_json(self, o):
         if DEBUG:
             log('Send: {0}', o)
-        self.linebuf.append(json.dumps(o, separators=(',', ':')))
+        self.linebuf.extend(json.dumps(o, separators=(',', ':')).encode('ascii'))
+        self.linebuf.extend(b'\n')
 
     #
     # TCP transport
     #
 
     def send_tcp_mlat(self, message):
-        self.linebuf.append('{{"mlat":{{"t":{0},"m":"{1}"}}}}'.format(
-            message.timestamp,
-            str(message)))
+        _modes.append_json_mlat(self.linebuf, (message,))
+
+    def send_tcp_mlat_many(self, messages):
+        _modes.append_json_mlat(self.linebuf, messages)
 
     def send_tcp_sync(self, em, om):
-        self.linebuf.append('{{"sync":{{"et":{0},"em":"{1}","ot":{2},"om":"{3}"}}}}'.format(
-            em.timestamp,
-            str(em),
-            om.timestamp,
-            str(om)))
+        _modes.append_json_sync(self.linebuf, em, om)
 
     def send_tcp_split_sync(self, m):
-        self.linebuf.append('{{"ssync":{{"t":{0},"m":"{1}"}}}}'.format(
-            m.timestamp,
-            str(m)))
+        _modes.append_json_ssync(self.linebuf, m)
 
     def send_seen(self, aclist):
         self._send_json({'seen': ['{0:06x}'.format(icao) for icao in aclist]})
@@ -480,11 +405,13 @@ class JsonServerConnection(mlat.client.net.ReconnectingConnection):
             self.udp_transport = UdpServerConnection(host, port, key)
 
             self.send_mlat = self.udp_transport.send_mlat
+            self.send_mlat_many = self.udp_transport.send_many
             self.send_sync = self.udp_transport.send_sync
             self.send_split_sync = self.udp_transport.send_split_sync
         else:
             self.udp_transport = None
             self.send_mlat = self.send_tcp_mlat
+            self.send_mlat_many = self.send_tcp_mlat_many
             self.send_sync = self.send_tcp_sync
             self.send_split_sync = self.send_tcp_split_sync
 
@@ -96,6 +96,13 @@ def hostport(s):
     return (parts[0], int(parts[1]))
 
 
+def signal_level(s):
+    level = int(s)
+    if level < 0 or level > 255:
+        raise argparse.ArgumentTypeError("{} should be a signal level between 0 and 255".format(s))
+    return level
+
+
 def make_inputs_group(parser):
     inputs = parser.add_argument_group('Mode S receiver input connection')
     inputs.add_argument('--input-type',
@@ -107,6 +114,24 @@ def make_inputs_group(parser):
                         required=True,
                         type=hostport,
                         default=('localhost', 30005))
+    inputs.add_argument('--input-thread',
+                        help="Read and frame receiver data on a separate native thread "
+                        "(Beast-format input types only).",
+                        action='store_true',
+                        default=False)
+    inputs.add_argument('--input-capture',
+                        help="Append the raw receiver data, with arrival times, to this file "
+                        "(see tools/replay-capture.py).",
+                        default=None)
+    inputs.add_argument('--input-min-signal',
+                        help="Ignore Beast-format messages with a signal level (0-255) below this.",
+                        type=signal_level,
+                        metavar='LEVEL',
+                        default=None)
+    inputs.add_argument('--input-repair-crc',
+                        help="Correct single-bit errors in DF11 and DF17 messages instead of discarding them.",
+                        action='store_true',
+                        default=False)
 
 
 def clock_frequency(args):
@@ -198,4 +223,8 @@ def build_outputs(args):
 def build_receiver_connection(args):
     return ReceiverConnection(host=args.input_connect[0],
                               port=args.input_connect[1],
-                              mode=connection_mode(args))
+                              mode=connection_mode(args),
+                              threaded=args.input_thread,
+                              capture=args.input_capture,
+                              min_signal=args.input_min_signal,
+                              repair_crc=args.input_repair_crc)
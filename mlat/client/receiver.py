@@ -22,28 +22,67 @@ Handles receiving Mode S messages from receivers using various formats.
 
 import socket
 import errno
+import asyncore
 
 import _modes
 import mlat.profile
 from mlat.client.stats import global_stats
-from mlat.client.net import ReconnectingConnection
+from mlat.client.capture import CaptureWriter
+from mlat.client.net import LoggingMixin, ReconnectingConnection
 from mlat.client.util import log, monotonic_time
 
 
+class ThreadWakeup(LoggingMixin, asyncore.file_dispatcher):
+    """Watches a ReaderThread's wakeup descriptor and calls back into
+    the receiver connection when there are frames to drain."""
+
+    def __init__(self, thread, callback):
+        asyncore.file_dispatcher.__init__(self, thread.fileno())
+        self.callback = callback
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.callback()
+
+
 class ReceiverConnection(ReconnectingConnection):
     inactivity_timeout = 150.0
+    read_size = 16384
+    rxbuf_size = 65536
+    max_residual = 5120
 
-    def __init__(self, host, port, mode):
+    def __init__(self, host, port, mode, threaded=False, capture=None, min_signal=None, repair_crc=False):
         ReconnectingConnection.__init__(self, host, port)
         self.coordinator = None
         self.last_data_received = None
         self.mode = mode
+        self.min_signal = min_signal
+        self.repair_crc = repair_crc
+
+        # optionally append everything read from the receiver to a
+        # capture file, for replaying later
+        self.capture = CaptureWriter(capture) if capture else None
+
+        # optionally read and frame the input on a native thread;
+        # only Beast-style input is supported there, and the thread
+        # doesn't hand back the raw data for capturing
+        self.threaded = threaded and mode in (_modes.BEAST, _modes.RADARCAPE, _modes.RADARCAPE_EMULATED)
+        if threaded and not self.threaded:
+            log('Input thread is only supported for Beast-format input types, reading on the main thread')
+        if self.threaded and self.capture:
+            log('Input thread is not supported when capturing input, reading on the main thread')
+            self.threaded = False
+        self.reader_thread = None
+        self.thread_wakeup = None
+        self.thread_rx_bytes = 0
 
         # set up filters
 
         # this set gets put into specific_filter in
-        # multiple places, so we can just add an address
-        # to this set when we want mlat data.
+        # multiple places; the reader compiles a snapshot
+        # of it, so reinstall specific_filter after changing it.
         self.interested_mlat = set()
 
         self.default_filter = [False] * 32
@@ -53,24 +92,31 @@ class ReceiverConnection(ReconnectingConnection):
         for df in (0, 4, 5, 11, 16, 20, 21):
             self.specific_filter[df] = self.interested_mlat
 
-        # we want all DF17 messages so we can report position rates
-        # and distinguish ADS-B from Mode-S-only aircraft
-        self.default_filter[17] = True
+        # DF17 positions are tracked by the reader, which works out
+        # position rates and which aircraft have good ADS-B itself; it
+        # only passes on the positions that are useful as sync messages
+        # for the aircraft in this set.
+        self.sync_filter = set()
 
         self.modeac_filter = set()
 
         self.reset_connection()
 
-    def detect(self, data):
-        n, detected_mode = detect_data_format(data)
-        if detected_mode is not None:
+    def detect(self, buf, start=0, end=None):
+        if end is None:
+            end = len(buf)
+
+        # wait for a few frames in a row before believing the result; a
+        # single well-formed frame is easily found in random data
+        n, detected_mode, confidence = _modes.detect_format(memoryview(buf)[start:end])
+        if detected_mode is not None and confidence >= 3:
             log("Detected {mode} format input".format(mode=detected_mode))
             if detected_mode == _modes.AVR:
                 log("Input format is AVR with no timestamps. "
                     "This format does not contain enough information for multilateration. "
                     "Please enable mlat timestamps on your receiver.")
                 self.close()
-                return (0, (), False)
+                return (start, (), False)
 
             self.reader.mode = detected_mode
             self.feed = self.reader.feed
@@ -79,30 +125,41 @@ class ReceiverConnection(ReconnectingConnection):
             mode_change = (mode_change_event(self.reader), )
 
             try:
-                m, messages, pending_error = self.feed(data[n:])
+                m, messages, pending_error = self.feed(buf, start=start + n, end=end)
             except ValueError:
                 # return just the mode change and keep the error pending
-                return (n, mode_change, True)
+                return (start + n, mode_change, True)
 
             # put the mode change on the front of the message list
-            return (n + m, mode_change + messages, pending_error)
+            return (m, mode_change + messages, pending_error)
         else:
-            if len(data) > 512:
+            if end - start > 512:
                 raise ValueError('Unable to autodetect input message format')
-            return (0, (), False)
+            return (start, (), False)
 
     def reset_connection(self):
-        self.residual = None
+        self.stop_thread()
+
+        # receive buffer; data between rx_start and rx_end is
+        # waiting to be parsed
+        self.rxbuf = bytearray(self.rxbuf_size)
+        self.rx_start = self.rx_end = 0
         self.reader = _modes.Reader(self.mode)
         if self.mode is None:
             self.feed = self.detect
         else:
             self.feed = self.reader.feed
-        # configure filter, seen-tracking
-        self.reader.seen = set()
-        self.reader.default_filter = self.default_filter
-        self.reader.specific_filter = self.specific_filter
-        self.reader.modeac_filter = self.modeac_filter
+        # configure filter, seen-tracking, ADS-B position tracking,
+        # and dropping repeated copies of a frame (same data and timestamp)
+        self.reader.track_seen = True
+        self.reader.track_adsb = True
+        self.reader.suppress_duplicates = True
+        self.reader.min_signal = self.min_signal
+        self.reader.repair_crc = self.repair_crc
+        self.reader.set_filter(default_filter=self.default_filter,
+                               specific_filter=self.specific_filter,
+                               modeac_filter=self.modeac_filter,
+                               sync_filter=self.sync_filter)
 
     def start_connection(self):
         log('Input connected to {0}:{1}', self.host, self.port)
@@ -110,12 +167,38 @@ class ReceiverConnection(ReconnectingConnection):
         self.state = 'connected'
         self.coordinator.input_connected()
 
+        if self.capture:
+            self.capture.new_connection()
+
         # synthesize a mode change immediately if we are not autodetecting
         if self.reader.mode is not None:
             self.coordinator.input_received_messages((mode_change_event(self.reader),))
 
         self.send_settings_message()
 
+        if self.threaded:
+            self.reader_thread = _modes.ReaderThread(self.socket)
+            self.thread_rx_bytes = 0
+            self.thread_wakeup = ThreadWakeup(self.reader_thread, self.handle_thread_read)
+            self.reader_thread.start()
+
+    def stop_thread(self):
+        if self.reader_thread is not None:
+            self.reader_thread.stop()
+            self.reader_thread = None
+        if self.thread_wakeup is not None:
+            self.thread_wakeup.close()
+            self.thread_wakeup = None
+
+    def close(self, manual_close=False):
+        # the thread must stop using the socket before it is closed
+        self.stop_thread()
+        ReconnectingConnection.close(self, manual_close)
+
+    def readable(self):
+        # when the reader thread is running, it does all the reading
+        return self.reader_thread is None
+
     def send_settings_message(self):
         # if we are connected to something that is Beast-like (or autodetecting), send a beast settings message
         if self.state != 'connected':
@@ -134,6 +217,8 @@ class ReceiverConnection(ReconnectingConnection):
         self.send(settings_message)
 
     def lost_connection(self):
+        if self.capture:
+            self.capture.flush()
         self.coordinator.input_disconnected()
 
     def heartbeat(self, now):
@@ -145,21 +230,37 @@ class ReceiverConnection(ReconnectingConnection):
             self.reconnect()
 
     def recent_aircraft(self):
-        """Return the set of aircraft seen from the receiver since the
-        last call to recent_aircraft(). This includes aircraft where no
-        messages were forwarded due to filtering."""
-        recent = set(self.reader.seen)
-        self.reader.seen.clear()
-        return recent
+        """Return the aircraft seen from the receiver since the last call
+        to recent_aircraft(), as (address, message count, DF bitmask)
+        tuples. This includes aircraft where no messages were forwarded
+        due to filtering."""
+        seen = self.reader.take_seen()
+        return zip(seen['address'], seen['count'], seen['df_mask'])
+
+    def recent_positions(self):
+        """Return the ADS-B position state of the aircraft tracked by the
+        receiver, as (address, positions, even age, odd age) tuples.
+        positions is the number of usable positions since the last call;
+        the ages are the times in seconds since the last usable even and
+        odd positions (infinite if there has not been one)."""
+        adsb = self.reader.take_adsb()
+        return zip(adsb['address'], adsb['positions'], adsb['even_age'], adsb['odd_age'])
 
     def update_filter(self, wanted_mlat):
         """Update the receiver filters so we receive mlat-relevant messages
         (basically, anything that's not DF17) for the given addresses only."""
-        # do this in place, because self.interested_mlat is referenced
-        # from the filters installed on the reader; updating the set in
-        # place automatically updates all the DF-specific filters.
+        # self.interested_mlat is shared by all the DF-specific filters;
+        # update it in place, then recompile the reader's copy.
         self.interested_mlat.clear()
         self.interested_mlat.update(wanted_mlat)
+        self.reader.set_filter(specific_filter=self.specific_filter)
+
+    def update_sync_filter(self, wanted_sync):
+        """Update the receiver filters so we receive DF17 sync messages
+        for the given addresses only."""
+        self.sync_filter.clear()
+        self.sync_filter.update(wanted_sync)
+        self.reader.set_filter(sync_filter=self.sync_filter)
 
     def update_modeac_filter(self, wanted_modeac):
         """Update the receiver filters so that we receive mode A/C messages
@@ -168,47 +269,57 @@ class ReceiverConnection(ReconnectingConnection):
         changed = (self.modeac_filter and not wanted_modeac) or (not self.modeac_filter and wanted_modeac)
         self.modeac_filter.clear()
         self.modeac_filter.update(wanted_modeac)
+        self.reader.set_filter(modeac_filter=self.modeac_filter)
         if changed:
             self.send_settings_message()
 
     @mlat.profile.trackcpu
     def handle_read(self):
+        if len(self.rxbuf) - self.rx_end < self.read_size:
+            # not enough room left at the end of the buffer,
+            # move the (small) unparsed residual to the front
+            residual = self.rx_end - self.rx_start
+            self.rxbuf[0:residual] = self.rxbuf[self.rx_start:self.rx_end]
+            self.rx_start = 0
+            self.rx_end = residual
+
         try:
-            moredata = self.recv(16384)
+            nbytes = self.socket.recv_into(memoryview(self.rxbuf)[self.rx_end:self.rx_end + self.read_size])
         except socket.error as e:
             if e.errno == errno.EAGAIN:
                 return
             raise
 
-        if not moredata:
+        if not nbytes:
             self.close()
             return
 
-        global_stats.receiver_rx_bytes += len(moredata)
+        if self.capture:
+            self.capture.write(memoryview(self.rxbuf)[self.rx_end:self.rx_end + nbytes])
 
-        if self.residual:
-            moredata = self.residual + moredata
+        global_stats.receiver_rx_bytes += nbytes
+        self.rx_end += nbytes
 
         self.last_data_received = monotonic_time()
 
         try:
-            consumed, messages, pending_error = self.feed(moredata)
+            self.rx_start, messages, pending_error = self.feed(self.rxbuf, start=self.rx_start, end=self.rx_end)
         except ValueError as e:
             log("Parsing receiver data failed: {e}", e=str(e))
+            self.collect_reader_stats()
             self.close()
             return
 
-        if consumed < len(moredata):
-            self.residual = moredata[consumed:]
-            if len(self.residual) > 5120:
-                raise RuntimeError('parser broken - buffer not being consumed')
-        else:
-            self.residual = None
+        if self.state != 'connected':
+            # the input was closed while parsing it (e.g. unusable input format)
+            return
+
+        if self.rx_start == self.rx_end:
+            self.rx_start = self.rx_end = 0
+        elif self.rx_end - self.rx_start > self.max_residual:
+            raise RuntimeError('parser broken - buffer not being consumed')
 
-        global_stats.receiver_rx_messages += self.reader.received_messages
-        global_stats.receiver_rx_filtered += self.reader.suppressed_messages
-        global_stats.receiver_rx_mlat     += self.reader.mlat_messages
-        self.reader.received_messages = self.reader.suppressed_messages = self.reader.mlat_messages = 0
+        self.collect_reader_stats()
 
         if messages:
             self.coordinator.input_received_messages(messages)
@@ -217,70 +328,65 @@ class ReceiverConnection(ReconnectingConnection):
             # call it again to get the exception
             # now that we've handled all the messages
             try:
-                if self.residual is None:
-                    self.feed(b'')
-                else:
-                    self.feed(self.residual)
+                self.feed(self.rxbuf, start=self.rx_start, end=self.rx_end)
             except ValueError as e:
                 log("Parsing receiver data failed: {e}", e=str(e))
+                self.collect_reader_stats()
                 self.close()
                 return
 
+    @mlat.profile.trackcpu
+    def handle_thread_read(self):
+        while True:
+            try:
+                frames, messages, pending_error = self.reader.drain(self.reader_thread)
+            except EOFError:
+                self.close()
+                return
+            except ValueError as e:
+                log("Parsing receiver data failed: {e}", e=str(e))
+                self.collect_reader_stats()
+                self.close()
+                return
+            except OSError as e:
+                log('Connection to {host}:{port} lost: {ex!s}', host=self.host, port=self.port, ex=e)
+                self.close()
+                return
 
-def mode_change_event(reader):
-    return _modes.EventMessage(_modes.DF_EVENT_MODE_CHANGE, 0, {
-        "mode": reader.mode,
-        "frequency": reader.frequency,
-        "epoch": reader.epoch})
-
+            rx_bytes = self.reader_thread.received_bytes
+            if rx_bytes != self.thread_rx_bytes:
+                global_stats.receiver_rx_bytes += rx_bytes - self.thread_rx_bytes
+                self.thread_rx_bytes = rx_bytes
+                self.last_data_received = monotonic_time()
 
-def detect_data_format(data):
-    """Try to work out what sort of data format this is.
+            self.collect_reader_stats()
 
-    Returns (offset, mode) where offset is the byte offset
-    to start at and mode is the decoder mode to use,
-    or None if detection failed."""
+            if messages:
+                self.coordinator.input_received_messages(messages)
 
-    for i in range(len(data)-4):
-        mode = None
+            if not pending_error:
+                return
 
-        if data[i] != b'\x1a' and data[i+1:i+3] in (b'\x1a1', b'\x1a2', b'\x1a3', b'\x1a4'):
-            mode = _modes.BEAST
-            offset = 1
+            # go round again to get the exception
+            # now that we've handled all the messages
 
-        elif data[i:i+4] == b'\x10\0x03\x10\0x02':
-            mode = _modes.SBS
-            offset = 2
+    def collect_reader_stats(self):
+        stats = self.reader.stats(reset=True)
+        global_stats.receiver_rx_messages += stats['received']
+        global_stats.receiver_rx_filtered += stats['suppressed']
+        global_stats.receiver_rx_mlat += stats['dropped']['mlat']
+        global_stats.receiver_rx_outliers += stats['timestamp_outliers']
+        global_stats.receiver_rx_jumps += stats['timestamp_jumps']
+        global_stats.receiver_rx_duplicates += stats['dropped']['duplicate']
+        global_stats.receiver_rx_weak += stats['dropped']['weak']
+        global_stats.receiver_rx_repaired += stats['repaired']
+        global_stats.receiver_rx_sync_losses += stats['sync_losses']
+        global_stats.receiver_parse_time += stats['parse_time']
+        global_stats.add_signal_histogram(self.reader.take_signal_histogram())
 
-        else:
-            if data[i:i+3] in (b';\n\r', b';\r\n'):
-                avr_prefix = 3
-            elif data[i:i+2] in (b';\n', b';\r'):
-                avr_prefix = 2
-            else:
-                avr_prefix = None
-
-            if avr_prefix:
-                firstbyte = data[i + avr_prefix]
-                if firstbyte in (ord('@'), ord('%'), ord('<')):
-                    mode = _modes.AVRMLAT
-                    offset = avr_prefix
-                elif firstbyte in (ord('*'), ord('.')):
-                    mode = _modes.AVR
-                    offset = avr_prefix
-
-        if mode:
-            reader = _modes.Reader(mode)
-            # don't actually want any data, just parse it
-            reader.want_events = False
-            reader.default_filter = [False] * 32
-            try:
-                n, _, pending_error = reader.feed(data[i + offset:])
-                if n > 0 and not pending_error:
-                    # consumed some data without problems
-                    return (i + offset, mode)
-            except ValueError:
-                # parse error, ignore it
-                pass
 
-    return (0, None)
+def mode_change_event(reader):
+    return _modes.EventMessage(_modes.DF_EVENT_MODE_CHANGE, 0, {
+        "mode": reader.mode,
+        "frequency": reader.frequency,
+        "epoch": reader.epoch})
@@ -38,8 +38,30 @@ class Stats:
         self.receiver_rx_messages = 0
         self.receiver_rx_filtered = 0
         self.receiver_rx_mlat = 0
+        self.receiver_rx_outliers = 0
+        self.receiver_rx_jumps = 0
+        self.receiver_rx_duplicates = 0
+        self.receiver_rx_weak = 0
+        self.receiver_rx_repaired = 0
+        self.receiver_rx_sync_losses = 0
+        self.receiver_parse_time = 0.0
+        self.receiver_rx_signal = [0] * 256
         self.mlat_positions = 0
 
+    def add_signal_histogram(self, histogram):
+        self.receiver_rx_signal = [a + b for a, b in zip(self.receiver_rx_signal, histogram)]
+
+    def signal_percentile(self, fraction):
+        """Return the signal level at a given fraction (0..1) of the way through
+        the received messages, weakest first."""
+        target = fraction * sum(self.receiver_rx_signal)
+        total = 0
+        for level, count in enumerate(self.receiver_rx_signal):
+            total += count
+            if total > target:
+                return level
+        return 255
+
     def log_and_reset(self, coordinator):
         now = monotonic_time()
         elapsed = now - self.start
@@ -58,6 +80,24 @@ class Stats:
         if self.receiver_rx_mlat:
             log('WARNING: Ignored {0:5d} messages with MLAT magic timestamp (do you have --forward-mlat on?)',
                 self.receiver_rx_mlat)
+        if self.receiver_rx_outliers:
+            log('WARNING: {0:5d} messages with out of range timestamps, {1:d} timestamp jumps',
+                self.receiver_rx_outliers, self.receiver_rx_jumps)
+        if self.receiver_rx_duplicates:
+            log('Dropped  {0:5d} repeated copies of messages', self.receiver_rx_duplicates)
+        if self.receiver_rx_repaired:
+            log('Repaired {0:5d} messages with a single-bit error ({1:.1f} msg/s)',
+                self.receiver_rx_repaired,
+                self.receiver_rx_repaired / elapsed)
+        if any(self.receiver_rx_signal):
+            log('Signal:   levels {0:d} / {1:d} / {2:d} (10th / 50th / 90th percentile), {3:d} weak messages ignored',
+                self.signal_percentile(0.1),
+                self.signal_percentile(0.5),
+                self.signal_percentile(0.9),
+                self.receiver_rx_weak)
+        if self.receiver_rx_sync_losses:
+            log('WARNING: Lost sync with the receiver data {0:d} times', self.receiver_rx_sync_losses)
+        log('Decoder:  {0:6.1f}% of the time spent decoding', 100.0 * self.receiver_parse_time / elapsed)
         log('Server:   {0:10s} {1:6.1f} kB/s from server   {2:6.1f} kB/s to server',
             coordinator.server.state,
             self.server_rx_bytes / elapsed / 1000.0,
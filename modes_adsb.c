@@ -0,0 +1,272 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+/********** ADS-B POSITION TRACKER ****************/
+
+/*
+ * Most DF17 traffic is only interesting to the client in aggregate: how
+ * often each aircraft reports a usable position, and whether it has done
+ * so recently. Only a small fraction of the frames (usable positions from
+ * aircraft the server wants sync data for) need to reach Python.
+ *
+ * When Reader.track_adsb is set, the reader keeps that per-aircraft state
+ * here and only returns the DF17 frames that are sync candidates. The
+ * state is collected periodically via Reader.take_adsb().
+ */
+
+/* an aircraft needs this many DF17 frames before its positions are used */
+#define ADSB_MIN_MESSAGES 10
+/* minimum NUCp for a usable position */
+#define ADSB_MIN_NUC 6
+/* forget aircraft with no DF17 frames for this long (ms) */
+#define ADSB_EXPIRY 120000
+
+void modesadsb_init(modesadsb *adsb)
+{
+    memset(adsb, 0, sizeof(*adsb));
+}
+
+void modesadsb_free(modesadsb *adsb)
+{
+    free(adsb->entries);
+    free(adsb->index);
+    modesadsb_init(adsb);
+}
+
+static inline uint32_t adsb_hash(modesadsb *adsb, uint32_t address)
+{
+    return (uint32_t)(address * 2654435761U) >> adsb->shift;
+}
+
+/* (re)build the hash index with room for at least 2*n_entries entries */
+static int adsb_reindex(modesadsb *adsb)
+{
+    int32_t *index;
+    uint32_t i, j, size;
+    int bits;
+
+    for (bits = 7, size = 128; size < adsb->n_entries * 2; ++bits, size <<= 1)
+        ;
+
+    if (! (index = malloc(size * sizeof(int32_t)))) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for (i = 0; i < size; ++i)
+        index[i] = -1;
+
+    free(adsb->index);
+    adsb->index = index;
+    adsb->mask = size - 1;
+    adsb->shift = 32 - bits;
+
+    for (i = 0; i < adsb->n_entries; ++i) {
+        for (j = adsb_hash(adsb, adsb->entries[i].address); index[j] >= 0; j = (j + 1) & adsb->mask)
+            ;
+        index[j] = (int32_t)i;
+    }
+
+    return 0;
+}
+
+/* find the entry for an address, creating it if needed; NULL (with an exception set) on error */
+static modesadsbentry *adsb_lookup(modesadsb *adsb, uint32_t address)
+{
+    modesadsbentry *entry;
+    uint32_t i;
+
+    if (adsb->index) {
+        for (i = adsb_hash(adsb, address); adsb->index[i] >= 0; i = (i + 1) & adsb->mask) {
+            entry = &adsb->entries[adsb->index[i]];
+            if (entry->address == address)
+                return entry;
+        }
+    }
+
+    /* new aircraft */
+    if (adsb->n_entries == adsb->allocated) {
+        uint32_t allocated = (adsb->allocated ? adsb->allocated * 2 : 64);
+        modesadsbentry *entries = realloc(adsb->entries, allocated * sizeof(modesadsbentry));
+        if (!entries) {
+            PyErr_NoMemory();
+            return NULL;
+        }
+
+        adsb->entries = entries;
+        adsb->allocated = allocated;
+    }
+
+    entry = &adsb->entries[adsb->n_entries++];
+    memset(entry, 0, sizeof(*entry));
+    entry->address = address;
+
+    /* keep the index load factor at or below 50% */
+    if (adsb->n_entries * 2 > adsb->mask + 1 || !adsb->index) {
+        if (adsb_reindex(adsb) < 0) {
+            --adsb->n_entries;
+            return NULL;
+        }
+    } else {
+        for (i = adsb_hash(adsb, address); adsb->index[i] >= 0; i = (i + 1) & adsb->mask)
+            ;
+        adsb->index[i] = (int32_t)(adsb->n_entries - 1);
+    }
+
+    return entry;
+}
+
+/* process one valid DF17 frame.
+ *
+ * pair_window is the largest allowed timestamp difference between the
+ * latest even and odd positions; now is the current monotonic time in ms.
+ *
+ * returns 1 if the frame is a usable position (an even/odd pair is
+ * available, with altitude and a good enough NUCp), 0 if it is not, or -1
+ * (with an exception set) on error. On success, *entry points at the
+ * aircraft's state, which remains valid until the tracker is next modified.
+ */
+int modesadsb_update(modesadsb *adsb, modesfields *fields, unsigned long long timestamp, unsigned signal, uint8_t *data,
+                     unsigned long long pair_window, unsigned long long now, modesadsbentry **entry)
+{
+    modesadsbentry *ac;
+    unsigned long long other;
+    int half;
+
+    if (! (ac = adsb_lookup(adsb, fields->address)))
+        return -1;
+
+    *entry = ac;
+    ++ac->messages;
+    ac->last_seen = now;
+
+    if (ac->messages < ADSB_MIN_MESSAGES)
+        return 0;   /* wait for more messages */
+
+    if (!fields->even_cpr && !fields->odd_cpr)
+        return 0;   /* not a position message */
+
+    half = (fields->odd_cpr ? 1 : 0);
+    ac->has_cpr[half] = 1;
+    ac->cpr_timestamp[half] = timestamp;
+    ac->cpr_signal[half] = signal;
+    memcpy(ac->cpr_data[half], data, 14);
+
+    if (!ac->has_cpr[!half])
+        return 0;
+
+    other = ac->cpr_timestamp[!half];
+    if ((timestamp > other ? timestamp - other : other - timestamp) > pair_window)
+        return 0;
+
+    if (!fields->has_altitude)
+        return 0;   /* need an altitude */
+
+    if (fields->nuc < ADSB_MIN_NUC)
+        return 0;
+
+    ++ac->positions;
+    ac->last_good[half] = now;
+    return 1;
+}
+
+/* wrap a bytearray in a memoryview with the given format, stealing the reference to the bytearray */
+static PyObject *make_column(PyObject *array, const char *format)
+{
+    PyObject *view, *cast;
+
+    if (!array)
+        return NULL;
+
+    view = PyMemoryView_FromObject(array);
+    Py_DECREF(array);
+    if (!view)
+        return NULL;
+
+    cast = PyObject_CallMethod(view, "cast", "s", format);
+    Py_DECREF(view);
+    return cast;
+}
+
+/* seconds since a monotonic ms time, or infinity if it never happened */
+static double age(unsigned long long then, unsigned long long now)
+{
+    if (!then)
+        return Py_HUGE_VAL;
+    return (now > then ? (now - then) / 1000.0 : 0.0);
+}
+
+/* return the state of all tracked aircraft as a dict of typed memoryviews
+ * (address, positions, even_age, odd_age), reset the position counts, and
+ * forget aircraft that have not been heard from for a while
+ */
+PyObject *modesadsb_take(modesadsb *adsb, unsigned long long now)
+{
+    PyObject *columns = NULL, *address = NULL, *positions = NULL, *even_age = NULL, *odd_age = NULL;
+    uint32_t i, kept;
+
+    /* expire old aircraft first, so they are not reported */
+    for (i = kept = 0; i < adsb->n_entries; ++i) {
+        if (now - adsb->entries[i].last_seen > ADSB_EXPIRY)
+            continue;
+        if (i != kept)
+            adsb->entries[kept] = adsb->entries[i];
+        ++kept;
+    }
+
+    if (kept != adsb->n_entries) {
+        adsb->n_entries = kept;
+        if (adsb_reindex(adsb) < 0)
+            return NULL;
+    }
+
+    if (! (address = make_column(PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)kept * sizeof(uint32_t)), "I")))
+        goto err;
+    if (! (positions = make_column(PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)kept * sizeof(uint32_t)), "I")))
+        goto err;
+    if (! (even_age = make_column(PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)kept * sizeof(double)), "d")))
+        goto err;
+    if (! (odd_age = make_column(PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)kept * sizeof(double)), "d")))
+        goto err;
+
+    /* the views were made from fresh bytearrays, so we can write through them directly */
+    for (i = 0; i < kept; ++i) {
+        modesadsbentry *ac = &adsb->entries[i];
+        ((uint32_t*)PyMemoryView_GET_BUFFER(address)->buf)[i] = ac->address;
+        ((uint32_t*)PyMemoryView_GET_BUFFER(positions)->buf)[i] = ac->positions;
+        ((double*)PyMemoryView_GET_BUFFER(even_age)->buf)[i] = age(ac->last_good[0], now);
+        ((double*)PyMemoryView_GET_BUFFER(odd_age)->buf)[i] = age(ac->last_good[1], now);
+        ac->positions = 0;
+    }
+
+    columns = Py_BuildValue("{s:N,s:N,s:N,s:N}",
+                            "address", address,
+                            "positions", positions,
+                            "even_age", even_age,
+                            "odd_age", odd_age);
+    return columns;
+
+ err:
+    Py_XDECREF(address);
+    Py_XDECREF(positions);
+    Py_XDECREF(even_age);
+    Py_XDECREF(odd_age);
+    return NULL;
+}
@@ -0,0 +1,312 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+#include <marshal.h>
+
+/********** MESSAGE BATCHES ****************/
+
+/*
+ * pack_batch() / unpack_batch() move lists of Messages between processes
+ * (over a pipe, or through shared memory) as one flat buffer. Messages
+ * can't be pickled, and building them back from bytes one at a time from
+ * Python is slow.
+ *
+ * A batch is a header followed by fixed-size records and then a side
+ * table holding the event data of any event messages. All integers are
+ * little-endian.
+ *
+ * Header:
+ *   0  magic "MSB1"
+ *   4  u32 total length of the batch in bytes
+ *   8  u32 number of messages in the batch
+ *  12  u32 number of records (messages, then the sync partners of DF17 messages)
+ *  16  u32 length of the side table
+ *
+ * Record:
+ *   0  u64 timestamp
+ *   8  u32 signal
+ *  12  u32 for events, index into the side table;
+ *          for messages with a sync partner, index of the partner's record;
+ *          otherwise 0xFFFFFFFF
+ *  16  u8  DF (event type, for events)
+ *  17  u8  data length
+ *  18  u8  flags: event, has a partner, had a bit error corrected
+ *  19  u8  (unused)
+ *  20  data, up to 14 bytes
+ *
+ * The side table is the marshalled list of event data objects.
+ * Messages are decoded again from their data when unpacked.
+ */
+
+#define BATCH_MAGIC "MSB1"
+#define BATCH_HEADER_SIZE 20
+#define BATCH_RECORD_SIZE 36
+#define BATCH_MAX_DATA 14
+#define BATCH_NO_INDEX 0xFFFFFFFFU
+
+#define BATCH_FLAG_EVENT 1
+#define BATCH_FLAG_PARTNER 2
+#define BATCH_FLAG_REPAIRED 4
+
+static void put_u32(uint8_t *p, uint32_t v)
+{
+    p[0] = v; p[1] = v >> 8; p[2] = v >> 16; p[3] = v >> 24;
+}
+
+static void put_u64(uint8_t *p, uint64_t v)
+{
+    put_u32(p, (uint32_t) v);
+    put_u32(p + 4, (uint32_t) (v >> 32));
+}
+
+static uint32_t get_u32(const uint8_t *p)
+{
+    return p[0] | (p[1] << 8) | (p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+static uint64_t get_u64(const uint8_t *p)
+{
+    return get_u32(p) | ((uint64_t)get_u32(p + 4) << 32);
+}
+
+/* write one record for a message; aux is the side table or partner index */
+static int pack_record(uint8_t *r, modesmessage *message, uint32_t aux, uint8_t flags)
+{
+    if (message->data && message->datalen > BATCH_MAX_DATA) {
+        PyErr_Format(PyExc_ValueError, "can't pack a %d-byte message", message->datalen);
+        return -1;
+    }
+
+    memset(r, 0, BATCH_RECORD_SIZE);
+    put_u64(r, message->timestamp);
+    put_u32(r + 8, message->signal);
+    put_u32(r + 12, aux);
+    r[16] = message->df;
+    r[18] = flags | (message->repaired ? BATCH_FLAG_REPAIRED : 0);
+    if (message->data) {
+        r[17] = message->datalen;
+        memcpy(r + 20, message->data, message->datalen);
+    }
+
+    return 0;
+}
+
+/* pack_batch(messages): pack a sequence of Messages (including event messages) into bytes */
+PyObject *modesbatch_pack(PyObject *self, PyObject *args)
+{
+    PyObject *messages, *seq = NULL, *events = NULL, *side = NULL, *batch = NULL;
+    PyObject **items;
+    Py_ssize_t n, i, n_records, side_len, total;
+    uint32_t partner_index, event_index = 0;
+    uint8_t *p;
+
+    if (!PyArg_ParseTuple(args, "O", &messages))
+        return NULL;
+
+    if (! (seq = PySequence_Fast(messages, "expected a sequence of messages")))
+        return NULL;
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    items = PySequence_Fast_ITEMS(seq);
+
+    /* count the records and collect the event data */
+    if (! (events = PyList_New(0)))
+        goto err;
+
+    n_records = n;
+    for (i = 0; i < n; ++i) {
+        modesmessage *message;
+
+        if (!modesmessage_check(items[i])) {
+            PyErr_SetString(PyExc_TypeError, "expected a Message");
+            goto err;
+        }
+
+        message = (modesmessage *)items[i];
+        if (!message->data) {
+            if (PyList_Append(events, message->eventdata ? message->eventdata : Py_None) < 0)
+                goto err;
+        } else if (message->partner) {
+            ++n_records;
+        }
+    }
+
+    if (PyList_GET_SIZE(events) > 0) {
+        if (! (side = PyMarshal_WriteObjectToString(events, Py_MARSHAL_VERSION)))
+            goto err;
+        side_len = PyBytes_GET_SIZE(side);
+    } else {
+        side_len = 0;
+    }
+
+    total = BATCH_HEADER_SIZE + n_records * BATCH_RECORD_SIZE + side_len;
+    if (total > 0xFFFFFFFFLL) {
+        PyErr_SetString(PyExc_ValueError, "batch too large");
+        goto err;
+    }
+
+    if (! (batch = PyBytes_FromStringAndSize(NULL, total)))
+        goto err;
+
+    p = (uint8_t *) PyBytes_AS_STRING(batch);
+    memcpy(p, BATCH_MAGIC, 4);
+    put_u32(p + 4, (uint32_t) total);
+    put_u32(p + 8, (uint32_t) n);
+    put_u32(p + 12, (uint32_t) n_records);
+    put_u32(p + 16, (uint32_t) side_len);
+
+    /* the messages themselves, then their partners */
+    partner_index = (uint32_t) n;
+    for (i = 0; i < n; ++i) {
+        modesmessage *message = (modesmessage *)items[i];
+        uint8_t *r = p + BATCH_HEADER_SIZE + i * BATCH_RECORD_SIZE;
+
+        if (!message->data) {
+            if (pack_record(r, message, event_index++, BATCH_FLAG_EVENT) < 0)
+                goto err;
+        } else if (message->partner) {
+            uint8_t *pr = p + BATCH_HEADER_SIZE + partner_index * BATCH_RECORD_SIZE;
+            if (pack_record(r, message, partner_index, BATCH_FLAG_PARTNER) < 0)
+                goto err;
+            if (pack_record(pr, (modesmessage *)message->partner, BATCH_NO_INDEX, 0) < 0)
+                goto err;
+            ++partner_index;
+        } else {
+            if (pack_record(r, message, BATCH_NO_INDEX, 0) < 0)
+                goto err;
+        }
+    }
+
+    if (side_len)
+        memcpy(p + BATCH_HEADER_SIZE + n_records * BATCH_RECORD_SIZE, PyBytes_AS_STRING(side), side_len);
+
+    Py_DECREF(seq);
+    Py_DECREF(events);
+    Py_XDECREF(side);
+    return batch;
+
+ err:
+    Py_XDECREF(seq);
+    Py_XDECREF(events);
+    Py_XDECREF(side);
+    Py_XDECREF(batch);
+    return NULL;
+}
+
+/* build the message for one record; events take their data from the side table */
+static PyObject *unpack_record(const uint8_t *r, PyObject *events)
+{
+    unsigned long long timestamp = get_u64(r);
+    unsigned signal = get_u32(r + 8);
+    uint32_t aux = get_u32(r + 12);
+    PyObject *eventdata, *message;
+
+    if (r[18] & BATCH_FLAG_EVENT) {
+        if (!events || aux >= (uint32_t) PyList_GET_SIZE(events)) {
+            PyErr_SetString(PyExc_ValueError, "bad event index in batch");
+            return NULL;
+        }
+
+        eventdata = PyList_GET_ITEM(events, aux);
+        Py_INCREF(eventdata);
+        return modesmessage_new_eventmessage(r[16], timestamp, eventdata);
+    }
+
+    if (r[17] > BATCH_MAX_DATA) {
+        PyErr_SetString(PyExc_ValueError, "bad data length in batch");
+        return NULL;
+    }
+
+    message = modesmessage_from_buffer(timestamp, signal, (uint8_t *) r + 20, r[17]);
+    if (message && (r[18] & BATCH_FLAG_REPAIRED))
+        ((modesmessage *)message)->repaired = 1;
+    return message;
+}
+
+/* unpack_batch(buffer): return the list of Messages packed by pack_batch() */
+PyObject *modesbatch_unpack(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    PyObject *list = NULL, *events = NULL;
+    const uint8_t *p, *records;
+    uint32_t total, n, n_records, side_len, i;
+
+    if (!PyArg_ParseTuple(args, "y*", &buffer))
+        return NULL;
+
+    p = buffer.buf;
+    if (buffer.len < BATCH_HEADER_SIZE || memcmp(p, BATCH_MAGIC, 4) != 0) {
+        PyErr_SetString(PyExc_ValueError, "not a message batch");
+        goto err;
+    }
+
+    total = get_u32(p + 4);
+    n = get_u32(p + 8);
+    n_records = get_u32(p + 12);
+    side_len = get_u32(p + 16);
+    if (n > n_records ||
+        total != BATCH_HEADER_SIZE + (uint64_t)n_records * BATCH_RECORD_SIZE + side_len ||
+        total > buffer.len) {
+        PyErr_SetString(PyExc_ValueError, "truncated or corrupt message batch");
+        goto err;
+    }
+
+    records = p + BATCH_HEADER_SIZE;
+    if (side_len) {
+        events = PyMarshal_ReadObjectFromString((const char *) records + (Py_ssize_t)n_records * BATCH_RECORD_SIZE, side_len);
+        if (!events)
+            goto err;
+        if (!PyList_Check(events)) {
+            PyErr_SetString(PyExc_ValueError, "corrupt event table in message batch");
+            goto err;
+        }
+    }
+
+    if (! (list = PyList_New(n)))
+        goto err;
+
+    for (i = 0; i < n; ++i) {
+        const uint8_t *r = records + (Py_ssize_t)i * BATCH_RECORD_SIZE;
+        PyObject *message = unpack_record(r, events);
+        if (!message)
+            goto err;
+        PyList_SET_ITEM(list, i, message);
+
+        if (r[18] & BATCH_FLAG_PARTNER) {
+            uint32_t partner = get_u32(r + 12);
+            if (partner < n || partner >= n_records) {
+                PyErr_SetString(PyExc_ValueError, "bad partner index in batch");
+                goto err;
+            }
+            if (! (((modesmessage *)message)->partner = unpack_record(records + (Py_ssize_t)partner * BATCH_RECORD_SIZE, events)))
+                goto err;
+        }
+    }
+
+    Py_XDECREF(events);
+    PyBuffer_Release(&buffer);
+    return list;
+
+ err:
+    Py_XDECREF(list);
+    Py_XDECREF(events);
+    PyBuffer_Release(&buffer);
+    return NULL;
+}
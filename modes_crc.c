@@ -27,6 +27,87 @@
 /* CRC values for all single-byte messages; used to speed up CRC calculation. */
 static uint32_t crc_table[256];
 
+/* Slicing tables: crc_slice[k][i] is the CRC of the byte i followed by k zero
+ * bytes (so crc_slice[0] is crc_table). The CRC is linear, so the CRC of
+ * several bytes after some remainder is the XOR of one lookup per byte; the
+ * lookups are independent of each other, unlike the byte-at-a-time loop
+ * where each lookup needs the result of the one before. Mode S bodies are
+ * 4 bytes (one 4-byte slice) or 11 bytes (an 8-byte slice and 3 single bytes).
+ */
+#define CRC_SLICES 8
+static uint32_t crc_slice[CRC_SLICES][256];
+
+/* Syndromes of single-bit errors: the CRC residual of a frame that is all
+ * zeros except for one bit. The residual of a damaged frame is the residual
+ * of the undamaged frame XOR the syndrome of the error, so a frame that
+ * should have a zero residual and has a residual found here has (most
+ * likely) a single-bit error at that position.
+ *
+ * One open-addressed table per frame length, keyed by syndrome.
+ */
+#define SYNDROME_SLOTS 256
+#define SYNDROME_EMPTY 0xFFFFFFFFU
+
+typedef struct {
+    uint32_t syndrome[SYNDROME_SLOTS];
+    int bit[SYNDROME_SLOTS];
+} syndrome_table;
+
+static syndrome_table syndromes_short;  /* 56-bit frames */
+static syndrome_table syndromes_long;   /* 112-bit frames */
+
+static inline unsigned syndrome_hash(uint32_t syndrome)
+{
+    return (syndrome ^ (syndrome >> 8) ^ (syndrome >> 16)) & (SYNDROME_SLOTS - 1);
+}
+
+static void build_syndrome_table(syndrome_table *table, int len)
+{
+    uint8_t frame[14];
+    int i;
+
+    for (i = 0; i < SYNDROME_SLOTS; ++i)
+        table->syndrome[i] = SYNDROME_EMPTY;
+
+    for (i = 0; i < len * 8; ++i) {
+        uint32_t syndrome;
+        unsigned slot;
+
+        memset(frame, 0, len);
+        frame[i / 8] = 0x80 >> (i % 8);
+        syndrome = modescrc_buffer_crc(frame, len - 3) ^ (frame[len-3] << 16) ^ (frame[len-2] << 8) ^ frame[len-1];
+
+        for (slot = syndrome_hash(syndrome); table->syndrome[slot] != SYNDROME_EMPTY; slot = (slot + 1) & (SYNDROME_SLOTS - 1))
+            ;
+        table->syndrome[slot] = syndrome;
+        table->bit[slot] = i;
+    }
+}
+
+/* return the bit position (0 = most significant bit of the first byte) of the
+ * single-bit error with the given syndrome in a frame of len bytes, or -1 if
+ * no single-bit error has that syndrome
+ */
+int modescrc_syndrome_bit(uint32_t syndrome, int len)
+{
+    syndrome_table *table;
+    unsigned slot;
+
+    if (len == 7)
+        table = &syndromes_short;
+    else if (len == 14)
+        table = &syndromes_long;
+    else
+        return -1;
+
+    for (slot = syndrome_hash(syndrome); table->syndrome[slot] != SYNDROME_EMPTY; slot = (slot + 1) & (SYNDROME_SLOTS - 1)) {
+        if (table->syndrome[slot] == syndrome)
+            return table->bit[slot];
+    }
+
+    return -1;
+}
+
 int modescrc_module_init(PyObject *m)
 {
     int i;
@@ -44,6 +125,20 @@ int modescrc_module_init(PyObject *m)
         crc_table[i] = c & 0x00ffffff;
     }
 
+    for (i = 0; i < 256; ++i) {
+        int k;
+
+        crc_slice[0][i] = crc_table[i];
+        for (k = 1; k < CRC_SLICES; ++k) {
+            /* run the previous entry through one more zero byte */
+            uint32_t c = crc_slice[k-1][i];
+            crc_slice[k][i] = ((c & 0x00ffff) << 8) ^ crc_table[(c >> 16) & 0xff];
+        }
+    }
+
+    build_syndrome_table(&syndromes_short, 7);
+    build_syndrome_table(&syndromes_long, 14);
+
     return 0;
 }
 
@@ -53,9 +148,31 @@ void modescrc_module_free(PyObject *m)
 
 uint32_t modescrc_buffer_crc(uint8_t *buf, Py_ssize_t len)
 {
-    uint32_t rem;
-    Py_ssize_t i;
-    for (rem = 0, i = len; i > 0; --i) {
+    uint32_t rem = 0;
+
+    /* 8 bytes at a time: the 24-bit remainder lines up with the first 3 bytes */
+    while (len >= 8) {
+        uint32_t hi = ((uint32_t)buf[0] << 24 | (uint32_t)buf[1] << 16 | (uint32_t)buf[2] << 8 | buf[3]) ^ (rem << 8);
+        uint32_t lo = (uint32_t)buf[4] << 24 | (uint32_t)buf[5] << 16 | (uint32_t)buf[6] << 8 | buf[7];
+
+        rem = crc_slice[7][hi >> 24] ^ crc_slice[6][(hi >> 16) & 0xff] ^
+            crc_slice[5][(hi >> 8) & 0xff] ^ crc_slice[4][hi & 0xff] ^
+            crc_slice[3][lo >> 24] ^ crc_slice[2][(lo >> 16) & 0xff] ^
+            crc_slice[1][(lo >> 8) & 0xff] ^ crc_slice[0][lo & 0xff];
+        buf += 8;
+        len -= 8;
+    }
+
+    if (len >= 4) {
+        uint32_t w = ((uint32_t)buf[0] << 24 | (uint32_t)buf[1] << 16 | (uint32_t)buf[2] << 8 | buf[3]) ^ (rem << 8);
+
+        rem = crc_slice[3][w >> 24] ^ crc_slice[2][(w >> 16) & 0xff] ^
+            crc_slice[1][(w >> 8) & 0xff] ^ crc_slice[0][w & 0xff];
+        buf += 4;
+        len -= 4;
+    }
+
+    for (; len > 0; --len) {
         rem = ((rem & 0x00ffff) << 8) ^ crc_table[*buf++ ^ ((rem & 0xff0000) >> 16)];
     }
 
@@ -86,3 +203,71 @@ PyObject *modescrc_crc(PyObject *self, PyObject *args)
     PyBuffer_Release(&buffer);
     return rv;
 }
+
+/* crc_many(buffer, stride, residual=True): check a packed array of frames
+ * in one call. buffer holds consecutive records of stride bytes each. With
+ * residual set, each record is treated as a whole frame and the result is
+ * its CRC residual (the CRC of everything but the last 3 bytes, XORed with
+ * the last 3 bytes: zero for an undamaged DF17 frame). Otherwise the result
+ * is the CRC of the whole record, as crc() would return. Returns a
+ * memoryview of unsigned 32-bit values, one per record.
+ */
+PyObject *modescrc_crc_many(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "buffer", "stride", "residual", NULL };
+    Py_buffer buffer;
+    Py_ssize_t stride, n, i;
+    int residual = 1;
+    PyObject *array = NULL, *view = NULL, *rv = NULL;
+    uint32_t *out;
+    uint8_t *record;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*n|p", kwlist, &buffer, &stride, &residual))
+        return NULL;
+
+    if (buffer.itemsize != 1) {
+        PyErr_SetString(PyExc_ValueError, "buffer itemsize is not 1");
+        goto out;
+    }
+
+    if (!PyBuffer_IsContiguous(&buffer, 'C')) {
+        PyErr_SetString(PyExc_ValueError, "buffer is not contiguous");
+        goto out;
+    }
+
+    if (stride < (residual ? 4 : 1)) {
+        PyErr_SetString(PyExc_ValueError, "stride is too small");
+        goto out;
+    }
+
+    if (buffer.len % stride != 0) {
+        PyErr_SetString(PyExc_ValueError, "buffer length is not a multiple of the stride");
+        goto out;
+    }
+
+    n = buffer.len / stride;
+    if (! (array = PyByteArray_FromStringAndSize(NULL, n * sizeof(uint32_t))))
+        goto out;
+
+    out = (uint32_t *) PyByteArray_AS_STRING(array);
+    record = buffer.buf;
+    if (residual) {
+        for (i = 0; i < n; ++i, record += stride) {
+            uint8_t *parity = record + stride - 3;
+            out[i] = modescrc_buffer_crc(record, stride - 3) ^ ((parity[0] << 16) | (parity[1] << 8) | parity[2]);
+        }
+    } else {
+        for (i = 0; i < n; ++i, record += stride)
+            out[i] = modescrc_buffer_crc(record, stride);
+    }
+
+    if (! (view = PyMemoryView_FromObject(array)))
+        goto out;
+    rv = PyObject_CallMethod(view, "cast", "s", "I");
+
+ out:
+    Py_XDECREF(view);
+    Py_XDECREF(array);
+    PyBuffer_Release(&buffer);
+    return rv;
+}
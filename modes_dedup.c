@@ -0,0 +1,90 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+/********** DUPLICATE SUPPRESSION ****************/
+
+/*
+ * Receivers that merge several SDRs, or relays that repeat traffic, can
+ * deliver the same frame more than once. The reader remembers recently
+ * seen frames in a small direct-mapped table indexed by a hash of the
+ * frame bytes, and drops a frame if the same bytes were seen with a
+ * timestamp within the configured window. A colliding frame just evicts
+ * the older entry, so the table may miss some duplicates, but it never
+ * drops a frame that wasn't a repeat.
+ */
+
+#define DEDUP_BITS 10
+#define DEDUP_SIZE (1 << DEDUP_BITS)
+
+void modesdedup_init(modesdedup *dedup)
+{
+    memset(dedup, 0, sizeof(*dedup));
+}
+
+void modesdedup_free(modesdedup *dedup)
+{
+    free(dedup->entries);
+    modesdedup_init(dedup);
+}
+
+static inline uint32_t dedup_hash(uint8_t *data, int datalen)
+{
+    uint32_t h = 2166136261U;
+    int i;
+
+    /* FNV-1a */
+    for (i = 0; i < datalen; ++i)
+        h = (h ^ data[i]) * 16777619U;
+
+    return h >> (32 - DEDUP_BITS);
+}
+
+/* check a frame against the recently seen frames, and remember it.
+ *
+ * returns 1 if the same frame was seen with a timestamp no more than
+ * window away, 0 if it was not, or -1 (with an exception set) on error.
+ */
+int modesdedup_check(modesdedup *dedup, unsigned long long timestamp, uint8_t *data, int datalen, unsigned long long window)
+{
+    modesdedupentry *entry;
+
+    if (datalen > (int)sizeof(entry->data))
+        return 0;
+
+    if (!dedup->entries) {
+        if (! (dedup->entries = calloc(DEDUP_SIZE, sizeof(modesdedupentry)))) {
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+
+    entry = &dedup->entries[dedup_hash(data, datalen)];
+    if (entry->datalen == datalen &&
+        (timestamp > entry->timestamp ? timestamp - entry->timestamp : entry->timestamp - timestamp) <= window &&
+        !memcmp(entry->data, data, datalen)) {
+        /* keep the first copy's timestamp, so a run of repeats can't stretch the window */
+        return 1;
+    }
+
+    entry->timestamp = timestamp;
+    entry->datalen = datalen;
+    memcpy(entry->data, data, datalen);
+    return 0;
+}
@@ -0,0 +1,330 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+/********** FILTERS ****************/
+
+/*
+ * The reader's filters are given to us as Python objects (a list of
+ * booleans indexed by DF, a list of address sets indexed by DF, and a set
+ * of Mode A/C codes). Looking these up for every frame is expensive, so
+ * when a filter is installed it is compiled into DF bitmasks, hash sets
+ * of addresses, and a Mode A/C bitmap, that can be checked without
+ * touching any Python objects. This means the reader works from a
+ * snapshot: changes made to the Python objects after they are installed
+ * have no effect until the filter is installed again. Reading a filter
+ * back gives an immutable copy (tuples and frozensets), so trying to
+ * change it in place fails instead of being silently ignored.
+ */
+
+/* read an iterable of integers into a malloc'd array; values that can never match an address are skipped */
+static int collect_addresses(PyObject *iterable, uint32_t maxvalue, uint32_t **values, uint32_t *count)
+{
+    PyObject *iter, *item;
+    uint32_t *array = NULL;
+    uint32_t used = 0, allocated = 0;
+
+    if (! (iter = PyObject_GetIter(iterable)))
+        return -1;
+
+    while ((item = PyIter_Next(iter))) {
+        long long value;
+
+        if (!PyLong_Check(item)) {
+            PyErr_Format(PyExc_TypeError, "filter addresses must be integers, not %.100s", Py_TYPE(item)->tp_name);
+            Py_DECREF(item);
+            goto err;
+        }
+
+        value = PyLong_AsLongLong(item);
+        Py_DECREF(item);
+        if (value == -1 && PyErr_Occurred()) {
+            if (!PyErr_ExceptionMatches(PyExc_OverflowError))
+                goto err;
+            /* too large to ever match */
+            PyErr_Clear();
+            continue;
+        }
+
+        if (value < 0 || value > maxvalue)
+            continue;
+
+        if (used == allocated) {
+            uint32_t *newarray;
+            allocated = (allocated ? allocated * 2 : 64);
+            if (! (newarray = realloc(array, allocated * sizeof(uint32_t)))) {
+                PyErr_NoMemory();
+                goto err;
+            }
+            array = newarray;
+        }
+
+        array[used++] = (uint32_t)value;
+    }
+
+    if (PyErr_Occurred())
+        goto err;
+
+    Py_DECREF(iter);
+    *values = array;
+    *count = used;
+    return 0;
+
+ err:
+    Py_DECREF(iter);
+    free(array);
+    return -1;
+}
+
+static void addrset_free(modesaddrset *set)
+{
+    if (set) {
+        free(set->slots);
+        free(set);
+    }
+}
+
+static void addrset_add(modesaddrset *set, uint32_t address)
+{
+    uint32_t i;
+
+    for (i = (uint32_t)(address * 2654435761U) >> set->shift; set->slots[i] != ADDRSET_EMPTY; i = (i + 1) & set->mask) {
+        if (set->slots[i] == address)
+            return;
+    }
+
+    set->slots[i] = address;
+    ++set->count;
+}
+
+/* build a new address set from a python iterable of addresses */
+static modesaddrset *addrset_compile(PyObject *iterable)
+{
+    modesaddrset *set;
+    uint32_t *values = NULL;
+    uint32_t count, i, size;
+    int bits;
+
+    if (collect_addresses(iterable, 0xFFFFFF, &values, &count) < 0)
+        return NULL;
+
+    /* keep the load factor at or below 50% */
+    for (bits = 4, size = 16; size < count * 2; ++bits, size <<= 1)
+        ;
+
+    if (! (set = calloc(1, sizeof(*set))) || ! (set->slots = malloc(size * sizeof(uint32_t)))) {
+        PyErr_NoMemory();
+        addrset_free(set);
+        free(values);
+        return NULL;
+    }
+
+    for (i = 0; i < size; ++i)
+        set->slots[i] = ADDRSET_EMPTY;
+    set->mask = size - 1;
+    set->shift = 32 - bits;
+    set->count = 0;
+
+    for (i = 0; i < count; ++i)
+        addrset_add(set, values[i]);
+
+    free(values);
+    return set;
+}
+
+void modesfilter_init(modesfilter *filter)
+{
+    memset(filter, 0, sizeof(*filter));
+}
+
+static void free_specific(modesfilter *filter)
+{
+    int i;
+
+    for (i = 0; i < filter->n_sets; ++i)
+        addrset_free(filter->sets[i]);
+
+    filter->n_sets = 0;
+    memset(filter->sets, 0, sizeof(filter->sets));
+    memset(filter->specific, 0, sizeof(filter->specific));
+}
+
+void modesfilter_free(modesfilter *filter)
+{
+    free_specific(filter);
+    free(filter->modeac);
+    addrset_free(filter->sync);
+    modesfilter_init(filter);
+}
+
+/* compile a default filter: None, or a sequence of booleans indexed by DF */
+int modesfilter_compile_default(modesfilter *filter, PyObject *default_filter)
+{
+    uint32_t mask = 0;
+    Py_ssize_t len, df;
+
+    if (default_filter == NULL || default_filter == Py_None) {
+        filter->has_default = 0;
+        filter->default_mask = 0;
+        return 0;
+    }
+
+    if ((len = PySequence_Length(default_filter)) < 0)
+        return -1;
+
+    for (df = 0; df < 32 && df < len; ++df) {
+        int rv;
+        PyObject *entry = PySequence_GetItem(default_filter, df);
+        if (entry == NULL)
+            return -1;
+
+        rv = PyObject_IsTrue(entry);
+        Py_DECREF(entry);
+        if (rv < 0)
+            return -1;
+        if (rv)
+            mask |= (1U << df);
+    }
+
+    filter->has_default = 1;
+    filter->default_mask = mask;
+    return 0;
+}
+
+/* compile a specific filter: None, or a sequence indexed by DF of None or iterables of addresses */
+int modesfilter_compile_specific(modesfilter *filter, PyObject *specific_filter)
+{
+    PyObject *entries[32];
+    modesfilter compiled;
+    Py_ssize_t len, df;
+    int i;
+
+    if (specific_filter == NULL || specific_filter == Py_None) {
+        free_specific(filter);
+        filter->has_specific = 0;
+        filter->specific_mask = 0;
+        return 0;
+    }
+
+    if ((len = PySequence_Length(specific_filter)) < 0)
+        return -1;
+
+    modesfilter_init(&compiled);
+    memset(entries, 0, sizeof(entries));
+
+    for (df = 0; df < 32 && df < len; ++df) {
+        PyObject *entry = PySequence_GetItem(specific_filter, df);
+        if (entry == NULL)
+            goto err;
+
+        if (entry == Py_None) {
+            Py_DECREF(entry);
+            continue;
+        }
+
+        entries[df] = entry;
+
+        /* the same set is usually installed for several DFs, only compile it once */
+        for (i = 0; i < df; ++i) {
+            if (entries[i] == entry) {
+                compiled.specific[df] = compiled.specific[i];
+                break;
+            }
+        }
+
+        if (!compiled.specific[df]) {
+            if (! (compiled.specific[df] = addrset_compile(entry)))
+                goto err;
+            compiled.sets[compiled.n_sets++] = compiled.specific[df];
+        }
+
+        compiled.specific_mask |= (1U << df);
+    }
+
+    for (df = 0; df < 32; ++df)
+        Py_XDECREF(entries[df]);
+
+    free_specific(filter);
+    memcpy(filter->specific, compiled.specific, sizeof(filter->specific));
+    memcpy(filter->sets, compiled.sets, sizeof(filter->sets));
+    filter->n_sets = compiled.n_sets;
+    filter->specific_mask = compiled.specific_mask;
+    filter->has_specific = 1;
+    return 0;
+
+ err:
+    for (df = 0; df < 32; ++df)
+        Py_XDECREF(entries[df]);
+    free_specific(&compiled);
+    return -1;
+}
+
+/* compile a Mode A/C filter: None, or an iterable of Mode A/C codes */
+int modesfilter_compile_modeac(modesfilter *filter, PyObject *modeac_filter)
+{
+    uint32_t *values = NULL;
+    uint32_t count, i;
+    uint8_t *bitmap;
+
+    if (modeac_filter == NULL || modeac_filter == Py_None) {
+        free(filter->modeac);
+        filter->modeac = NULL;
+        filter->has_modeac = 0;
+        return 0;
+    }
+
+    if (collect_addresses(modeac_filter, 0xFFFF, &values, &count) < 0)
+        return -1;
+
+    if (! (bitmap = calloc(65536 / 8, 1))) {
+        free(values);
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for (i = 0; i < count; ++i)
+        bitmap[values[i] >> 3] |= (1 << (values[i] & 7));
+    free(values);
+
+    free(filter->modeac);
+    filter->modeac = bitmap;
+    filter->has_modeac = 1;
+    return 0;
+}
+
+/* compile a DF17 sync candidate filter: None, or an iterable of addresses */
+int modesfilter_compile_sync(modesfilter *filter, PyObject *sync_filter)
+{
+    modesaddrset *set;
+
+    if (sync_filter == NULL || sync_filter == Py_None) {
+        addrset_free(filter->sync);
+        filter->sync = NULL;
+        filter->has_sync = 0;
+        return 0;
+    }
+
+    if (! (set = addrset_compile(sync_filter)))
+        return -1;
+
+    addrset_free(filter->sync);
+    filter->sync = set;
+    filter->has_sync = 1;
+    return 0;
+}
@@ -0,0 +1,212 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+/********** TCP JSON LINES ****************/
+
+/*
+ * Without the UDP transport, mlat and sync messages go to the server as
+ * JSON lines over the (usually zlib-compressed) TCP connection:
+ *
+ *   {"mlat":{"t":<timestamp>,"m":"<hex>"}}
+ *   {"sync":{"et":<timestamp>,"em":"<hex>","ot":<timestamp>,"om":"<hex>"}}
+ *   {"ssync":{"t":<timestamp>,"m":"<hex>"}}
+ *
+ * These helpers append finished lines (each ending in a newline) straight
+ * to a bytearray, which is what the client compresses and sends.
+ */
+
+static const char hexdigit[16] = "0123456789abcdef";
+
+/* longest decimal representation of an unsigned long long */
+#define MAX_DECIMAL 20
+
+/* check that o is a message with data, and return it */
+static modesmessage *json_message(PyObject *o)
+{
+    if (!modesmessage_check(o)) {
+        PyErr_SetString(PyExc_TypeError, "expected a Message");
+        return NULL;
+    }
+
+    if (!((modesmessage *)o)->data) {
+        PyErr_SetString(PyExc_ValueError, "can't send an event message to the server");
+        return NULL;
+    }
+
+    return (modesmessage *)o;
+}
+
+static char *put_string(char *p, const char *s, size_t len)
+{
+    memcpy(p, s, len);
+    return p + len;
+}
+
+#define PUT_LITERAL(p, s) put_string((p), (s), sizeof(s) - 1)
+
+static char *put_decimal(char *p, unsigned long long value)
+{
+    char digits[MAX_DECIMAL];
+    int n = 0;
+
+    do {
+        digits[n++] = '0' + (value % 10);
+        value /= 10;
+    } while (value);
+
+    while (n > 0)
+        *p++ = digits[--n];
+    return p;
+}
+
+static char *put_hex(char *p, modesmessage *message)
+{
+    int i;
+
+    for (i = 0; i < message->datalen; ++i) {
+        *p++ = hexdigit[(message->data[i] >> 4) & 15];
+        *p++ = hexdigit[message->data[i] & 15];
+    }
+
+    return p;
+}
+
+/* timestamp and data of one message, at most */
+static Py_ssize_t message_space(modesmessage *message)
+{
+    return MAX_DECIMAL + 2 * (Py_ssize_t)message->datalen;
+}
+
+/* make room for up to extra more bytes at the end of buf; returns a pointer to the old end */
+static char *json_reserve(PyObject *buf, Py_ssize_t extra, Py_ssize_t *oldlen)
+{
+    *oldlen = PyByteArray_GET_SIZE(buf);
+    if (PyByteArray_Resize(buf, *oldlen + extra) < 0)
+        return NULL;
+    return PyByteArray_AS_STRING(buf) + *oldlen;
+}
+
+/* trim buf back to the bytes that were actually written */
+static PyObject *json_finish(PyObject *buf, char *start, char *end, Py_ssize_t oldlen)
+{
+    if (PyByteArray_Resize(buf, oldlen + (end - start)) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+/* append_json_mlat(buf, messages): append an mlat line to buf for each message */
+PyObject *modesjson_append_mlat(PyObject *self, PyObject *args)
+{
+    PyObject *buf, *messages, *seq;
+    PyObject **items;
+    Py_ssize_t i, n, space = 0, oldlen;
+    char *start, *p;
+
+    if (!PyArg_ParseTuple(args, "O!O", &PyByteArray_Type, &buf, &messages))
+        return NULL;
+
+    if (! (seq = PySequence_Fast(messages, "expected a sequence of messages")))
+        return NULL;
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    items = PySequence_Fast_ITEMS(seq);
+    for (i = 0; i < n; ++i) {
+        modesmessage *message = json_message(items[i]);
+        if (!message)
+            goto err;
+        space += sizeof("{\"mlat\":{\"t\":,\"m\":\"\"}}\n") - 1 + message_space(message);
+    }
+
+    if (! (start = p = json_reserve(buf, space, &oldlen)))
+        goto err;
+
+    for (i = 0; i < n; ++i) {
+        modesmessage *message = (modesmessage *)items[i];
+        p = PUT_LITERAL(p, "{\"mlat\":{\"t\":");
+        p = put_decimal(p, message->timestamp);
+        p = PUT_LITERAL(p, ",\"m\":\"");
+        p = put_hex(p, message);
+        p = PUT_LITERAL(p, "\"}}\n");
+    }
+
+    Py_DECREF(seq);
+    return json_finish(buf, start, p, oldlen);
+
+ err:
+    Py_DECREF(seq);
+    return NULL;
+}
+
+/* append_json_sync(buf, even, odd): append a sync line for a pair of DF17 positions */
+PyObject *modesjson_append_sync(PyObject *self, PyObject *args)
+{
+    PyObject *buf, *even_obj, *odd_obj;
+    modesmessage *even, *odd;
+    Py_ssize_t oldlen;
+    char *start, *p;
+
+    if (!PyArg_ParseTuple(args, "O!OO", &PyByteArray_Type, &buf, &even_obj, &odd_obj))
+        return NULL;
+
+    if (! (even = json_message(even_obj)) || ! (odd = json_message(odd_obj)))
+        return NULL;
+
+    if (! (start = p = json_reserve(buf, sizeof("{\"sync\":{\"et\":,\"em\":\"\",\"ot\":,\"om\":\"\"}}\n") - 1 +
+                                    message_space(even) + message_space(odd), &oldlen)))
+        return NULL;
+
+    p = PUT_LITERAL(p, "{\"sync\":{\"et\":");
+    p = put_decimal(p, even->timestamp);
+    p = PUT_LITERAL(p, ",\"em\":\"");
+    p = put_hex(p, even);
+    p = PUT_LITERAL(p, "\",\"ot\":");
+    p = put_decimal(p, odd->timestamp);
+    p = PUT_LITERAL(p, ",\"om\":\"");
+    p = put_hex(p, odd);
+    p = PUT_LITERAL(p, "\"}}\n");
+
+    return json_finish(buf, start, p, oldlen);
+}
+
+/* append_json_ssync(buf, message): append a split sync line for one DF17 position */
+PyObject *modesjson_append_ssync(PyObject *self, PyObject *args)
+{
+    PyObject *buf, *message_obj;
+    modesmessage *message;
+    Py_ssize_t oldlen;
+    char *start, *p;
+
+    if (!PyArg_ParseTuple(args, "O!O", &PyByteArray_Type, &buf, &message_obj))
+        return NULL;
+
+    if (! (message = json_message(message_obj)))
+        return NULL;
+
+    if (! (start = p = json_reserve(buf, sizeof("{\"ssync\":{\"t\":,\"m\":\"\"}}\n") - 1 + message_space(message), &oldlen)))
+        return NULL;
+
+    p = PUT_LITERAL(p, "{\"ssync\":{\"t\":");
+    p = put_decimal(p, message->timestamp);
+    p = PUT_LITERAL(p, ",\"m\":\"");
+    p = put_hex(p, message);
+    p = PUT_LITERAL(p, "\"}}\n");
+
+    return json_finish(buf, start, p, oldlen);
+}
@@ -29,11 +29,15 @@ static long modesmessage_hash(PyObject *self);
 static PyObject *modesmessage_richcompare(PyObject *self, PyObject *other, int op);
 static PyObject *modesmessage_repr(PyObject *self);
 static PyObject *modesmessage_str(PyObject *self);
+static PyObject *modesmessage_getcrc(modesmessage *self, void *closure);
+static PyObject *modesmessage_getaddress(modesmessage *self, void *closure);
+static PyObject *modesmessage_getaltitude(modesmessage *self, void *closure);
 
 /* internal helpers */
-static PyObject *decode_ac13(unsigned ac13);
+static int decode_ac13(unsigned ac13, int *altitude);
+static int decode_ac12(unsigned ac12, int *altitude);
 static uint32_t crc_residual(uint8_t *message, int len);
-static int decode(modesmessage *self);
+static int decode(modesmessage *self, modesfields *fields);
 
 /* modesmessage fields */
 /* todo: these can probably all be read/write */
@@ -45,13 +49,20 @@ static PyMemberDef modesmessageMembers[] = {
     { "even_cpr",     T_BOOL,      offsetof(modesmessage, even_cpr),  READONLY, "CPR even-format flag" },
     { "odd_cpr",      T_BOOL,      offsetof(modesmessage, odd_cpr),   READONLY, "CPR odd-format flag" },
     { "valid",        T_BOOL,      offsetof(modesmessage, valid),     READONLY, "Does the message look OK?" },
-    { "crc_residual", T_OBJECT,    offsetof(modesmessage, crc),       READONLY, "CRC residual" },
-    { "address",      T_OBJECT,    offsetof(modesmessage, address),   READONLY, "ICAO address" },
-    { "altitude",     T_OBJECT,    offsetof(modesmessage, altitude),  READONLY, "altitude" },
+    { "repaired",     T_BOOL,      offsetof(modesmessage, repaired),  READONLY, "Was a single-bit error in the message corrected?" },
     { "eventdata",    T_OBJECT,    offsetof(modesmessage, eventdata), READONLY, "event data dictionary for special event messages" },
+    { "sync_partner", T_OBJECT,    offsetof(modesmessage, partner),   READONLY, "for DF17 sync candidates from a reader with track_adsb set, the latest position message of the other CPR format" },
     { NULL, 0, 0, 0, NULL }
 };
 
+/* .. and the decoded fields, which are only converted to python objects when asked for */
+static PyGetSetDef modesmessageGetSet[] = {
+    { "crc_residual", (getter)modesmessage_getcrc,      NULL, "CRC residual", NULL },
+    { "address",      (getter)modesmessage_getaddress,  NULL, "ICAO address", NULL },
+    { "altitude",     (getter)modesmessage_getaltitude, NULL, "altitude", NULL },
+    { NULL, NULL, NULL, NULL, NULL }
+};
+
 /* modesmessage buffer protocol */
 static PyBufferProcs modesmessageBufferProcs = {
     modesmessage_bf_getbuffer,          /* bf_getbuffer  */
@@ -101,7 +112,7 @@ static PyTypeObject modesmessageType = {
     0,                                /* tp_iternext    */
     0,                                /* tp_methods     */
     modesmessageMembers,              /* tp_members     */
-    0,                                /* tp_getset      */
+    modesmessageGetSet,               /* tp_getset      */
     0,                                /* tp_base        */
     0,                                /* tp_dict        */
     0,                                /* tp_descr_get   */
@@ -148,17 +159,33 @@ int modesmessage_module_init(PyObject *m)
     return 0;
 }
 
+/*
+ * Messages are created and destroyed at the frame rate, so keep a
+ * freelist of deallocated Message objects to reuse rather than going
+ * back to the allocator each time.
+ */
+#define MESSAGE_FREELIST_MAX 1024
+static modesmessage *message_freelist[MESSAGE_FREELIST_MAX];
+static int message_freelist_len = 0;
+
 void modesmessage_module_free(PyObject *m)
 {
+    while (message_freelist_len > 0)
+        PyObject_Del(message_freelist[--message_freelist_len]);
 }
 
 static PyObject *modesmessage_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
     modesmessage *self;
 
-    self = (modesmessage *)type->tp_alloc(type, 0);
-    if (!self)
-        return NULL;
+    if (type == &modesmessageType && message_freelist_len > 0) {
+        self = message_freelist[--message_freelist_len];
+        PyObject_Init((PyObject*)self, type);
+    } else {
+        self = (modesmessage *)type->tp_alloc(type, 0);
+        if (!self)
+            return NULL;
+    }
 
     /* minimal init */
     self->timestamp = 0;
@@ -167,53 +194,97 @@ static PyObject *modesmessage_new(PyTypeObject *type, PyObject *args, PyObject *
     self->nuc = 0;
     self->even_cpr = self->odd_cpr = 0;
     self->valid = 0;
-    self->crc = NULL;
-    self->address = NULL;
-    self->altitude = NULL;
+    self->repaired = 0;
+    self->has_crc = self->has_address = self->has_altitude = 0;
+    self->crc = self->address = 0;
+    self->altitude = 0;
+    self->crc_obj = NULL;
+    self->address_obj = NULL;
+    self->altitude_obj = NULL;
+    self->addrcache = NULL;
+    self->addrcache_owner = NULL;
     self->data = NULL;
     self->datalen = 0;
     self->eventdata = NULL;
+    self->partner = NULL;
 
     return (PyObject *)self;
 }
 
 static void modesmessage_dealloc(modesmessage *self)
 {
-    Py_XDECREF(self->crc);
-    Py_XDECREF(self->address);
-    Py_XDECREF(self->altitude);
+    Py_XDECREF(self->crc_obj);
+    Py_XDECREF(self->address_obj);
+    Py_XDECREF(self->altitude_obj);
+    Py_XDECREF(self->addrcache_owner);
     Py_XDECREF(self->eventdata);
-    free(self->data);
-    Py_TYPE(self)->tp_free((PyObject*)self);
+    Py_XDECREF(self->partner);
+    if (self->data != self->inline_data)
+        PyMem_Free(self->data);
+
+    if (Py_TYPE(self) == &modesmessageType && message_freelist_len < MESSAGE_FREELIST_MAX)
+        message_freelist[message_freelist_len++] = self;
+    else
+        Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+/* copy frame data into a message, using the inline buffer if it fits */
+static int set_data(modesmessage *self, uint8_t *data, Py_ssize_t datalen)
+{
+    uint8_t *copydata;
+
+    if (datalen <= MODES_INLINE_DATA) {
+        copydata = self->inline_data;
+    } else if (! (copydata = PyMem_Malloc(datalen))) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    memcpy(copydata, data, datalen);
+
+    if (self->data != self->inline_data)
+        PyMem_Free(self->data);
+    self->data = copydata;
+    self->datalen = datalen;
+    return 0;
 }
 
 /* internal entry point to build a new message from a buffer */
 PyObject *modesmessage_from_buffer(unsigned long long timestamp, unsigned signal, uint8_t *data, int datalen)
+{
+    modesfields fields;
+
+    modesmessage_decode_fields(data, datalen, &fields);
+    return modesmessage_from_fields(timestamp, signal, data, datalen, &fields, NULL, NULL);
+}
+
+/* internal entry point to build a new message from a buffer,
+ * reusing the results of a previous modesmessage_decode_fields() on it
+ */
+PyObject *modesmessage_from_fields(unsigned long long timestamp, unsigned signal, uint8_t *data, int datalen, modesfields *fields,
+                                   modesaddrcache *cache, PyObject *cache_owner)
 {
     modesmessage *message;
-    uint8_t *copydata;
 
     if (! (message = (modesmessage*)modesmessage_new(&modesmessageType, NULL, NULL)))
         goto err;
 
-    /* minimal init so deallocation works */
-    message->data = NULL;
-
-    copydata = malloc(datalen);
-    if (!copydata) {
-        PyErr_NoMemory();
+    if (set_data(message, data, datalen) < 0)
         goto err;
-    }
-    memcpy(copydata, data, datalen);
 
     message->timestamp = timestamp;
     message->signal = signal;
-    message->data = copydata;
-    message->datalen = datalen;
 
-    if (decode(message) < 0)
+    if (decode(message, fields) < 0)
         goto err;
 
+    if (cache && message->has_address) {
+        /* look the address up only if it is asked for */
+        message->addrcache = cache;
+        Py_INCREF(cache_owner);
+        message->addrcache_owner = cache_owner;
+    }
+
     return (PyObject*)message;
 
  err:
@@ -221,6 +292,50 @@ PyObject *modesmessage_from_buffer(unsigned long long timestamp, unsigned signal
     return NULL;
 }
 
+/* address cache */
+
+void modesaddrcache_init(modesaddrcache *cache)
+{
+    memset(cache, 0, sizeof(*cache));
+}
+
+void modesaddrcache_clear(modesaddrcache *cache)
+{
+    int i;
+
+    for (i = 0; i < ADDRCACHE_SIZE; ++i)
+        Py_CLEAR(cache->obj[i]);
+}
+
+/* return a new reference to a python int for this address, reusing a
+ * previous object if we have one; a colliding address evicts the old entry
+ */
+PyObject *modesaddrcache_get(modesaddrcache *cache, uint32_t address)
+{
+    unsigned slot = (uint32_t)(address * 2654435761U) >> (32 - ADDRCACHE_BITS);
+    PyObject *obj;
+
+    if (cache->obj[slot] && cache->address[slot] == address) {
+        ++cache->hits;
+        Py_INCREF(cache->obj[slot]);
+        return cache->obj[slot];
+    }
+
+    ++cache->misses;
+    if (!(obj = PyLong_FromLong(address)))
+        return NULL;
+
+    Py_XSETREF(cache->obj[slot], obj);
+    cache->address[slot] = address;
+    Py_INCREF(obj);
+    return obj;
+}
+
+int modesmessage_check(PyObject *o)
+{
+    return PyObject_TypeCheck(o, &modesmessageType);
+}
+
 /* internal entry point to build a new event message
  * steals a reference from eventdata
  */
@@ -278,44 +393,37 @@ static int modesmessage_init(modesmessage *self, PyObject *args, PyObject *kwds)
         goto out;
     }
 
-    self->datalen = 0;
-    free(self->data);
-
-    self->data = malloc(data.len);
-    if (!self->data) {
-        PyErr_NoMemory();
+    if (set_data(self, data.buf, data.len) < 0)
         goto out;
-    }
 
-    memcpy(self->data, data.buf, data.len);
-    self->datalen = data.len;
-
-    rv = decode(self);
+    rv = decode(self, NULL);
 
  out:
     PyBuffer_Release(&data);
     return rv;
 }
 
-static PyObject *decode_ac13(unsigned ac13)
+/* decode a 13-bit AC field, return 1 and set *altitude if it's valid, 0 otherwise */
+static int decode_ac13(unsigned ac13, int *altitude)
 {
     int h, f, a;
 
     if (ac13 == 0)
-        Py_RETURN_NONE;
+        return 0;
 
     if (ac13 & 0x0040) /* M bit */
-        Py_RETURN_NONE;
+        return 0;
 
     if (ac13 & 0x0010) { /* Q bit */
         int n = ((ac13 & 0x1f80) >> 2) | ((ac13 & 0x0020) >> 1) | (ac13 & 0x000f);
-        return PyLong_FromLong(n * 25 - 1000);
+        *altitude = n * 25 - 1000;
+        return 1;
     }
 
     /* convert from Gillham code */
     if (! ((ac13 & 0x1500))) {
         /* illegal gillham code */
-        Py_RETURN_NONE;
+        return 0;
     }
 
     h = 0;
@@ -327,7 +435,7 @@ static PyObject *decode_ac13(unsigned ac13)
         h ^= 5;
 
     if (h > 5)
-        Py_RETURN_NONE; /* illegal */
+        return 0; /* illegal */
 
     f = 0;
     if (ac13 & 0x0010) f ^= 0x1ff; /* D1 */
@@ -345,14 +453,15 @@ static PyObject *decode_ac13(unsigned ac13)
 
     a = 500 * f + 100 * h - 1300;
     if (a < -1200)
-        Py_RETURN_NONE; /* illegal */
+        return 0; /* illegal */
 
-    return PyLong_FromLong(a);
+    *altitude = a;
+    return 1;
 }
 
-static PyObject *decode_ac12(unsigned ac12)
+static int decode_ac12(unsigned ac12, int *altitude)
 {
-    return decode_ac13(((ac12 & 0x0fc0) << 1) | (ac12 & 0x003f));
+    return decode_ac13(((ac12 & 0x0fc0) << 1) | (ac12 & 0x003f), altitude);
 }
 
 static uint32_t crc_residual(uint8_t *message, int len)
@@ -369,105 +478,111 @@ static uint32_t crc_residual(uint8_t *message, int len)
     return crc;
 }
 
-static int decode(modesmessage *self)
+/* decode a raw frame into its fields, without creating any python objects */
+void modesmessage_decode_fields(uint8_t *data, int datalen, modesfields *fields)
 {
     uint32_t crc;
 
     /* clear state */
-    self->valid = 0;
-    self->nuc = 0;
-    self->odd_cpr = self->even_cpr = 0;
-    Py_CLEAR(self->crc);
-    Py_CLEAR(self->address);
-    Py_CLEAR(self->altitude);
-
-    if (self->datalen == 2) {
-        self->df = DF_MODEAC;
-        self->address = PyLong_FromLong((self->data[0] << 8) | self->data[1]);
-        self->valid = 1;
-        return 0;
+    fields->df = 0;
+    fields->nuc = 0;
+    fields->even_cpr = fields->odd_cpr = 0;
+    fields->valid = 0;
+    fields->repaired = 0;
+    fields->has_crc = fields->has_address = fields->has_altitude = 0;
+    fields->crc = fields->address = 0;
+    fields->altitude = 0;
+
+    if (datalen == 2) {
+        fields->df = DF_MODEAC;
+        fields->address = (data[0] << 8) | data[1];
+        fields->has_address = 1;
+        fields->valid = 1;
+        return;
     }
 
-    self->df = (self->data[0] >> 3) & 31;
+    if (datalen < 1)
+        return;
+
+    fields->df = (data[0] >> 3) & 31;
 
-    if ((self->df < 16 && self->datalen != 7) || (self->df >= 16 && self->datalen != 14)) {
+    if ((fields->df < 16 && datalen != 7) || (fields->df >= 16 && datalen != 14)) {
         /* wrong length, no further processing */
-        return 0;
+        return;
     }
 
-    if (self->df != 0 && self->df != 4 && self->df != 5 && self->df != 11 &&
-        self->df != 16 && self->df != 17 && self->df != 20 && self->df != 21) {
+    if (fields->df != 0 && fields->df != 4 && fields->df != 5 && fields->df != 11 &&
+        fields->df != 16 && fields->df != 17 && fields->df != 20 && fields->df != 21) {
         /* we do not know how to handle this message type, no further processing */
-        return 0;
+        return;
     }
 
-    crc = crc_residual(self->data, self->datalen);
-    if (!(self->crc = PyLong_FromLong(crc)))
-        return -1;
+    crc = crc_residual(data, datalen);
+    fields->crc = crc;
+    fields->has_crc = 1;
 
-    switch (self->df) {
+    switch (fields->df) {
     case 0:
     case 4:
     case 16:
     case 20:
-        self->address = (Py_INCREF(self->crc), self->crc);
-        if (! (self->altitude = decode_ac13((self->data[2] & 0x1f) << 8 | (self->data[3]))))
-            return -1;
-        self->valid = 1;
+        fields->address = crc;
+        fields->has_address = 1;
+        fields->has_altitude = decode_ac13((data[2] & 0x1f) << 8 | (data[3]), &fields->altitude);
+        fields->valid = 1;
         break;
 
     case 5:
     case 21:
     case 24:
-        self->address = (Py_INCREF(self->crc), self->crc);
-        self->valid = 1;
+        fields->address = crc;
+        fields->has_address = 1;
+        fields->valid = 1;
         break;
 
     case 11:
-        self->valid = ((crc & ~0x7f) == 0);
-        if (self->valid) {
-            if (! (self->address = PyLong_FromLong( (self->data[1] << 16) | (self->data[2] << 8) | (self->data[3]) )))
-                return -1;
+        fields->valid = ((crc & ~0x7f) == 0);
+        if (fields->valid) {
+            fields->address = (data[1] << 16) | (data[2] << 8) | (data[3]);
+            fields->has_address = 1;
         }
         break;
 
     case 17:
-        self->valid = (crc == 0);
-        if (self->valid) {
+        fields->valid = (crc == 0);
+        if (fields->valid) {
             unsigned metype;
 
-            unsigned address = (self->data[1] << 16) | (self->data[2] << 8) | (self->data[3]);
-            self->address = PyLong_FromLong(address);
-            if (!self->address)
-                return -1;
+            unsigned address = (data[1] << 16) | (data[2] << 8) | (data[3]);
+            fields->address = address;
+            fields->has_address = 1;
 
-            metype = self->data[4] >> 3;
+            metype = data[4] >> 3;
             if ((metype >= 9 && metype <= 18) || (metype >= 20 && metype < 22)) {
                 if (metype == 22)
-                    self->nuc = 0;
+                    fields->nuc = 0;
                 else if (metype <= 18)
-                    self->nuc = 18 - metype;
+                    fields->nuc = 18 - metype;
                 else
-                    self->nuc = 29 - metype;
+                    fields->nuc = 29 - metype;
 
-                if (0 && self->nuc <= 5) {
-                    fprintf(stderr, "%06x nuc: %d\n", address, self->nuc);
+                if (0 && fields->nuc <= 5) {
+                    fprintf(stderr, "%06x nuc: %d\n", address, fields->nuc);
                 }
 
-                if (self->data[6] & 0x04)
-                    self->odd_cpr = 1;
+                if (data[6] & 0x04)
+                    fields->odd_cpr = 1;
                 else
-                    self->even_cpr = 1;
+                    fields->even_cpr = 1;
 
-                if (! (self->altitude = decode_ac12((self->data[5] << 4) | ((self->data[6] & 0xF0) >> 4))))
-                    return -1;
+                fields->has_altitude = decode_ac12((data[5] << 4) | ((data[6] & 0xF0) >> 4), &fields->altitude);
 
                 // crude check if there is any CPR data, if either cpr_lat or cpr_lon is mostly zeros, set invalid
-                if ((self->data[7] == 0 && (self->data[8] & 0x7F) == 0) || (self->data[9] == 0 && self->data[10] == 0)) {
-                    self->valid = 0;
+                if ((data[7] == 0 && (data[8] & 0x7F) == 0) || (data[9] == 0 && data[10] == 0)) {
+                    fields->valid = 0;
                     if (0) {
                         fprintf(stderr, "%06x %02x %02x %02x %02x\n",
-                                address, self->data[7], self->data[8], self->data[9], self->data[10]);
+                                address, data[7], data[8], data[9], data[10]);
                     }
                 }
             }
@@ -477,10 +592,124 @@ static int decode(modesmessage *self)
     default:
         break;
     }
+}
+
+/* try to correct a single-bit error in a DF11 or DF17 frame that failed its CRC check.
+ * DF11 frames are assumed to have an interrogator ID of zero (all-call replies to
+ * anything else don't have a residual we can tell apart from damage), and errors
+ * in the DF field are not corrected. Returns 1 and fills in repaired (at least
+ * datalen bytes) and fields if the corrected frame is valid, 0 otherwise.
+ */
+int modesmessage_repair_fields(uint8_t *data, int datalen, uint8_t *repaired, modesfields *fields)
+{
+    modesfields repaired_fields;
+    int bit;
+
+    if (fields->valid || !fields->has_crc || (fields->df != 11 && fields->df != 17))
+        return 0;
+
+    bit = modescrc_syndrome_bit(fields->crc, datalen);
+    if (bit < 5)
+        return 0;
+
+    memcpy(repaired, data, datalen);
+    repaired[bit / 8] ^= 0x80 >> (bit % 8);
+
+    modesmessage_decode_fields(repaired, datalen, &repaired_fields);
+    if (!repaired_fields.valid)
+        return 0;
+
+    repaired_fields.repaired = 1;
+    *fields = repaired_fields;
+    return 1;
+}
+
+/* fill in a message from its decoded fields; if fields is NULL, decode the message data first */
+static int decode(modesmessage *self, modesfields *fields)
+{
+    modesfields decoded;
+
+    if (!fields) {
+        modesmessage_decode_fields(self->data, self->datalen, &decoded);
+        fields = &decoded;
+    }
+
+    /* clear state */
+    Py_CLEAR(self->crc_obj);
+    Py_CLEAR(self->address_obj);
+    Py_CLEAR(self->altitude_obj);
+
+    self->df = fields->df;
+    self->nuc = fields->nuc;
+    self->even_cpr = fields->even_cpr;
+    self->odd_cpr = fields->odd_cpr;
+    self->valid = fields->valid;
+    self->repaired = fields->repaired;
+
+    self->has_crc = fields->has_crc;
+    self->crc = fields->crc;
+    self->has_address = fields->has_address;
+    self->address = fields->address;
+    self->has_altitude = fields->has_altitude;
+    self->altitude = fields->altitude;
 
     return 0;
 }
 
+/* getters for the decoded fields; these box the value on first use and keep it */
+static PyObject *modesmessage_getcrc(modesmessage *self, void *closure)
+{
+    if (!self->has_crc)
+        Py_RETURN_NONE;
+
+    if (!self->crc_obj) {
+        if (self->addrcache && self->has_address && self->address == self->crc) {
+            /* address/parity: the residual is an address */
+            if (!(self->crc_obj = modesaddrcache_get(self->addrcache, self->crc)))
+                return NULL;
+        } else if (!(self->crc_obj = PyLong_FromLong(self->crc))) {
+            return NULL;
+        }
+    }
+
+    Py_INCREF(self->crc_obj);
+    return self->crc_obj;
+}
+
+static PyObject *modesmessage_getaddress(modesmessage *self, void *closure)
+{
+    if (!self->has_address)
+        Py_RETURN_NONE;
+
+    if (!self->address_obj) {
+        if (self->has_crc && self->address == self->crc) {
+            /* address/parity: address is the CRC residual */
+            if (!(self->address_obj = modesmessage_getcrc(self, NULL)))
+                return NULL;
+        } else if (self->addrcache) {
+            if (!(self->address_obj = modesaddrcache_get(self->addrcache, self->address)))
+                return NULL;
+        } else if (!(self->address_obj = PyLong_FromLong(self->address))) {
+            return NULL;
+        }
+    }
+
+    Py_INCREF(self->address_obj);
+    return self->address_obj;
+}
+
+static PyObject *modesmessage_getaltitude(modesmessage *self, void *closure)
+{
+    if (!self->has_altitude)
+        Py_RETURN_NONE;
+
+    if (!self->altitude_obj && !(self->altitude_obj = PyLong_FromLong(self->altitude)))
+        return NULL;
+
+    Py_INCREF(self->altitude_obj);
+    return self->altitude_obj;
+}
+
 static int modesmessage_bf_getbuffer(PyObject *self, Py_buffer *view, int flags)
 {
     return PyBuffer_FillInfo(view, self, ((modesmessage*)self)->data, ((modesmessage*)self)->datalen, 1, flags);
@@ -18,6 +18,10 @@
 
 #include "_modes.h"
 #include <stdlib.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <sys/time.h>
 
 static unsigned long long monotic_ms(void) {
@@ -30,6 +34,13 @@ static unsigned long long monotic_ms(void) {
     return mst;
 }
 
+static unsigned long long monotonic_ns(void) {
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ((unsigned long long) ts.tv_sec) * 1000000000ULL + ts.tv_nsec;
+}
+
 
 /* decoder modes */
 typedef enum {
@@ -49,6 +60,14 @@ typedef enum {
 #define MAGIC_UAT_TIMESTAMP  0xFF004D4C4155ULL
 #define OUTLIER_LIMIT 1
 
+/* timestamp checks read the system clock at the start of each feed and
+ * then once per this many frames, rather than once per frame
+ */
+#define CLOCK_SAMPLE_FRAMES 256
+
+/* per-DF settings and counters have one slot per DF, plus one (DF_MODEAC) for Mode A/C */
+#define N_DF_SLOTS (DF_MODEAC + 1)
+
 /* a modesreader object */
 typedef struct {
     PyObject_HEAD
@@ -62,6 +81,8 @@ typedef struct {
     unsigned long long last_timestamp; /* last seen timestamp */
     unsigned long long last_ts_mono; /* system time associated with last timestamp */
     unsigned long long monotonic; /* current monotonic time */
+    unsigned int clock_countdown; /* timestamp checks left before monotonic is sampled again */
+    long long jump_limit;         /* largest allowed timestamp/system clock disagreement, in timestamp units */
     unsigned int radarcape_utc_bugfix;
 
     /* count timestamp outliers, first one is ignored / message discarded / last_timestamp not updated */
@@ -78,19 +99,85 @@ typedef struct {
     char want_mlat_messages;
     char want_invalid_messages;
     char want_events;
+    char offline;                 /* decoding a file, so don't compare timestamps with the system clock */
 
     /* filtering */
-    PyObject *seen;
+    char track_seen;
+    modesseen seen;               /* aircraft seen since the last take_seen() */
+    char track_adsb;
+    modesadsb adsb;               /* per-aircraft DF17 position state */
+    char repair_crc;
+    char suppress_duplicates;
+    double duplicate_window;      /* seconds */
+    modesdedup dedup;             /* recently seen frames */
+    char has_signal;              /* does the current mode give each frame a signal level? */
+    char signal_filter;           /* is any min_signal threshold set? */
+    uint8_t min_signal[N_DF_SLOTS]; /* weakest signal accepted, per DF; DF_MODEAC for Mode A/C */
     PyObject *default_filter;
     PyObject *specific_filter;
     PyObject *modeac_filter;
+    PyObject *sync_filter;
+    modesfilter filter;           /* compiled versions of the filters above */
 
     /* stats */
     unsigned int received_messages;
     unsigned int suppressed_messages;
     unsigned int mlat_messages;
+    unsigned int timestamp_outliers;
+    unsigned int outlier_suppressed_messages;
+    unsigned int timestamp_jumps;
+    unsigned int clock_samples;
+    unsigned int duplicate_messages;
+    unsigned int weak_messages;
+    unsigned int repaired_messages;
+    unsigned int signal_histogram[256]; /* frames received at each signal level */
+
+    /* more detailed stats, only available via stats() */
+    unsigned long long df_frames[N_DF_SLOTS];  /* frames passed to the decoder, per DF */
+    unsigned long long bytes_consumed;         /* input bytes parsed */
+    unsigned long long beast_escapes;          /* escaped 0x1A bytes in Beast input */
+    unsigned long long sync_losses;            /* parse errors raised */
+    unsigned long long parse_time_ns;          /* time spent parsing and decoding */
+    /* frames dropped at each stage, besides those counted by the members above */
+    unsigned long long backwards_messages;     /* timestamp went backwards */
+    unsigned long long prefiltered_messages;   /* DF or Mode A/C code not wanted by any filter */
+    unsigned long long invalid_messages;       /* failed the CRC or other checks */
+    unsigned long long zero_timestamp_messages;
+    unsigned long long filtered_messages;      /* not wanted by the DF / address filters */
+    unsigned long long adsb_messages;          /* DF17 used for position tracking but not a sync candidate */
+
+    modesaddrcache addrcache;     /* address objects for returned messages */
 } modesreader;
 
+/* columns produced by feed_columns */
+typedef enum {
+    COLUMN_TIMESTAMP,
+    COLUMN_SIGNAL,
+    COLUMN_DF,
+    COLUMN_ADDRESS,
+    COLUMN_VALID,
+    COLUMN_DATALEN,
+    COLUMN_DATA,
+    N_COLUMNS
+} column_id;
+
+#define COLUMN_DATA_SIZE 14
+
+/* where a feed puts its results */
+typedef struct {
+    int max_messages;                /* capacity of the output */
+    int count;                       /* number of results (messages, events, rows) so far */
+
+    PyObject **messages;             /* messages and events; only events in columnar mode */
+    int n_messages;
+
+    char columnar;                   /* are frames written to columns, rather than as messages? */
+    int n_rows;
+    PyObject *columns[N_COLUMNS];    /* bytearrays holding the column data */
+
+    Py_ssize_t error_offset;         /* if the parser raised an exception, the offset of the frame it was on */
+} feed_output;
+
 /* methods for the modesreader type */
 static PyObject *modesreader_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
 static int modesreader_init(modesreader *self, PyObject *args, PyObject *kwds);
@@ -98,6 +185,18 @@ static void modesreader_dealloc(modesreader *self);
 static int modesreader_setmode(modesreader *self, PyObject *mode, void *dummy);
 static PyObject *modesreader_getmode(modesreader *self, void *dummy);
 static PyObject *modesreader_feed(modesreader *self, PyObject *args, PyObject *kwds);
+static PyObject *modesreader_feed_columns(modesreader *self, PyObject *args, PyObject *kwds);
+static PyObject *modesreader_iter_feed(modesreader *self, PyObject *args, PyObject *kwds);
+static PyObject *modesreader_set_filter(modesreader *self, PyObject *args, PyObject *kwds);
+static PyObject *modesreader_take_seen(modesreader *self);
+static PyObject *modesreader_take_adsb(modesreader *self);
+static PyObject *modesreader_take_signal_histogram(modesreader *self);
+static PyObject *modesreader_stats(modesreader *self, PyObject *args, PyObject *kwds);
+static PyObject *modesreader_drain(modesreader *self, PyObject *args, PyObject *kwds);
+static PyObject *modesreader_getfilter(modesreader *self, void *closure);
+static int modesreader_setfilter(modesreader *self, PyObject *value, void *closure);
+static PyObject *modesreader_getminsignal(modesreader *self, void *closure);
+static int modesreader_setminsignal(modesreader *self, PyObject *value, void *closure);
 
 /* modesreader fields */
 static PyMemberDef modesreaderMembers[] = {
@@ -111,25 +210,48 @@ static PyMemberDef modesreaderMembers[] = {
     { "want_mlat_messages",    T_BOOL,      offsetof(modesreader, want_mlat_messages),    0,         "should the decoder return synthetic mlat messages?" },
     { "want_invalid_messages", T_BOOL,      offsetof(modesreader, want_invalid_messages), 0,         "should the decoder return invalid messages?" },
     { "want_events",           T_BOOL,      offsetof(modesreader, want_events),           0,         "should the decoder return metadata events?" },
-    { "seen",                  T_OBJECT,    offsetof(modesreader, seen),                  0,         "set of addresses seen by the decoder" },
-    { "default_filter",        T_OBJECT,    offsetof(modesreader, default_filter),        0,         "DF accept filter for all aircraft"},
-    { "specific_filter",       T_OBJECT,    offsetof(modesreader, specific_filter),       0,         "DF accept filter for specific aircraft"},
-    { "modeac_filter",         T_OBJECT,    offsetof(modesreader, modeac_filter),         0,         "Mode A/C accept filter"},
+    { "track_seen",            T_BOOL,      offsetof(modesreader, track_seen),            0,         "should the decoder record aircraft seen for take_seen()?" },
+    { "track_adsb",            T_BOOL,      offsetof(modesreader, track_adsb),            0,         "should the decoder track DF17 positions, and only return DF17 sync candidates?" },
+    { "repair_crc",            T_BOOL,      offsetof(modesreader, repair_crc),            0,         "should the decoder correct single-bit errors in DF11/DF17 frames?" },
+    { "suppress_duplicates",   T_BOOL,      offsetof(modesreader, suppress_duplicates),   0,         "should the decoder drop repeats of recently seen frames?" },
+    { "duplicate_window",      T_DOUBLE,    offsetof(modesreader, duplicate_window),      0,         "largest timestamp difference, in seconds, between a frame and its repeat" },
     { "received_messages",     T_UINT,      offsetof(modesreader, received_messages),     0,         "total number of messages decoded"},
     { "suppressed_messages",   T_UINT,      offsetof(modesreader, suppressed_messages),   0,         "number of messages suppressed by filtering"},
     { "mlat_messages",         T_UINT,      offsetof(modesreader, mlat_messages),         0,         "number of incoming MLAT messages received (and ignored)"},
+    { "timestamp_outliers",    T_UINT,      offsetof(modesreader, timestamp_outliers),    0,         "number of timestamps that disagreed with the system clock"},
+    { "outlier_suppressed_messages", T_UINT, offsetof(modesreader, outlier_suppressed_messages), 0, "number of messages suppressed because the timestamp was an outlier"},
+    { "timestamp_jumps",       T_UINT,      offsetof(modesreader, timestamp_jumps),       0,         "number of timestamp jump events generated"},
+    { "duplicate_messages",    T_UINT,      offsetof(modesreader, duplicate_messages),    0,         "number of repeated frames suppressed"},
+    { "weak_messages",         T_UINT,      offsetof(modesreader, weak_messages),         0,         "number of messages suppressed because the signal was below min_signal"},
+    { "repaired_messages",     T_UINT,      offsetof(modesreader, repaired_messages),     0,         "number of messages with a single-bit error that was corrected"},
+    { "clock_samples",         T_UINT,      offsetof(modesreader, clock_samples),         0,         "number of times the system clock was read for timestamp checks"},
+    { "address_cache_hits",    T_UINT,      offsetof(modesreader, addrcache.hits),        0,         "number of message addresses found in the address cache"},
+    { "address_cache_misses",  T_UINT,      offsetof(modesreader, addrcache.misses),      0,         "number of message addresses not found in the address cache"},
     { NULL, 0, 0, 0, NULL }
 };
 
-/* .. and the mode field which has a special getter/setter */
+/* .. and the mode and filter fields which have special getters/setters */
 static PyGetSetDef modesreaderGetSet[] = {
     { "mode", (getter)modesreader_getmode, (setter)modesreader_setmode, "decoder mode", NULL },
+    { "default_filter", (getter)modesreader_getfilter, (setter)modesreader_setfilter, "DF accept filter for all aircraft", "default" },
+    { "specific_filter", (getter)modesreader_getfilter, (setter)modesreader_setfilter, "DF accept filter for specific aircraft", "specific" },
+    { "modeac_filter", (getter)modesreader_getfilter, (setter)modesreader_setfilter, "Mode A/C accept filter", "modeac" },
+    { "sync_filter", (getter)modesreader_getfilter, (setter)modesreader_setfilter, "DF17 sync candidate filter, used with track_adsb", "sync" },
+    { "min_signal", (getter)modesreader_getminsignal, (setter)modesreader_setminsignal, "weakest signal level accepted, per DF (Beast and Radarcape modes only)", NULL },
     { NULL, NULL, NULL, NULL, NULL }
 };
 
 /* modesreader methods */
 static PyMethodDef modesreaderMethods[] = {
     { "feed", (PyCFunction)modesreader_feed, METH_VARARGS|METH_KEYWORDS, "Process and decode some data." },
+    { "feed_columns", (PyCFunction)modesreader_feed_columns, METH_VARARGS|METH_KEYWORDS, "Process and decode some data into typed column arrays." },
+    { "iter_feed", (PyCFunction)modesreader_iter_feed, METH_VARARGS|METH_KEYWORDS, "Return an iterator that decodes some data one message at a time." },
+    { "set_filter", (PyCFunction)modesreader_set_filter, METH_VARARGS|METH_KEYWORDS, "Install some or all of default_filter, specific_filter, modeac_filter, sync_filter at once." },
+    { "drain", (PyCFunction)modesreader_drain, METH_VARARGS|METH_KEYWORDS, "Process and decode frames queued by a ReaderThread." },
+    { "take_seen", (PyCFunction)modesreader_take_seen, METH_NOARGS, "Return and reset the per-aircraft counts of DF11/17/18 messages seen." },
+    { "take_adsb", (PyCFunction)modesreader_take_adsb, METH_NOARGS, "Return the per-aircraft ADS-B position state, and reset the position counts." },
+    { "take_signal_histogram", (PyCFunction)modesreader_take_signal_histogram, METH_NOARGS, "Return and reset the count of frames received at each signal level." },
+    { "stats", (PyCFunction)modesreader_stats, METH_VARARGS|METH_KEYWORDS, "Return a dict of decoder statistics, optionally resetting them." },
     { NULL, NULL, 0, NULL }
 };
 
@@ -190,14 +312,45 @@ static struct {
     { DECODER_NONE,                   NULL, NULL }
 };
 
+/* names, buffer formats and per-row sizes of the feed_columns columns */
+static struct {
+    const char *name;
+    const char *format;
+    int size;
+} columntable[N_COLUMNS] = {
+    { "timestamp", "Q", sizeof(uint64_t) },                  /* COLUMN_TIMESTAMP */
+    { "signal",    "B", sizeof(uint8_t) },                   /* COLUMN_SIGNAL */
+    { "df",        "B", sizeof(uint8_t) },                   /* COLUMN_DF */
+    { "address",   "I", sizeof(uint32_t) },                  /* COLUMN_ADDRESS */
+    { "valid",     "B", sizeof(uint8_t) },                   /* COLUMN_VALID */
+    { "datalen",   "B", sizeof(uint8_t) },                   /* COLUMN_DATALEN */
+    { "data",      "B", COLUMN_DATA_SIZE * sizeof(uint8_t) } /* COLUMN_DATA */
+};
+
 /* internal helpers */
-static PyObject *feed_beast(modesreader *self, Py_buffer *buf, int max_messages);
-static PyObject *feed_avr(modesreader *self, Py_buffer *buf, int max_messages);
-static PyObject *feed_sbs(modesreader *self, Py_buffer *buf, int max_messages);
+static PyObject *feed_beast(modesreader *self, Py_buffer *buf, Py_ssize_t start, Py_ssize_t end, feed_output *out);
+static PyObject *feed_avr(modesreader *self, Py_buffer *buf, Py_ssize_t start, Py_ssize_t end, feed_output *out);
+static PyObject *feed_sbs(modesreader *self, Py_buffer *buf, Py_ssize_t start, Py_ssize_t end, feed_output *out);
+static void init_hexvalues(void);
 static void set_decoder_mode(modesreader *self, decoder_mode newmode);
+static void sample_clock(modesreader *self);
+static void reset_stats(modesreader *self);
 static PyObject *radarcape_settings_to_list(uint8_t settings);
 static PyObject *radarcape_status_to_dict(uint8_t *message);
-static int filter_message(modesreader *self, PyObject *message);
+static int prefilter_message(modesreader *self, unsigned long long timestamp, uint8_t *data, int datalen);
+static int filter_message(modesreader *self, unsigned long long timestamp, modesfields *fields);
+static int track_position(modesreader *self, unsigned long long timestamp, unsigned signal, uint8_t *data, modesfields *fields, modesadsbentry **sync_entry);
+static PyObject *feed_common(modesreader *self, PyObject *args, PyObject *kwds, int columnar);
+static PyObject *feed_dispatch(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out);
+static PyObject *feed_parse(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out);
+static PyTypeObject modesfiledecoderType;
+static PyTypeObject modesfeediterType;
+static void output_clear(feed_output *out);
+static int output_init(feed_output *out, int max_messages, int columnar);
+static void output_free(feed_output *out);
+static int output_event(feed_output *out, PyObject *event);
+static int output_frame(modesreader *self, feed_output *out, unsigned long long timestamp, unsigned signal, uint8_t *data, int datalen);
+static PyObject *output_result(feed_output *out, Py_ssize_t offset, int error_pending);
 
 /*
  * module setup/teardown
@@ -209,6 +362,14 @@ int modesreader_module_init(PyObject *m)
     if (PyType_Ready(&modesreaderType) < 0)
         goto error;
 
+    if (PyType_Ready(&modesfiledecoderType) < 0)
+        goto error;
+
+    if (PyType_Ready(&modesfeediterType) < 0)
+        goto error;
+
+    init_hexvalues();
+
     for (i = 0; modetable[i].cstr != NULL; ++i) {
         PyObject *pystr = PyUnicode_FromString(modetable[i].cstr);
         if (pystr == NULL) {
@@ -258,29 +419,52 @@ static PyObject *modesreader_new(PyTypeObject *type, PyObject *args, PyObject *k
     self->last_timestamp = 0;
     self->last_ts_mono = 0;
     self->monotonic = 0;
+    self->clock_countdown = 0;
     self->outliers = 0;
     self->allow_mode_change = 1;
     self->want_zero_timestamps = 0;
     self->want_mlat_messages = 0;
     self->want_invalid_messages = 0;
     self->want_events = 1;
-
-    Py_INCREF(Py_None); self->seen = Py_None;
+    self->offline = 0;
+
+    self->track_seen = 0;
+    modesseen_init(&self->seen);
+    self->track_adsb = 0;
+    modesadsb_init(&self->adsb);
+    self->repair_crc = 0;
+    self->suppress_duplicates = 0;
+    self->duplicate_window = 0.0;
+    modesdedup_init(&self->dedup);
+    self->signal_filter = 0;
+    memset(self->min_signal, 0, sizeof(self->min_signal));
+    modesaddrcache_init(&self->addrcache);
     Py_INCREF(Py_None); self->default_filter = Py_None;
     Py_INCREF(Py_None); self->specific_filter = Py_None;
     Py_INCREF(Py_None); self->modeac_filter = Py_None;
+    Py_INCREF(Py_None); self->sync_filter = Py_None;
+    modesfilter_init(&self->filter);
 
     self->received_messages = self->suppressed_messages = self->mlat_messages = 0;
+    self->timestamp_outliers = self->outlier_suppressed_messages = self->timestamp_jumps = self->clock_samples = 0;
+    self->duplicate_messages = self->weak_messages = self->repaired_messages = 0;
+    memset(self->signal_histogram, 0, sizeof(self->signal_histogram));
+    reset_stats(self);
 
     return (PyObject *)self;
 }
 
 static void modesreader_dealloc(modesreader *self)
 {
-    Py_CLEAR(self->seen);
+    modesseen_free(&self->seen);
+    modesadsb_free(&self->adsb);
+    modesdedup_free(&self->dedup);
+    modesaddrcache_clear(&self->addrcache);
     Py_CLEAR(self->default_filter);
     Py_CLEAR(self->specific_filter);
     Py_CLEAR(self->modeac_filter);
+    Py_CLEAR(self->sync_filter);
+    modesfilter_free(&self->filter);
 
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
@@ -342,10 +526,386 @@ static PyObject *modesreader_getmode(modesreader *self, void *dummy)
     return Py_None;
 }
 
+/* getter for default_filter / specific_filter / modeac_filter / sync_filter */
+static PyObject *modesreader_getfilter(modesreader *self, void *closure)
+{
+    PyObject *value;
+
+    if (!strcmp(closure, "default"))
+        value = self->default_filter;
+    else if (!strcmp(closure, "specific"))
+        value = self->specific_filter;
+    else if (!strcmp(closure, "modeac"))
+        value = self->modeac_filter;
+    else
+        value = self->sync_filter;
+
+    Py_INCREF(value);
+    return value;
+}
+
+/* make an immutable copy of a filter that has been compiled: a tuple for the
+ * default filter, a tuple of frozensets (or None) for the specific filter,
+ * and a frozenset for the Mode A/C and sync filters
+ */
+static PyObject *freeze_filter(const char *which, PyObject *value)
+{
+    PyObject *frozen;
+    Py_ssize_t i, n;
+
+    if (value == Py_None) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+
+    if (!strcmp(which, "default"))
+        return PySequence_Tuple(value);
+
+    if (strcmp(which, "specific"))
+        return PyFrozenSet_New(value);
+
+    if (! (frozen = PySequence_Tuple(value)))
+        return NULL;
+
+    n = PyTuple_GET_SIZE(frozen);
+    for (i = 0; i < n; ++i) {
+        PyObject *entry = PyTuple_GET_ITEM(frozen, i);
+        PyObject *addresses;
+
+        if (entry == Py_None)
+            continue;
+
+        if (! (addresses = PyFrozenSet_New(entry))) {
+            Py_DECREF(frozen);
+            return NULL;
+        }
+
+        /* the tuple is new and not shared yet, so it can still be filled in */
+        PyTuple_SET_ITEM(frozen, i, addresses);
+        Py_DECREF(entry);
+    }
+
+    return frozen;
+}
+
+/* install a filter: compile it, and keep an immutable copy so it can be read back.
+ * The reader uses a snapshot of the filter contents; install the filter again to change it.
+ */
+static int install_filter(modesreader *self, const char *which, PyObject *value)
+{
+    PyObject **slot, *frozen;
+    int rv;
+
+    if (value == NULL)
+        value = Py_None;
+
+    if (!strcmp(which, "default")) {
+        slot = &self->default_filter;
+        rv = modesfilter_compile_default(&self->filter, value);
+    } else if (!strcmp(which, "specific")) {
+        slot = &self->specific_filter;
+        rv = modesfilter_compile_specific(&self->filter, value);
+    } else if (!strcmp(which, "modeac")) {
+        slot = &self->modeac_filter;
+        rv = modesfilter_compile_modeac(&self->filter, value);
+    } else {
+        slot = &self->sync_filter;
+        rv = modesfilter_compile_sync(&self->filter, value);
+    }
+
+    if (rv < 0)
+        return -1;
+
+    if (! (frozen = freeze_filter(which, value)))
+        return -1;
+
+    Py_XSETREF(*slot, frozen);
+    return 0;
+}
+
+static int modesreader_setfilter(modesreader *self, PyObject *value, void *closure)
+{
+    return install_filter(self, closure, value);
+}
+
+/* set_filter(default_filter=..., specific_filter=..., modeac_filter=..., sync_filter=...)
+ * installs the given filters; filters that are not mentioned are left unchanged.
+ */
+static PyObject *modesreader_set_filter(modesreader *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "default_filter", "specific_filter", "modeac_filter", "sync_filter", NULL };
+    PyObject *default_filter = NULL, *specific_filter = NULL, *modeac_filter = NULL, *sync_filter = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|OOOO", kwlist, &default_filter, &specific_filter, &modeac_filter, &sync_filter))
+        return NULL;
+
+    if (default_filter && install_filter(self, "default", default_filter) < 0)
+        return NULL;
+    if (specific_filter && install_filter(self, "specific", specific_filter) < 0)
+        return NULL;
+    if (modeac_filter && install_filter(self, "modeac", modeac_filter) < 0)
+        return NULL;
+    if (sync_filter && install_filter(self, "sync", sync_filter) < 0)
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+/* getter for min_signal: None if no threshold is set, otherwise a list with
+ * the threshold for each DF followed by the threshold for Mode A/C
+ */
+static PyObject *modesreader_getminsignal(modesreader *self, void *closure)
+{
+    PyObject *list;
+    int i;
+
+    if (!self->signal_filter)
+        Py_RETURN_NONE;
+
+    if (! (list = PyList_New(N_DF_SLOTS)))
+        return NULL;
+
+    for (i = 0; i < N_DF_SLOTS; ++i) {
+        PyObject *value = PyLong_FromLong(self->min_signal[i]);
+        if (!value) {
+            Py_DECREF(list);
+            return NULL;
+        }
+        PyList_SET_ITEM(list, i, value);
+    }
+
+    return list;
+}
+
+/* parse one min_signal threshold: None (no threshold) or a signal level 0..255 */
+static int parse_min_signal(PyObject *value, uint8_t *threshold)
+{
+    long level;
+
+    if (value == Py_None) {
+        *threshold = 0;
+        return 0;
+    }
+
+    level = PyLong_AsLong(value);
+    if (level == -1 && PyErr_Occurred())
+        return -1;
+
+    if (level < 0 || level > 255) {
+        PyErr_SetString(PyExc_ValueError, "signal thresholds must be between 0 and 255");
+        return -1;
+    }
+
+    *threshold = (uint8_t) level;
+    return 0;
+}
+
+/* setter for min_signal. Accepts None (accept everything), a single level
+ * that applies to all DFs and Mode A/C, or a sequence indexed by DF whose
+ * entries are levels or None; an entry at index DF_MODEAC applies to Mode A/C.
+ * Frames weaker than the threshold for their DF are dropped before decoding.
+ */
+static int modesreader_setminsignal(modesreader *self, PyObject *value, void *closure)
+{
+    uint8_t thresholds[N_DF_SLOTS];
+    int i;
+
+    if (value == NULL || value == Py_None) {
+        memset(thresholds, 0, sizeof(thresholds));
+    } else if (PyLong_Check(value)) {
+        if (parse_min_signal(value, &thresholds[0]) < 0)
+            return -1;
+        memset(thresholds, thresholds[0], sizeof(thresholds));
+    } else {
+        PyObject *seq;
+        Py_ssize_t n;
+
+        if (! (seq = PySequence_Fast(value, "min_signal must be None, an integer, or a sequence")))
+            return -1;
+
+        n = PySequence_Fast_GET_SIZE(seq);
+        if (n > N_DF_SLOTS) {
+            PyErr_Format(PyExc_ValueError, "min_signal has more than %d entries", N_DF_SLOTS);
+            Py_DECREF(seq);
+            return -1;
+        }
+
+        memset(thresholds, 0, sizeof(thresholds));
+        for (i = 0; i < n; ++i) {
+            if (parse_min_signal(PySequence_Fast_GET_ITEM(seq, i), &thresholds[i]) < 0) {
+                Py_DECREF(seq);
+                return -1;
+            }
+        }
+
+        Py_DECREF(seq);
+    }
+
+    memcpy(self->min_signal, thresholds, sizeof(thresholds));
+    self->signal_filter = 0;
+    for (i = 0; i < N_DF_SLOTS; ++i)
+        if (thresholds[i])
+            self->signal_filter = 1;
+
+    return 0;
+}
+
+/* take_signal_histogram(): return a list of 256 counts of the frames
+ * received at each signal level since the last call, and reset the counts.
+ * Only frames from formats that carry a signal level are counted.
+ */
+static PyObject *modesreader_take_signal_histogram(modesreader *self)
+{
+    PyObject *list;
+    int i;
+
+    if (! (list = PyList_New(256)))
+        return NULL;
+
+    for (i = 0; i < 256; ++i) {
+        PyObject *count = PyLong_FromUnsignedLong(self->signal_histogram[i]);
+        if (!count) {
+            Py_DECREF(list);
+            return NULL;
+        }
+        PyList_SET_ITEM(list, i, count);
+    }
+
+    memset(self->signal_histogram, 0, sizeof(self->signal_histogram));
+    return list;
+}
+
+/* zero the counters reported by stats() */
+static void reset_stats(modesreader *self)
+{
+    self->received_messages = self->suppressed_messages = self->mlat_messages = 0;
+    self->timestamp_outliers = self->outlier_suppressed_messages = self->timestamp_jumps = 0;
+    self->duplicate_messages = self->weak_messages = self->repaired_messages = 0;
+    self->clock_samples = self->addrcache.hits = self->addrcache.misses = 0;
+
+    memset(self->df_frames, 0, sizeof(self->df_frames));
+    self->bytes_consumed = self->beast_escapes = self->sync_losses = self->parse_time_ns = 0;
+    self->backwards_messages = self->prefiltered_messages = self->invalid_messages = 0;
+    self->zero_timestamp_messages = self->filtered_messages = self->adsb_messages = 0;
+}
+
+/* stats(reset=False): return a dict of decoder statistics:
+ *
+ *   frames              dict of DF -> frames passed to the decoder (DF_MODEAC for Mode A/C)
+ *   received, suppressed, repaired, timestamp_outliers, timestamp_jumps, clock_samples
+ *                       as the corresponding members
+ *   address_cache       dict of hits, misses: address lookups in the address cache
+ *   bytes               input bytes parsed by feed() and friends
+ *   escapes             escaped 0x1A bytes seen in Beast input
+ *   sync_losses         parse errors raised
+ *   dropped             dict of stage -> frames dropped there; these add up to suppressed
+ *   parse_time          seconds spent in feed() and friends
+ *
+ * If reset is true, all of these (and the member counters they include)
+ * start again from zero.
+ */
+static PyObject *modesreader_stats(modesreader *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "reset", NULL };
+    PyObject *frames = NULL, *dropped = NULL, *address_cache = NULL, *rv = NULL;
+    int reset = 0, i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p", kwlist, &reset))
+        return NULL;
+
+    if (! (frames = PyDict_New()))
+        goto out;
+
+    for (i = 0; i < N_DF_SLOTS; ++i) {
+        PyObject *key, *count;
+        int res;
+
+        if (!self->df_frames[i])
+            continue;
+
+        key = PyLong_FromLong(i);
+        count = PyLong_FromUnsignedLongLong(self->df_frames[i]);
+        res = (key && count) ? PyDict_SetItem(frames, key, count) : -1;
+        Py_XDECREF(key);
+        Py_XDECREF(count);
+        if (res < 0)
+            goto out;
+    }
+
+    dropped = Py_BuildValue("{s:I,s:I,s:I,s:I,s:K,s:K,s:K,s:K,s:K,s:K}",
+                            "duplicate", self->duplicate_messages,
+                            "weak", self->weak_messages,
+                            "mlat", self->mlat_messages,
+                            "outlier", self->outlier_suppressed_messages,
+                            "backwards", self->backwards_messages,
+                            "prefilter", self->prefiltered_messages,
+                            "invalid", self->invalid_messages,
+                            "zero_timestamp", self->zero_timestamp_messages,
+                            "filter", self->filtered_messages,
+                            "adsb", self->adsb_messages);
+    if (!dropped)
+        goto out;
+
+    address_cache = Py_BuildValue("{s:I,s:I}",
+                                  "hits", self->addrcache.hits,
+                                  "misses", self->addrcache.misses);
+    if (!address_cache)
+        goto out;
+
+    rv = Py_BuildValue("{s:O,s:I,s:I,s:I,s:I,s:I,s:I,s:K,s:K,s:K,s:O,s:O,s:d}",
+                       "frames", frames,
+                       "received", self->received_messages,
+                       "suppressed", self->suppressed_messages,
+                       "repaired", self->repaired_messages,
+                       "timestamp_outliers", self->timestamp_outliers,
+                       "timestamp_jumps", self->timestamp_jumps,
+                       "clock_samples", self->clock_samples,
+                       "bytes", self->bytes_consumed,
+                       "escapes", self->beast_escapes,
+                       "sync_losses", self->sync_losses,
+                       "dropped", dropped,
+                       "address_cache", address_cache,
+                       "parse_time", self->parse_time_ns / 1e9);
+    if (rv && reset)
+        reset_stats(self);
+
+ out:
+    Py_XDECREF(frames);
+    Py_XDECREF(dropped);
+    Py_XDECREF(address_cache);
+    return rv;
+}
+
+/* take_seen(): return a dict of typed memoryviews (address, count, df_mask,
+ * first_timestamp, last_timestamp), one row per aircraft seen since the
+ * last call, and start again with an empty table.
+ */
+static PyObject *modesreader_take_seen(modesreader *self)
+{
+    return modesseen_take(&self->seen);
+}
+
+/* take_adsb(): return a dict of typed memoryviews (address, positions,
+ * even_age, odd_age), one row per aircraft tracked by track_adsb. positions
+ * counts the usable positions since the last call; the ages are the times in
+ * seconds since the last usable even/odd position, or infinity.
+ */
+static PyObject *modesreader_take_adsb(modesreader *self)
+{
+    return modesadsb_take(&self->adsb, monotic_ms());
+}
+
 /* feed some data to the reader and does one of:
- *  1) returns a tuple (bytes_consumed, messages, error_pending), or
+ *  1) returns a tuple (offset, messages, error_pending), or
  *  2) throws an exception
  *
+ * Only the bytes between the start and end offsets of the buffer
+ * are parsed (by default, the whole buffer). The returned offset is
+ * the offset within the buffer of the first unconsumed byte, so a
+ * caller that keeps a receive buffer around (e.g. a bytearray filled
+ * by recv_into) can pass it back in with start set to that offset once
+ * more data has arrived, without copying any residual data.
+ *
  * If a stream error is seen, but some messages were parsed OK,
  * then an exception is not immediately thrown and the parsed
  * messages are returned with error_pending = True. The caller
@@ -355,15 +915,38 @@ static PyObject *modesreader_getmode(modesreader *self, void *dummy)
  * Internal errors (e.g. out of memory) are thrown immediately.
  */
 static PyObject *modesreader_feed(modesreader *self, PyObject *args, PyObject *kwds)
+{
+    return feed_common(self, args, kwds, 0);
+}
+
+/* feed some data to the reader, like feed(), but instead of building a
+ * Message for each decoded frame, write the frames into typed column
+ * arrays. Returns a tuple (offset, columns, events, error_pending) where
+ * columns is a dict of memoryviews, one per column, that all have one
+ * element per decoded frame (the "data" column has 14 bytes per frame,
+ * left-aligned and zero-padded; see the "datalen" column for the actual
+ * length). events is a tuple of any event messages generated.
+ */
+static PyObject *modesreader_feed_columns(modesreader *self, PyObject *args, PyObject *kwds)
+{
+    return feed_common(self, args, kwds, 1);
+}
+
+/* common implementation of feed() and feed_columns() */
+static PyObject *feed_common(modesreader *self, PyObject *args, PyObject *kwds, int columnar)
 {
     Py_buffer buffer;
     PyObject *rv = NULL;
     int max_messages = 0;
-    static char *kwlist[] = { "buffer", "max_messages", NULL };
+    Py_ssize_t start = 0, end = -1;
+    feed_output out;
+    static char *kwlist[] = { "buffer", "max_messages", "start", "end", NULL };
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*|i", kwlist, &buffer, &max_messages))
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*|inn", kwlist, &buffer, &max_messages, &start, &end))
         return NULL;
 
+    output_clear(&out);
+
     if (buffer.itemsize != 1) {
         PyErr_SetString(PyExc_ValueError, "buffer itemsize is not 1");
         goto out;
@@ -374,34 +957,90 @@ static PyObject *modesreader_feed(modesreader *self, PyObject *args, PyObject *k
         goto out;
     }
 
+    if (end < 0)
+        end = buffer.len;
+
+    if (start < 0 || start > end || end > buffer.len) {
+        PyErr_SetString(PyExc_ValueError, "start/end offsets out of range");
+        goto out;
+    }
+
+    if (max_messages <= 0) {
+        /* allocate the maximum size we might need, given a minimal encoding of: */
+        switch (self->decoder_mode) {
+        case DECODER_BEAST:
+        case DECODER_RADARCAPE:
+        case DECODER_RADARCAPE_EMULATED:
+            /*   <1A> <'1'> <6 bytes timestamp> <1 byte signal> <2 bytes message> = 11 bytes total */
+            max_messages = (end - start) / 11 + 2;
+            break;
+        case DECODER_SBS:
+            /*   <DLE> <STX> <0x09> <n/a> <3 bytes timestamp> <2 bytes message> <DLE> <ETX> <2 bytes CRC> = 13 bytes total */
+            max_messages = (end - start) / 13 + 1;
+            break;
+        default:
+            /*   '*' <2 bytes message> ';' LF */
+            max_messages = (end - start) / 5 + 1;
+            break;
+        }
+    }
+
+    if (output_init(&out, max_messages, columnar) < 0)
+        goto out;
+
+    sample_clock(self);
+    rv = feed_dispatch(self, &buffer, start, end, &out);
+
+ out:
+    output_free(&out);
+    PyBuffer_Release(&buffer);
+    return rv;
+}
+
+/* run the parser for the current decoder mode over buffer[start:end],
+ * and account for the bytes and time it used
+ */
+static PyObject *feed_dispatch(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out)
+{
+    unsigned long long started = monotonic_ns();
+    PyObject *rv = feed_parse(self, buffer, start, end, out);
+
+    self->parse_time_ns += monotonic_ns() - started;
+    if (rv) {
+        self->bytes_consumed += PyLong_AsSsize_t(PyTuple_GET_ITEM(rv, 0)) - start;
+    } else {
+        if (out->error_offset > start)
+            self->bytes_consumed += out->error_offset - start;
+        if (PyErr_ExceptionMatches(PyExc_ValueError))
+            ++self->sync_losses;
+    }
+
+    return rv;
+}
+
+static PyObject *feed_parse(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out)
+{
     switch (self->decoder_mode) {
     case DECODER_NONE:
         PyErr_SetString(PyExc_NotImplementedError, "decoder mode is None, no decoder type selected");
-        break;
+        return NULL;
 
     case DECODER_BEAST:
     case DECODER_RADARCAPE:
     case DECODER_RADARCAPE_EMULATED:
-        rv = feed_beast(self, &buffer, max_messages);
-        break;
+        return feed_beast(self, buffer, start, end, out);
 
     case DECODER_AVR:
     case DECODER_AVRMLAT:
-        rv = feed_avr(self, &buffer, max_messages);
-        break;
+        return feed_avr(self, buffer, start, end, out);
 
     case DECODER_SBS:
-        rv = feed_sbs(self, &buffer, max_messages);
-        break;
+        return feed_sbs(self, buffer, start, end, out);
 
     default:
         PyErr_Format(PyExc_AssertionError, "decoder somehow got into illegal mode %d", (int)self->decoder_mode);
-        break;
+        return NULL;
     }
-
- out:
-    PyBuffer_Release(&buffer);
-    return rv;
 }
 
 static void set_decoder_mode(modesreader *self, decoder_mode newmode)
@@ -439,6 +1078,9 @@ static void set_decoder_mode(modesreader *self, decoder_mode newmode)
         self->epoch = NULL;
         break;
     }
+
+    self->jump_limit = self->frequency + self->frequency / 4; /* 1.25 seconds */
+    self->has_signal = (newmode == DECODER_BEAST || newmode == DECODER_RADARCAPE || newmode == DECODER_RADARCAPE_EMULATED);
 }
 
 /* turn a radarcape DIP switch setting byte into a Python list of settings strings */
@@ -491,6 +1133,7 @@ static PyObject *make_timestamp_jump_event(modesreader *self, unsigned long long
     if (eventdata == NULL)
         return NULL;
 
+    ++self->timestamp_jumps;
     return modesmessage_new_eventmessage(DF_EVENT_TIMESTAMP_JUMP, timestamp, eventdata);
 }
 
@@ -564,26 +1207,41 @@ static int is_synthetic_timestamp(unsigned long long timestamp)
     return (timestamp == 0 || (timestamp >= MAGIC_MLAT_TIMESTAMP && timestamp <= MAGIC_MLAT_TIMESTAMP + 10));
 }
 
+/* read the system clock into self->monotonic */
+static void sample_clock(modesreader *self)
+{
+    self->monotonic = monotic_ms();
+    self->clock_countdown = CLOCK_SAMPLE_FRAMES;
+    ++self->clock_samples;
+}
+
 /* check if the given timestamp is in range (not a jump), return 1 if it is */
 static int timestamp_check(modesreader *self, unsigned long long timestamp)
 {
     if (is_synthetic_timestamp(timestamp))
         return 1;
 
-    if (self->frequency == 0)
+    if (self->frequency == 0 || self->offline)
         return 1;
 
-    self->monotonic = monotic_ms(); // update system time
+    /* the clock was sampled when the feed started; within a feed only
+     * resample it occasionally, as frames arrive much faster than the
+     * 1.25 second tolerance could notice
+     */
+    if (self->clock_countdown == 0)
+        sample_clock(self);
+    --self->clock_countdown;
 
     if (self->last_timestamp == 0)
         return 1;
 
-
     long long ts_elapsed = (long long) timestamp - (long long) self->last_timestamp;
-    long long sys_elapsed = (self->monotonic - self->last_ts_mono) * (self->frequency / 1000);
-    long long max_offset = 1.25 * self->frequency; // 1.25 seconds
+    long long sys_elapsed = 0;
+    if (self->monotonic != self->last_ts_mono)
+        sys_elapsed = (long long) (self->monotonic - self->last_ts_mono) * (long long) (self->frequency / 1000);
 
-    if (ts_elapsed > sys_elapsed + max_offset || ts_elapsed < sys_elapsed - max_offset) {
+    if (ts_elapsed > sys_elapsed + self->jump_limit || ts_elapsed < sys_elapsed - self->jump_limit) {
+        ++self->timestamp_outliers;
         self->outliers++;
         if (self->outliers > OUTLIER_LIMIT) {
             if (self->monotonic > self->outlierNoSpam) {
@@ -647,343 +1305,713 @@ static void timestamp_update(modesreader *self, unsigned long long timestamp)
     self->last_ts_mono = self->monotonic;
 }
 
-/* feed implementation for Beast-format data (including Radarcape) */
-static PyObject *feed_beast(modesreader *self, Py_buffer *buffer, int max_messages)
+/********** FEED OUTPUT **************/
+
+/* minimal init so output_free works */
+static void output_clear(feed_output *out)
 {
-    PyObject *rv = NULL;
-    uint8_t *buffer_start, *p, *eod;
-    int message_count = 0;
-    PyObject *message_tuple = NULL;
-    PyObject **messages = NULL;
-    int error_pending = 0;
+    int i;
 
-    buffer_start = buffer->buf;
+    out->max_messages = out->count = 0;
+    out->messages = NULL;
+    out->n_messages = 0;
+    out->columnar = 0;
+    out->n_rows = 0;
+    for (i = 0; i < N_COLUMNS; ++i)
+        out->columns[i] = NULL;
+    out->error_offset = 0;
+}
 
-    if (max_messages <= 0) {
-        /* allocate the maximum size we might need, given a minimal encoding of:
-         *   <1A> <'1'> <6 bytes timestamp> <1 byte signal> <2 bytes message> = 11 bytes total
-         */
-        max_messages = buffer->len / 11 + 2;
-    }
+/* prepare an output with space for up to max_messages results */
+static int output_init(feed_output *out, int max_messages, int columnar)
+{
+    int i;
 
-    messages = calloc(max_messages, sizeof(PyObject*));
-    if (!messages) {
+    output_clear(out);
+    out->max_messages = max_messages;
+    out->columnar = columnar;
+
+    out->messages = calloc(max_messages, sizeof(PyObject*));
+    if (!out->messages) {
         PyErr_NoMemory();
-        goto out;
+        return -1;
     }
 
-    /* parse messages */
-    p = buffer_start;
-    eod = buffer_start + buffer->len;
-    while (p+2 <= eod && message_count+2 < max_messages) {
-        int message_len = -1;
-        uint64_t timestamp;
-        uint8_t signal;
-        uint8_t data[14];
-        uint8_t *m, *eom;
-        int i;
-        uint8_t type;
-        PyObject *message;
-        int wanted;
-        int has_timestamp_signal;
-
-        if (p[0] != 0x1a) {
-            error_pending = 1;
-            if (message_count > 0)
-                goto nomoredata;
-            PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected a 0x1A marker at offset %d but found 0x%02x instead", (int) (p - buffer_start), (int)p[0]);
-            goto out;
+    if (columnar) {
+        for (i = 0; i < N_COLUMNS; ++i) {
+            if (!(out->columns[i] = PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)max_messages * columntable[i].size)))
+                return -1;
         }
+    }
 
-        has_timestamp_signal = 1;
-        type = p[1];
-        switch (type) {
-        case '1': message_len = 2; break; /* mode A/C */
-        case '2': message_len = 7; break; /* mode S short */
-        case '3': message_len = 14; break; /* mode S long */
-        case '4': message_len = 14; break; /* radarcape status message */
-        case '5':
-            /* radarcape position message, no timestamp/signal bytes */
-            message_len = 21;
-            has_timestamp_signal = 0;
-            break;
-        default:
-            error_pending = 1;
-            if (message_count > 0)
-                goto nomoredata;
-            PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected message type 0x%02x after 0x1A marker at offset %d", (int)p[1], (int) (p - buffer_start));
-            goto out;
+    return 0;
+}
+
+static void output_free(feed_output *out)
+{
+    int i;
+
+    while (--out->n_messages >= 0) {
+        Py_XDECREF(out->messages[out->n_messages]);
+    }
+    free(out->messages);
+    out->messages = NULL;
+    out->n_messages = 0;
+
+    for (i = 0; i < N_COLUMNS; ++i) {
+        Py_CLEAR(out->columns[i]);
+    }
+}
+
+/* add an event message to the output, stealing a reference to it.
+ * if event is NULL, returns -1 (and the exception raised while
+ * building the event is left in place)
+ */
+static int output_event(feed_output *out, PyObject *event)
+{
+    if (!event)
+        return -1;
+
+    out->messages[out->n_messages++] = event;
+    ++out->count;
+    return 0;
+}
+
+/* decode a Mode S / Mode A/C frame, apply filters, update the seen table,
+ * and add the frame to the output if it is wanted
+ */
+static int output_frame(modesreader *self, feed_output *out, unsigned long long timestamp, unsigned signal, uint8_t *data, int datalen)
+{
+    modesfields fields;
+    modesadsbentry *sync_entry = NULL;
+    uint8_t repaired[14];
+    int wanted;
+
+    ++self->received_messages;
+    if (datalen == 2)
+        ++self->df_frames[DF_MODEAC];
+    else if (datalen >= 1)
+        ++self->df_frames[(data[0] >> 3) & 31];
+
+    /* drop weak frames before doing any other work on the frame */
+    if (self->has_signal) {
+        ++self->signal_histogram[signal & 255];
+
+        if (self->signal_filter && datalen >= 1) {
+            unsigned df = (datalen == 2 ? DF_MODEAC : (data[0] >> 3) & 31);
+            if (signal < self->min_signal[df]) {
+                ++self->weak_messages;
+                ++self->suppressed_messages;
+                return 0;
+            }
         }
+    }
 
-        m = p + 2;
-        eom = m + message_len + (has_timestamp_signal ? 7 : 0);
-        if (eom > eod)
-            break;
+    /* drop repeats */
+    if (self->suppress_duplicates && self->frequency != 0 && !is_synthetic_timestamp(timestamp)) {
+        unsigned long long window = (self->duplicate_window > 0 ? (unsigned long long) (self->duplicate_window * self->frequency) : 0);
+        int duplicate = modesdedup_check(&self->dedup, timestamp, data, datalen, window);
+        if (duplicate < 0)
+            return -1;
+        if (duplicate) {
+            ++self->duplicate_messages;
+            ++self->suppressed_messages;
+            return 0;
+        }
+    }
 
-#define ADVANCE \
-        do {                                                            \
-            if (*m++ == 0x1a) {                                         \
-                if (m < eod && *m != 0x1a) {                            \
-                    error_pending = 1;                                  \
-                    if (message_count > 0)                              \
-                        goto nomoredata;                                \
-                    PyErr_SetString(PyExc_ValueError, "Lost sync with input stream: expected 0x1A after 0x1A escape"); \
-                    goto out;                                           \
-                }                                                       \
-                ++m, ++eom;                                             \
-                if (eom > eod)                                          \
-                    goto nomoredata;                                    \
-            }                                                           \
-        } while(0)
-
-        if (has_timestamp_signal) {
-            /* timestamp, 6 bytes */
-            timestamp = *m;
-            ADVANCE;
-            timestamp = (timestamp << 8) | *m;
-            ADVANCE;
-            timestamp = (timestamp << 8) | *m;
-            ADVANCE;
-            timestamp = (timestamp << 8) | *m;
-            ADVANCE;
-            timestamp = (timestamp << 8) | *m;
-            ADVANCE;
-            timestamp = (timestamp << 8) | *m;
-            ADVANCE;
-
-            /* signal, 1 byte */
-            signal = *m;
-            ADVANCE;
-        } else {
-            timestamp = 0;
-            signal = 0;
+    /* cheap checks that don't need the frame to be decoded */
+    wanted = prefilter_message(self, timestamp, data, datalen);
+    if (wanted > 0) {
+        modesmessage_decode_fields(data, datalen, &fields);
+        if (self->repair_crc && !fields.valid && modesmessage_repair_fields(data, datalen, repaired, &fields)) {
+            /* carry on with the corrected frame */
+            data = repaired;
+            ++self->repaired_messages;
         }
+        wanted = filter_message(self, timestamp, &fields);
+        if (wanted > 0 && self->track_adsb && fields.df == 17 && fields.valid)
+            wanted = track_position(self, timestamp, signal, data, &fields, &sync_entry);
+    }
 
-        /* message, N bytes */
-        for (i = 0; i < message_len; ++i) {
-            data[i] = *m;
-            ADVANCE;
+    if (wanted < 0)
+        return -1;
+
+    if (!wanted) {
+        ++self->suppressed_messages;
+        return 0;
+    }
+
+    if (out->columnar) {
+        int row = out->n_rows++;
+        uint8_t *rowdata = (uint8_t*)PyByteArray_AS_STRING(out->columns[COLUMN_DATA]) + row * COLUMN_DATA_SIZE;
+        int copylen = (datalen < COLUMN_DATA_SIZE ? datalen : COLUMN_DATA_SIZE);
+
+        ((uint64_t*)PyByteArray_AS_STRING(out->columns[COLUMN_TIMESTAMP]))[row] = timestamp;
+        ((uint8_t*)PyByteArray_AS_STRING(out->columns[COLUMN_SIGNAL]))[row] = signal;
+        ((uint8_t*)PyByteArray_AS_STRING(out->columns[COLUMN_DF]))[row] = fields.df;
+        ((uint32_t*)PyByteArray_AS_STRING(out->columns[COLUMN_ADDRESS]))[row] = (fields.has_address ? fields.address : 0);
+        ((uint8_t*)PyByteArray_AS_STRING(out->columns[COLUMN_VALID]))[row] = fields.valid;
+        ((uint8_t*)PyByteArray_AS_STRING(out->columns[COLUMN_DATALEN]))[row] = copylen;
+        memcpy(rowdata, data, copylen);
+        memset(rowdata + copylen, 0, COLUMN_DATA_SIZE - copylen);
+    } else {
+        PyObject *message = modesmessage_from_fields(timestamp, signal, data, datalen, &fields, &self->addrcache, (PyObject *)self);
+        if (!message)
+            return -1;
+        out->messages[out->n_messages++] = message;
+
+        if (sync_entry) {
+            /* attach the other half of the even/odd pair */
+            int half = (fields.odd_cpr ? 0 : 1);
+            modesfields partner_fields;
+            PyObject *partner;
+
+            modesmessage_decode_fields(sync_entry->cpr_data[half], 14, &partner_fields);
+            partner = modesmessage_from_fields(sync_entry->cpr_timestamp[half], sync_entry->cpr_signal[half],
+                                               sync_entry->cpr_data[half], 14, &partner_fields, &self->addrcache, (PyObject *)self);
+            if (!partner)
+                return -1;
+            ((modesmessage*)message)->partner = partner;
         }
+    }
 
-        /* do some filtering */
+    ++out->count;
+    return 0;
+}
 
-        if (type == '4') {
-            /* radarcape-style status message, use this to switch our decoder type */
+/* build the return value of feed / feed_columns */
+static PyObject *output_result(feed_output *out, Py_ssize_t offset, int error_pending)
+{
+    PyObject *message_tuple = NULL;
+    PyObject *columns = NULL;
+    int i;
 
-            self->radarcape_utc_bugfix = (data[2] & 0x80) == 0x80;
+    if (! (message_tuple = PyTuple_New(out->n_messages)))
+        goto err;
 
-            if (self->allow_mode_change) {
-                decoder_mode newmode;
-                if (data[0] & 0x10) {
-                    /* radarcape in GPS timestamp mode */
-                    if ((data[2] & 0x20) == 0x20) {
-                        newmode = DECODER_RADARCAPE_EMULATED;
-                    } else {
-                        newmode = DECODER_RADARCAPE;
-                    }
-                } else {
-                    /* radarcape in 12MHz timestamp mode */
-                    newmode = DECODER_BEAST;
-                }
+    while (--out->n_messages >= 0) {
+        PyTuple_SET_ITEM(message_tuple, out->n_messages, out->messages[out->n_messages]); /* steals ref */
+    }
+    out->n_messages = 0;
 
-                /* handle mode changes by inserting an event message */
-                if (newmode != self->decoder_mode) {
-                    set_decoder_mode(self, newmode);
-                    if (self->want_events) {
-                        if (! (messages[message_count++] = make_mode_change_event(self)))
-                        goto out;
-                    }
-                }
-            }
+    if (!out->columnar)
+        return Py_BuildValue("(n,N,N)", offset, message_tuple, PyBool_FromLong(error_pending));
+
+    if (! (columns = PyDict_New()))
+        goto err;
+
+    for (i = 0; i < N_COLUMNS; ++i) {
+        PyObject *view, *cast;
+        int rv;
+
+        if (PyByteArray_Resize(out->columns[i], (Py_ssize_t)out->n_rows * columntable[i].size) < 0)
+            goto err;
+
+        if (! (view = PyMemoryView_FromObject(out->columns[i])))
+            goto err;
+
+        cast = PyObject_CallMethod(view, "cast", "s", columntable[i].format);
+        Py_DECREF(view);
+        if (!cast)
+            goto err;
+
+        rv = PyDict_SetItemString(columns, columntable[i].name, cast);
+        Py_DECREF(cast);
+        if (rv < 0)
+            goto err;
+    }
+
+    return Py_BuildValue("(n,N,N,N)", offset, columns, message_tuple, PyBool_FromLong(error_pending));
+
+ err:
+    Py_XDECREF(message_tuple);
+    Py_XDECREF(columns);
+    return NULL;
+}
+
+/* nonzero iff one of the 8 bytes at m is 0x1A */
+static inline uint64_t beast_escape_in_word(const uint8_t *m)
+{
+    const uint64_t ones = 0x0101010101010101ULL, highs = 0x8080808080808080ULL, escapes = 0x1a1a1a1a1a1a1a1aULL;
+    uint64_t word;
+
+    memcpy(&word, m, 8);
+    word ^= escapes;
+    return (word - ones) & ~word & highs;
+}
+
+/* does this run of bytes contain a 0x1A? checks a word at a time */
+static inline int beast_has_escape(const uint8_t *m, Py_ssize_t n)
+{
+    Py_ssize_t i;
+
+    if (n < 8) {
+        for (i = 0; i < n; ++i) {
+            if (m[i] == 0x1a)
+                return 1;
         }
+        return 0;
+    }
+
+    for (i = 0; i + 8 < n; i += 8) {
+        if (beast_escape_in_word(m + i))
+            return 1;
+    }
+
+    /* last (possibly overlapping) word */
+    return beast_escape_in_word(m + n - 8) != 0;
+}
 
-        // hacky: toggle mode if self->try_toggle_freq was set in a function
-        if (self->try_toggle_freq > 0) {
-            self->try_toggle_freq = -5;
+/* Copy n bytes of Beast frame contents starting at m into dst, undoing
+ * 0x1A 0x1A escapes. Escapes are located with memchr and the runs between
+ * them are copied in bulk.
+ *
+ * Returns 1 on success and sets *next to the byte after the frame,
+ * 0 if the frame extends past eod, or -1 if a 0x1A is not followed by
+ * another 0x1A (i.e. we have lost sync).
+ */
+static int beast_unescape(uint8_t *m, uint8_t *eod, uint8_t *dst, Py_ssize_t n, uint8_t **next)
+{
+    while (n > 0) {
+        uint8_t *escape;
+        Py_ssize_t run;
 
-            decoder_mode newmode = DECODER_NONE;
+        if (m + n > eod)
+            return 0;
 
-            if (self->decoder_mode == DECODER_BEAST) {
-                newmode = DECODER_RADARCAPE;
-            }
-            if (self->decoder_mode == DECODER_RADARCAPE) {
+        if (! (escape = memchr(m, 0x1a, n))) {
+            memcpy(dst, m, n);
+            *next = m + n;
+            return 1;
+        }
+
+        /* copy up to and including the escaped 0x1A, then skip its duplicate */
+        run = escape - m + 1;
+        memcpy(dst, m, run);
+        dst += run;
+        n -= run;
+        m += run;
+
+        if (m >= eod)
+            return 0;
+        if (*m != 0x1a)
+            return -1;
+        ++m;
+    }
+
+    *next = m;
+    return 1;
+}
+
+/* Find the Beast frame starting at p, and unescape it if needed.
+ * This does not touch any Python objects, so it can be used without the GIL.
+ *
+ * On success returns BEAST_FRAME_OK, and sets *type to the frame type,
+ * *payload to the unescaped timestamp/signal/message bytes (either in
+ * the input buffer or in scratch, which must be BEAST_MAX_PAYLOAD bytes)
+ * and *next to the start of the following frame.
+ */
+int modesbeast_frame(uint8_t *p, uint8_t *eod, uint8_t *scratch, uint8_t *type, uint8_t **payload, uint8_t **next)
+{
+    uint8_t *m, *eom;
+
+    if (p + 2 > eod)
+        return BEAST_FRAME_MORE;
+
+    if (p[0] != 0x1a)
+        return BEAST_FRAME_BAD_MARKER;
+
+    *type = p[1];
+    m = p + 2;
+    switch (*type) {
+    case '1': eom = m + 7 + 2; break; /* mode A/C */
+    case '2': eom = m + 7 + 7; break; /* mode S short */
+    case '3': eom = m + 7 + 14; break; /* mode S long */
+    case '4': eom = m + 7 + 14; break; /* radarcape status message */
+    case '5': eom = m + 21; break; /* radarcape position message, no timestamp/signal bytes */
+    default:
+        return BEAST_FRAME_BAD_TYPE;
+    }
+
+    if (eom > eod)
+        return BEAST_FRAME_MORE;
+
+    if (!beast_has_escape(m, eom - m)) {
+        /* the usual case: nothing is escaped, so use the frame where it is */
+        *payload = m;
+        *next = eom;
+        return BEAST_FRAME_OK;
+    }
+
+    /* copy out the unescaped timestamp, signal, and message */
+    switch (beast_unescape(m, eod, scratch, eom - m, next)) {
+    case 1:
+        *payload = scratch;
+        return BEAST_FRAME_OK;
+    case 0:
+        return BEAST_FRAME_MORE;
+    default:
+        return BEAST_FRAME_BAD_ESCAPE;
+    }
+}
+
+/* process one unescaped Beast frame (see modesbeast_frame) */
+static int process_beast_frame(modesreader *self, feed_output *out, uint8_t type, uint8_t *payload)
+{
+    int message_len;
+    int has_timestamp_signal;
+    uint64_t timestamp;
+    uint8_t signal;
+    uint8_t *data;
+
+    has_timestamp_signal = 1;
+    switch (type) {
+    case '1': message_len = 2; break; /* mode A/C */
+    case '2': message_len = 7; break; /* mode S short */
+    case '5': message_len = 21; has_timestamp_signal = 0; break; /* radarcape position message */
+    default: message_len = 14; break; /* mode S long, radarcape status message */
+    }
+
+    if (has_timestamp_signal) {
+        /* timestamp, 6 bytes */
+        timestamp = ((uint64_t)payload[0] << 40) | ((uint64_t)payload[1] << 32) | ((uint64_t)payload[2] << 24) |
+            ((uint64_t)payload[3] << 16) | ((uint64_t)payload[4] << 8) | (uint64_t)payload[5];
+
+        /* signal, 1 byte */
+        signal = payload[6];
+
+        /* message, N bytes */
+        data = payload + 7;
+    } else {
+        timestamp = 0;
+        signal = 0;
+        data = payload;
+    }
+
+    /* do some filtering */
+
+    if (type == '4') {
+        /* radarcape-style status message, use this to switch our decoder type */
+
+        self->radarcape_utc_bugfix = (data[2] & 0x80) == 0x80;
+
+        if (self->allow_mode_change) {
+            decoder_mode newmode;
+            if (data[0] & 0x10) {
+                /* radarcape in GPS timestamp mode */
+                if ((data[2] & 0x20) == 0x20) {
+                    newmode = DECODER_RADARCAPE_EMULATED;
+                } else {
+                    newmode = DECODER_RADARCAPE;
+                }
+            } else {
+                /* radarcape in 12MHz timestamp mode */
                 newmode = DECODER_BEAST;
             }
 
-            if (newmode != DECODER_NONE) {
+            /* handle mode changes by inserting an event message */
+            if (newmode != self->decoder_mode) {
                 set_decoder_mode(self, newmode);
                 if (self->want_events) {
-                    if (! (messages[message_count++] = make_mode_change_event(self)))
-                        goto out;
+                    if (output_event(out, make_mode_change_event(self)) < 0)
+                    return -1;
                 }
             }
         }
+    }
 
-        // ignore ModeAC messages
-        if (type == '1') {
-            /* don't try to process this as a Mode S message */
-            p = m;
-            continue;
+    // hacky: toggle mode if self->try_toggle_freq was set in a function
+    if (self->try_toggle_freq > 0) {
+        self->try_toggle_freq = -5;
+
+        decoder_mode newmode = DECODER_NONE;
+
+        if (self->decoder_mode == DECODER_BEAST) {
+            newmode = DECODER_RADARCAPE;
+        }
+        if (self->decoder_mode == DECODER_RADARCAPE) {
+            newmode = DECODER_BEAST;
         }
 
-        if (has_timestamp_signal && !is_synthetic_timestamp(timestamp)) {
-            if (self->decoder_mode == DECODER_BEAST) {
-                /* 12MHz mode */
-
-                /* check for very out of range value
-                 * (dump1090 can hold messages for up to 60 seconds! so be conservative here)
-                 * also work around dump1090-mutability issue #47 which can send very stale Mode A/C messages
-                 */
-                if (self->want_events && type != '1' && !timestamp_check(self, timestamp)) {
-                    if (self->outliers > OUTLIER_LIMIT &&
-                            ! (messages[message_count++] = make_timestamp_jump_event(self, timestamp)))
-                        goto out;
-                }
+        if (newmode != DECODER_NONE) {
+            set_decoder_mode(self, newmode);
+            if (self->want_events) {
+                if (output_event(out, make_mode_change_event(self)) < 0)
+                    return -1;
+            }
+        }
+    }
 
-                /* adjust the timestamps so they always reflect the start of the frame */
-                uint64_t adjust;
-                if (type == '1') {
-                    // Mode A/C, timestamp reported at F2 which is 20.3us after F1
-                    // this is 243.6 cycles at 12MHz
-                    adjust = 244;
-                } else if (type == '2') {
-                    // Mode S short, timestamp reported at end of frame, frame is 8us preamble plus 56us data
-                    // this is 768 cycles at 12MHz
-                    adjust = 768;
-                } else if (type == '3') {
-                    // Mode S long, timestamp reported halfway through the frame (at bit 56), same offset as Mode S short
-                    adjust = 768;
-                } else {
-                    // anything else we assume is already correct
-                    adjust = 0;
-                }
+    // ignore ModeAC messages
+    if (type == '1') {
+        /* don't try to process this as a Mode S message */
+        return 0;
+    }
 
-                if (timestamp < adjust) {
-                    timestamp = 0;
-                } else {
-                    timestamp = timestamp - adjust;
-                }
+    if (has_timestamp_signal && !is_synthetic_timestamp(timestamp)) {
+        if (self->decoder_mode == DECODER_BEAST) {
+            /* 12MHz mode */
+
+            /* check for very out of range value
+             * (dump1090 can hold messages for up to 60 seconds! so be conservative here)
+             * also work around dump1090-mutability issue #47 which can send very stale Mode A/C messages
+             */
+            if (self->want_events && type != '1' && !timestamp_check(self, timestamp)) {
+                if (self->outliers > OUTLIER_LIMIT &&
+                        output_event(out, make_timestamp_jump_event(self, timestamp)) < 0)
+                    return -1;
+            }
+
+            /* adjust the timestamps so they always reflect the start of the frame */
+            uint64_t adjust;
+            if (type == '1') {
+                // Mode A/C, timestamp reported at F2 which is 20.3us after F1
+                // this is 243.6 cycles at 12MHz
+                adjust = 244;
+            } else if (type == '2') {
+                // Mode S short, timestamp reported at end of frame, frame is 8us preamble plus 56us data
+                // this is 768 cycles at 12MHz
+                adjust = 768;
+            } else if (type == '3') {
+                // Mode S long, timestamp reported halfway through the frame (at bit 56), same offset as Mode S short
+                adjust = 768;
             } else {
-                /* gps mode */
-
-                /* adjust timestamp so that it is a contiguous nanoseconds-since-
-                 * midnight value, rather than the raw form which skips values once
-                 * a second
-                 */
-                uint64_t nanos = timestamp & 0x00003FFFFFFF;
-                uint64_t secs = timestamp >> 30;
-
-                if (!self->radarcape_utc_bugfix) {
-                    /* fix up the timestamp so it is UTC, not 1 second ahead */
-                    if (secs == 0) {
-                        secs = 86399;
-                    } else {
-                        --secs;
-                    }
-                }
+                // anything else we assume is already correct
+                adjust = 0;
+            }
 
-                timestamp = nanos + secs * 1000000000;
-
-                /* adjust the timestamps so they always reflect the start of the frame */
-                uint64_t adjust;
-                if (type == '1') {
-                    // Mode A/C, timestamp reported at F2 which is 20.3us after F1
-                    adjust = 20300;
-                } else if (type == '2') {
-                    // Mode S short, timestamp reported at end of frame, frame is 8us preamble plus 56us data
-                    adjust = 64000;
-                } else if (type == '3') {
-                    // Mode S long, timestamp reported at end of frame, frame is 8us preamble plus 112us data
-                    adjust = 120000;
-                } else {
-                    // anything else we assume is already correct
-                    adjust = 0;
-                }
+            if (timestamp < adjust) {
+                timestamp = 0;
+            } else {
+                timestamp = timestamp - adjust;
+            }
+        } else {
+            /* gps mode */
 
-                if (adjust <= timestamp) {
-                    timestamp = timestamp - adjust;
+            /* adjust timestamp so that it is a contiguous nanoseconds-since-
+             * midnight value, rather than the raw form which skips values once
+             * a second
+             */
+            uint64_t nanos = timestamp & 0x00003FFFFFFF;
+            uint64_t secs = timestamp >> 30;
+
+            if (!self->radarcape_utc_bugfix) {
+                /* fix up the timestamp so it is UTC, not 1 second ahead */
+                if (secs == 0) {
+                    secs = 86399;
                 } else {
-                    /* wrap it to the previous day */
-                    timestamp = timestamp + 86400 * 1000000000ULL - adjust;
+                    --secs;
                 }
+            }
 
-                /* check for end of day rollover */
-                if (self->want_events && self->last_timestamp >= (86340 * 1000000000ULL) && timestamp <= (60 * 1000000000ULL)) {
-                    if (! (messages[message_count++] = make_epoch_rollover_event(self, timestamp)))
-                        goto out;
-                } else if (self->want_events && type != '1' && !timestamp_check(self, timestamp)) {
-                    if (! (messages[message_count++] = make_timestamp_jump_event(self, timestamp)))
-                        goto out;
-                }
+            timestamp = nanos + secs * 1000000000;
+
+            /* adjust the timestamps so they always reflect the start of the frame */
+            uint64_t adjust;
+            if (type == '1') {
+                // Mode A/C, timestamp reported at F2 which is 20.3us after F1
+                adjust = 20300;
+            } else if (type == '2') {
+                // Mode S short, timestamp reported at end of frame, frame is 8us preamble plus 56us data
+                adjust = 64000;
+            } else if (type == '3') {
+                // Mode S long, timestamp reported at end of frame, frame is 8us preamble plus 112us data
+                adjust = 120000;
+            } else {
+                // anything else we assume is already correct
+                adjust = 0;
             }
 
-            if (type != '1') {
-                timestamp_update(self, timestamp);
+            if (adjust <= timestamp) {
+                timestamp = timestamp - adjust;
+            } else {
+                /* wrap it to the previous day */
+                timestamp = timestamp + 86400 * 1000000000ULL - adjust;
             }
-        }
 
-        if (type == '4') {
-            /* radarcape-style status message, emit the status event if wanted */
-            if (self->want_events) {
-                if (! (messages[message_count++] = make_radarcape_status_event(self, timestamp, data)))
-                    goto out;
+            /* check for end of day rollover */
+            if (self->want_events && self->last_timestamp >= (86340 * 1000000000ULL) && timestamp <= (60 * 1000000000ULL)) {
+                if (output_event(out, make_epoch_rollover_event(self, timestamp)) < 0)
+                    return -1;
+            } else if (self->want_events && type != '1' && !timestamp_check(self, timestamp)) {
+                if (output_event(out, make_timestamp_jump_event(self, timestamp)) < 0)
+                    return -1;
             }
+        }
 
-            /* don't try to process this as a Mode S message */
-            p = m;
-            continue;
+        if (type != '1') {
+            timestamp_update(self, timestamp);
         }
+    }
 
-        if (type == '5') {
-            /* radarcape-style position message, emit the position event if wanted */
+    if (type == '4') {
+        /* radarcape-style status message, emit the status event if wanted */
+        if (self->want_events) {
+            if (output_event(out, make_radarcape_status_event(self, timestamp, data)) < 0)
+                return -1;
+        }
 
-            if (self->want_events) {
-                if (! (messages[message_count++] = make_radarcape_position_event(self, data)))
-                    goto out;
-            }
+        /* don't try to process this as a Mode S message */
+        return 0;
+    }
 
-            /* don't try to process this as a Mode S message */
-            p = m;
-            continue;
+    if (type == '5') {
+        /* radarcape-style position message, emit the position event if wanted */
+
+        if (self->want_events) {
+            if (output_event(out, make_radarcape_position_event(self, data)) < 0)
+                return -1;
         }
 
-        /* it's a Mode A/C or Mode S message, parse it */
-        if (! (message = modesmessage_from_buffer(timestamp, signal, data, message_len)))
-            goto out;
+        /* don't try to process this as a Mode S message */
+        return 0;
+    }
 
-        /* apply filters, update seen-set */
-        ++self->received_messages;
-        wanted = filter_message(self, message);
-        if (wanted < 0)
-            goto out;
-        else if (wanted)
-            messages[message_count++] = message;
-        else {
-            ++self->suppressed_messages;
-            Py_DECREF(message);
-        }
+    /* it's a Mode A/C or Mode S message: decode it, apply filters, update seen table */
+    return output_frame(self, out, timestamp, signal, data, message_len);
+}
 
-        p = m;
+/* drain(thread, max_messages=0): process frames queued by a ReaderThread.
+ *
+ * Returns a tuple (frames, messages, error_pending) like feed(), where
+ * frames is the number of queued frames consumed. If the thread has
+ * stopped (connection closed, socket error, lost sync) and everything
+ * it queued has been processed, the next call raises EOFError, OSError
+ * or ValueError respectively.
+ */
+static PyObject *modesreader_drain(modesreader *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "thread", "max_messages", NULL };
+    PyObject *thread = NULL, *rv = NULL;
+    int max_messages = 0;
+    Py_ssize_t consumed = 0;
+    unsigned long long started;
+    feed_output out;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|i", kwlist, &thread, &max_messages))
+        return NULL;
+
+    output_clear(&out);
+
+    if (!modesthread_check(thread)) {
+        PyErr_SetString(PyExc_TypeError, "expected a ReaderThread");
+        goto out;
     }
 
- nomoredata:
-    if (! (message_tuple = PyTuple_New(message_count)))
+    if (self->decoder_mode != DECODER_BEAST && self->decoder_mode != DECODER_RADARCAPE && self->decoder_mode != DECODER_RADARCAPE_EMULATED) {
+        PyErr_SetString(PyExc_ValueError, "drain() needs a Beast or Radarcape decoder mode");
         goto out;
+    }
+
+    modesthread_clear_wakeup(thread);
 
-    while (--message_count >= 0) {
-        PyTuple_SET_ITEM(message_tuple, message_count, messages[message_count]); /* steals ref */
+    if (max_messages <= 0) {
+        /* each frame produces at most a message plus two events */
+        max_messages = modesthread_available(thread) * 3 + 3;
     }
 
-    rv = Py_BuildValue("(l,N,N)", (long) (p - buffer_start), message_tuple, PyBool_FromLong(error_pending));
+    if (output_init(&out, max_messages, 0) < 0)
+        goto out;
+
+    sample_clock(self);
+    started = monotonic_ns();
 
- out:
-    while (--message_count >= 0) {
-        Py_XDECREF(messages[message_count]);
+    while (out.count+2 < out.max_messages) {
+        modesrawframe *frames;
+        unsigned n, i;
+
+        if (! (n = modesthread_take(thread, &frames)))
+            break;
+
+        for (i = 0; i < n && out.count+2 < out.max_messages; ++i) {
+            if (process_beast_frame(self, &out, frames[i].type, frames[i].payload) < 0) {
+                modesthread_release(thread, i);
+                goto out;
+            }
+        }
+
+        modesthread_release(thread, i);
+        consumed += i;
+    }
+
+    self->parse_time_ns += monotonic_ns() - started;
+
+    if (out.count == 0) {
+        /* nothing to return, report any error now */
+        if (modesthread_raise_if_stopped(thread) < 0)
+            goto out;
+        rv = output_result(&out, consumed, 0);
+    } else {
+        rv = output_result(&out, consumed, modesthread_finished(thread));
     }
-    free(messages);
+
+ out:
+    output_free(&out);
     return rv;
 }
 
+/* feed implementation for Beast-format data (including Radarcape) */
+static PyObject *feed_beast(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out)
+{
+    uint8_t *buffer_start, *p, *eod;
+    int error_pending = 0;
+
+    buffer_start = buffer->buf;
+
+    /* parse messages */
+    p = buffer_start + start;
+    eod = buffer_start + end;
+    while (p+2 <= eod && out->count+2 < out->max_messages) {
+        uint8_t scratch[BEAST_MAX_PAYLOAD];
+        uint8_t type, *payload, *next;
+
+        switch (modesbeast_frame(p, eod, scratch, &type, &payload, &next)) {
+        case BEAST_FRAME_OK:
+            break;
+
+        case BEAST_FRAME_MORE:
+            goto nomoredata;
+
+        case BEAST_FRAME_BAD_MARKER:
+            error_pending = 1;
+            if (out->count > 0)
+                goto nomoredata;
+            PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected a 0x1A marker at offset %d but found 0x%02x instead", (int) (p - buffer_start), (int)p[0]);
+            goto out;
+
+        case BEAST_FRAME_BAD_TYPE:
+            error_pending = 1;
+            if (out->count > 0)
+                goto nomoredata;
+            PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected message type 0x%02x after 0x1A marker at offset %d", (int)p[1], (int) (p - buffer_start));
+            goto out;
+
+        default: /* BEAST_FRAME_BAD_ESCAPE */
+            error_pending = 1;
+            if (out->count > 0)
+                goto nomoredata;
+            PyErr_SetString(PyExc_ValueError, "Lost sync with input stream: expected 0x1A after 0x1A escape");
+            goto out;
+        }
+
+        if (payload == scratch)
+            self->beast_escapes += (next - p) - 2 - modesbeast_payload_len(type);
+
+        if (process_beast_frame(self, out, type, payload) < 0)
+            goto out;
+
+        p = next;
+    }
+
+ nomoredata:
+    return output_result(out, p - buffer_start, error_pending);
+
+ out:
+    out->error_offset = p - buffer_start;
+    return NULL;
+}
+
 /********** SBS INPUT **************/
 
 /*
@@ -1012,34 +2040,17 @@ static PyObject *feed_beast(modesreader *self, Py_buffer *buffer, int max_messag
  * start of the frame (as dump1090 / Beast do), you have to compensate for
  * the frame length.
  */
-static PyObject *feed_sbs(modesreader *self, Py_buffer *buffer, int max_messages)
+static PyObject *feed_sbs(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out)
 {
-    PyObject *rv = NULL;
     uint8_t *buffer_start, *p, *eod;
-    int message_count = 0;
-    PyObject *message_tuple = NULL;
-    PyObject **messages = NULL;
     int error_pending = 0;
 
     buffer_start = buffer->buf;
 
-    if (max_messages <= 0) {
-        /* allocate the maximum size we might need, given a minimal encoding of:
-         *   <DLE> <STX> <0x09> <n/a> <3 bytes timestamp> <2 bytes message> <DLE> <ETX> <2 bytes CRC> = 13 bytes total
-         */
-        max_messages = buffer->len / 13 + 1;
-    }
-
-    messages = calloc(max_messages, sizeof(PyObject*));
-    if (!messages) {
-        PyErr_NoMemory();
-        goto out;
-    }
-
     /* parse messages */
-    p = buffer_start;
-    eod = buffer_start + buffer->len;
-    while (p+13 <= eod && message_count < max_messages) {
+    p = buffer_start + start;
+    eod = buffer_start + end;
+    while (p+13 <= eod && out->count < out->max_messages) {
         int message_len = -1;
         uint64_t timestamp;
         /* largest message we care about is:
@@ -1054,48 +2065,55 @@ static PyObject *feed_sbs(modesreader *self, Py_buffer *buffer, int max_messages
         int i;
         uint8_t type;
         uint32_t crc;
-        PyObject *message;
 
         if (p[0] != 0x10 || p[1] != 0x02) {
             error_pending = 1;
-            if (message_count > 0)
+            if (out->count > 0)
                 goto nomoredata;
             PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected DLE STX at offset %d but found 0x%02x 0x%02x instead", (int) (p - buffer_start), (int)p[0], (int)p[1]);
             goto out;
         }
 
-        /* scan for DLE ETX, copy data */
+        /* scan for DLE ETX, copying the runs of data between DLEs */
         m = p + 2;
         i = 0;
         while (m < eod) {
-            if (*m == 0x10) {
-                /* DLE <something> */
+            uint8_t *dle = memchr(m, 0x10, eod - m);
+            Py_ssize_t run = (dle ? dle : eod) - m;
 
-                if ((m+1) >= eod)
-                    goto nomoredata;
+            if (i < 19) {
+                int copy = (run < 19 - i ? run : 19 - i);
+                memcpy(data + i, m, copy);
+                i += copy;
+            }
 
-                if (m[1] == 0x03) {
-                    /* DLE ETX */
-                    break;
-                }
+            m += run;
+            if (!dle)
+                break;
 
-                if (m[1] != 0x10) {
-                    /* DLE <something we don't understand> */
-                    error_pending = 1;
-                    if (message_count > 0)
-                        goto nomoredata;
-                    PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected DLE 0x%02x at offset %d", (int) (m - buffer_start), (int)m[1]);
-                    goto out;
-                }
+            /* DLE <something> */
 
-                /* DLE DLE */
-                ++m;
+            if ((m+1) >= eod)
+                goto nomoredata;
+
+            if (m[1] == 0x03) {
+                /* DLE ETX */
+                break;
             }
 
-            if (i < 19)
-                data[i++] = *m;
+            if (m[1] != 0x10) {
+                /* DLE <something we don't understand> */
+                error_pending = 1;
+                if (out->count > 0)
+                    goto nomoredata;
+                PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected DLE 0x%02x at offset %d", (int) (m - buffer_start), (int)m[1]);
+                goto out;
+            }
 
-            ++m;
+            /* DLE DLE */
+            if (i < 19)
+                data[i++] = 0x10;
+            m += 2;
         }
 
         /* now pointing at DLE of DLE ETX */
@@ -1109,7 +2127,7 @@ static PyObject *feed_sbs(modesreader *self, Py_buffer *buffer, int max_messages
                 goto nomoredata;
             if (m[0] != 0x10) {
                 error_pending = 1;
-                if (message_count > 0)
+                if (out->count > 0)
                     goto nomoredata;
                 PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected DLE 0x%02x at offset %d", (int) (m - buffer_start), (int)*m);
                 goto out;
@@ -1125,7 +2143,7 @@ static PyObject *feed_sbs(modesreader *self, Py_buffer *buffer, int max_messages
                 goto nomoredata;
             if (m[0] != 0x10) {
                 error_pending = 1;
-                if (message_count > 0)
+                if (out->count > 0)
                     goto nomoredata;
                 PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected DLE 0x%02x at offset %d", (int) (m - buffer_start), (int)*m);
                 goto out;
@@ -1203,100 +2221,82 @@ static PyObject *feed_sbs(modesreader *self, Py_buffer *buffer, int max_messages
          * isn't true, you will get synchronization jumps that are a multiple of 839ms.
          */
 
-        /* merge in top bits of the current widened counter */
-        timestamp = timestamp | (self->last_timestamp & 0xFFFFFFFFFF000000ULL);
-
-        /* check for rollover, if it happened then increase the widened part */
-        if (timestamp < self->last_timestamp)
-            timestamp += (1 << 24);
-
+        /* advance the widened counter by however far the low 24 bits moved forward
+         * (modulo 2^24); a timestamp that went backwards has rolled over once.
+         */
+        timestamp = self->last_timestamp + ((timestamp - self->last_timestamp) & 0xFFFFFF);
         self->last_timestamp = timestamp;
 
-        /* decode it */
-        if (! (message = modesmessage_from_buffer(timestamp, 0, &data[5], message_len)))
+        /* decode it, apply filters, update seen table */
+        if (output_frame(self, out, timestamp, 0, &data[5], message_len) < 0)
             goto out;
 
-        /* apply filters, update seen-set */
-        ++self->received_messages;
-        int wanted = filter_message(self, message);
-        if (wanted < 0)
-            goto out;
-        else if (wanted)
-            messages[message_count++] = message;
-        else {
-            ++self->suppressed_messages;
-            Py_DECREF(message);
-        }
-
         p = m;
     }
 
  nomoredata:
-    if (! (message_tuple = PyTuple_New(message_count)))
-        goto out;
-
-    while (--message_count >= 0) {
-        PyTuple_SET_ITEM(message_tuple, message_count, messages[message_count]); /* steals ref */
-    }
-
-    rv = Py_BuildValue("(l,N,N)", (long) (p - buffer_start), message_tuple, PyBool_FromLong(error_pending));
+    return output_result(out, p - buffer_start, error_pending);
 
  out:
-    while (--message_count >= 0) {
-        Py_XDECREF(messages[message_count]);
-    }
-    free(messages);
-    return rv;
+    out->error_offset = p - buffer_start;
+    return NULL;
 }
 
 /********** AVR INPUT **************/
 
-static int hexvalue(char c)
+/* value of each hex digit, or -1; filled in by init_hexvalues() */
+static int8_t hexvalues[256];
+
+static void init_hexvalues(void)
 {
-    if (c >= '0' && c <= '9')
-        return c - '0';
-    else if (c >= 'a' && c <= 'f')
-        return c - 'a' + 10;
-    else if (c >= 'A' && c <= 'F')
-        return c - 'A' + 10;
-    else
-        return -1;
+    int c;
+
+    for (c = 0; c < 256; ++c)
+        hexvalues[c] = -1;
+    for (c = '0'; c <= '9'; ++c)
+        hexvalues[c] = c - '0';
+    for (c = 'a'; c <= 'f'; ++c)
+        hexvalues[c] = c - 'a' + 10;
+    for (c = 'A'; c <= 'F'; ++c)
+        hexvalues[c] = c - 'A' + 10;
 }
 
-static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages)
+static inline int hexvalue(uint8_t c)
 {
-    PyObject *rv = NULL;
-    uint8_t *buffer_start, *p, *eod;
-    int message_count = 0;
-    PyObject *message_tuple = NULL;
-    PyObject **messages = NULL;
-    int error_pending = 0;
+    return hexvalues[c];
+}
 
-    buffer_start = buffer->buf;
+/* decode n hex digit pairs into bytes; returns 0 if any digit was bad */
+static inline int decode_hex(const uint8_t *m, uint8_t *data, int n)
+{
+    int i, bad = 0;
 
-    if (max_messages <= 0) {
-        /* allocate the maximum size we might need, given a minimal encoding of:
-         *   '*' <2 bytes message> ';' LF
-         */
-        max_messages = buffer->len / 5 + 1;
+    for (i = 0; i < n; ++i, m += 2) {
+        int c0 = hexvalues[m[0]], c1 = hexvalues[m[1]];
+        bad |= c0 | c1;
+        data[i] = (c0 << 4) | c1;
     }
 
-    messages = calloc(max_messages, sizeof(PyObject*));
-    if (!messages) {
-        PyErr_NoMemory();
-        goto out;
-    }
+    return (bad >= 0);
+}
+
+static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, Py_ssize_t start, Py_ssize_t end, feed_output *out)
+{
+    uint8_t *buffer_start, *p, *eod;
+    int error_pending = 0;
+
+    buffer_start = buffer->buf;
 
-    p = buffer_start;
-    eod = buffer_start + buffer->len;
-    while (p+17 <= eod && message_count+1 < max_messages) {
+    p = buffer_start + start;
+    eod = buffer_start + end;
+    while (p+17 <= eod && out->count+1 < out->max_messages) {
         int message_len = -1;
         uint64_t timestamp;
         uint8_t data[14];
+        uint8_t tsbytes[6];
         uint8_t message_format;
         int i;
-        uint8_t *m;
-        PyObject *message;
+        uint8_t *m, *semi;
 
         message_format = p[0];
         if (message_format != '@' &&
@@ -1305,7 +2305,7 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
             message_format != '*' &&
             message_format != ':') {
             error_pending = 1;
-            if (message_count > 0)
+            if (out->count > 0)
                 goto nomoredata;
             PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected '@'/'%%'/'<'/'*'/':' at offset %d but found 0x%02x instead",
                          (int) (p - buffer_start), (int)p[0]);
@@ -1313,9 +2313,17 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
         }
 
         m = p + 1;
-        if (message_format == '@' ||
-            message_format == '%' ||
-            message_format == '<') {
+        if ((message_format == '@' ||
+             message_format == '%' ||
+             message_format == '<') &&
+            m + 12 <= eod && decode_hex(m, tsbytes, 6)) {
+            /* fast path: a complete, valid timestamp */
+            timestamp = ((uint64_t)tsbytes[0] << 40) | ((uint64_t)tsbytes[1] << 32) | ((uint64_t)tsbytes[2] << 24) |
+                ((uint64_t)tsbytes[3] << 16) | ((uint64_t)tsbytes[4] << 8) | tsbytes[5];
+            m += 12;
+        } else if (message_format == '@' ||
+                   message_format == '%' ||
+                   message_format == '<') {
             /* read 6 bytes of timestamp */
             timestamp = 0;
             for (i = 0; i < 12; ++i, ++m) {
@@ -1331,7 +2339,7 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
                     timestamp |= c;
                 } else {
                     error_pending = 1;
-                    if (message_count > 0)
+                    if (out->count > 0)
                         goto nomoredata;
                     PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected a hex digit at offset %d but found 0x%02x instead",
                                  (int) (m - buffer_start), (int)*m);
@@ -1350,8 +2358,18 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
                 goto nomoredata;
         }
 
+        /* find the end of message marker; if the message is well formed,
+         * decode it in one go, otherwise go through it a digit at a time
+         * to work out exactly what is wrong with it
+         */
+        semi = memchr(m, ';', (eod - m < 29 ? eod - m : 29));
+        message_len = (semi ? (semi - m) / 2 : 0);
+        if (semi && semi + 1 < eod && ((semi - m) & 1) == 0 && decode_hex(m, data, message_len))
+            m = semi;
+        else
+            message_len = 0;
+
         /* read 2-14 bytes of data */
-        message_len = 0;
         while (message_len < 14) {
             int c0, c1;
 
@@ -1365,7 +2383,7 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
                 c0 = hexvalue(m[0]);
                 if (c0 < 0) {
                     error_pending = 1;
-                    if (message_count > 0)
+                    if (out->count > 0)
                         goto nomoredata;
 
                     PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected a hex digit at offset %d but found 0x%02x instead",
@@ -1377,7 +2395,7 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
             c1 = hexvalue(m[1]);
             if (c1 < 0) {
                 error_pending = 1;
-                if (message_count > 0)
+                if (out->count > 0)
                     goto nomoredata;
 
                 PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected a hex digit at offset %d but found 0x%02x instead",
@@ -1397,7 +2415,7 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
             goto nomoredata;
         if (*m != ';') {
             error_pending = 1;
-            if (message_count > 0)
+            if (out->count > 0)
                 goto nomoredata;
 
             PyErr_Format(PyExc_ValueError, "Lost sync with input stream: expected ';' at offset %d but found 0x%02x instead",
@@ -1418,7 +2436,7 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
         /* check length */
         if (message_len != 2 && message_len != 7 && message_len != 14) {
             error_pending = 1;
-            if (message_count > 0)
+            if (out->count > 0)
                 goto nomoredata;
 
             PyErr_Format(PyExc_ValueError, "Lost sync with input stream: unexpected %d-byte message starting at offset %d",
@@ -1431,136 +2449,777 @@ static PyObject *feed_avr(modesreader *self, Py_buffer *buffer, int max_messages
          * also work around dump1090-mutability issue #47 which can send very stale Mode A/C messages
          */
         if (self->want_events && message_len != 2 && !timestamp_check(self, timestamp)) {
-            if (! (messages[message_count++] = make_timestamp_jump_event(self, timestamp)))
+            if (output_event(out, make_timestamp_jump_event(self, timestamp)) < 0)
                 goto out;
         }
 
         timestamp_update(self, timestamp);
 
-        /* decode it */
-        if (! (message = modesmessage_from_buffer(timestamp, 0, data, message_len)))
-            goto out;
-
-        /* apply filters, update seen-set */
-        ++self->received_messages;
-        int wanted = filter_message(self, message);
-        if (wanted < 0)
+        /* decode it, apply filters, update seen table */
+        if (output_frame(self, out, timestamp, 0, data, message_len) < 0)
             goto out;
-        else if (wanted)
-            messages[message_count++] = message;
-        else {
-            ++self->suppressed_messages;
-            Py_DECREF(message);
-        }
 
         /* next message */
         p = m;
     }
 
  nomoredata:
-    if (! (message_tuple = PyTuple_New(message_count)))
-        goto out;
+    return output_result(out, p - buffer_start, error_pending);
+
+ out:
+    out->error_offset = p - buffer_start;
+    return NULL;
+}
+
+/********** STREAMING FEED **************/
+
+/*
+ * iter_feed(buffer, start=0, end=-1) returns an iterator that decodes
+ * buffer[start:end] as it is consumed. Each step runs the format parser
+ * with room for the results of a single frame, so the parser stops at the
+ * next wanted frame: nothing is decoded ahead of the caller, and a parse
+ * error is raised by the next() call that reaches it, rather than being
+ * reported as pending. The iterator's offset is always the offset just
+ * past the last frame decoded, which is where feeding should resume if the
+ * caller stops early; after a parse error, it is the offset of the frame
+ * that could not be parsed.
+ *
+ * The iterator keeps the buffer exported until it is exhausted or
+ * discarded, so a bytearray can't be resized while it is in use.
+ */
+
+/* the most results one frame can produce (events plus a message) */
+#define FEEDITER_MAX_RESULTS 3
+
+typedef struct {
+    PyObject_HEAD
+
+    modesreader *reader;          /* the reader doing the work */
+    Py_buffer buffer;             /* the data, while has_buffer is set */
+    char has_buffer;
+    Py_ssize_t offset;            /* how far we have got */
+    Py_ssize_t end;
+    PyObject *results;            /* tuple of results of the last frame decoded */
+    Py_ssize_t next_result;       /* index of the next one to return */
+    PyObject *slots[FEEDITER_MAX_RESULTS];
+} modesfeediter;
+
+static void modesfeediter_release(modesfeediter *self)
+{
+    if (self->has_buffer) {
+        PyBuffer_Release(&self->buffer);
+        self->has_buffer = 0;
+    }
+}
+
+static void modesfeediter_dealloc(modesfeediter *self)
+{
+    modesfeediter_release(self);
+    Py_CLEAR(self->results);
+    Py_CLEAR(self->reader);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+/* output capacity that makes the parser for the current mode stop after one wanted frame */
+static int feediter_capacity(modesreader *reader)
+{
+    switch (reader->decoder_mode) {
+    case DECODER_BEAST:
+    case DECODER_RADARCAPE:
+    case DECODER_RADARCAPE_EMULATED:
+        return 3;
+    case DECODER_SBS:
+        return 1;
+    default:
+        return 2;
+    }
+}
+
+/* return the next message or event, decoding another frame if needed */
+static PyObject *modesfeediter_next(modesfeediter *self)
+{
+    feed_output out;
+    PyObject *result, *messages;
+    Py_ssize_t offset;
+
+    if (self->results) {
+        if (self->next_result < PyTuple_GET_SIZE(self->results)) {
+            PyObject *message = PyTuple_GET_ITEM(self->results, self->next_result++);
+            Py_INCREF(message);
+            return message;
+        }
+        Py_CLEAR(self->results);
+    }
+
+    while (self->has_buffer && self->offset < self->end) {
+        output_clear(&out);
+        out.max_messages = feediter_capacity(self->reader);
+        out.messages = self->slots;
+
+        result = feed_dispatch(self->reader, &self->buffer, self->offset, self->end, &out);
+        if (!result) {
+            /* frames before the one that failed were consumed (and filtered out) */
+            if (out.error_offset > self->offset)
+                self->offset = out.error_offset;
+            /* drop anything produced by the failed frame */
+            while (--out.n_messages >= 0)
+                Py_XDECREF(out.messages[out.n_messages]);
+            return NULL;
+        }
+
+        offset = PyLong_AsSsize_t(PyTuple_GET_ITEM(result, 0));
+        messages = PyTuple_GET_ITEM(result, 1);
+        if (offset == self->offset && PyTuple_GET_SIZE(messages) == 0) {
+            /* only a partial frame left */
+            Py_DECREF(result);
+            break;
+        }
+
+        self->offset = offset;
+        if (PyTuple_GET_SIZE(messages) > 0) {
+            Py_INCREF(messages);
+            self->results = messages;
+            self->next_result = 1;
+            Py_DECREF(result);
+            messages = PyTuple_GET_ITEM(self->results, 0);
+            Py_INCREF(messages);
+            return messages;
+        }
+
+        /* everything was filtered out, go round again */
+        Py_DECREF(result);
+    }
+
+    /* finished; returning NULL with no exception set stops the iteration */
+    modesfeediter_release(self);
+    return NULL;
+}
+
+static PyMemberDef modesfeediterMembers[] = {
+    { "reader", T_OBJECT, offsetof(modesfeediter, reader), READONLY, "the Reader decoding the data" },
+    { "offset", T_PYSSIZET, offsetof(modesfeediter, offset), READONLY, "buffer offset just past the last frame decoded" },
+    { NULL, 0, 0, 0, NULL }
+};
+
+static PyTypeObject modesfeediterType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_modes.FeedIterator",            /* tp_name        */
+    sizeof(modesfeediter),            /* tp_basicsize   */
+    0,                                /* tp_itemsize    */
+    (destructor)modesfeediter_dealloc, /* tp_dealloc     */
+    0,                                /* tp_print       */
+    0,                                /* tp_getattr     */
+    0,                                /* tp_setattr     */
+    0,                                /* tp_reserved    */
+    0,                                /* tp_repr        */
+    0,                                /* tp_as_number   */
+    0,                                /* tp_as_sequence */
+    0,                                /* tp_as_mapping  */
+    0,                                /* tp_hash        */
+    0,                                /* tp_call        */
+    0,                                /* tp_str         */
+    PyObject_GenericGetAttr,          /* tp_getattro    */
+    0,                                /* tp_setattro    */
+    0,                                /* tp_as_buffer   */
+    Py_TPFLAGS_DEFAULT,               /* tp_flags       */
+    "An iterator that decodes a buffer of receiver data on demand; see Reader.iter_feed().", /* tp_doc         */
+    0,                                /* tp_traverse    */
+    0,                                /* tp_clear       */
+    0,                                /* tp_richcompare */
+    0,                                /* tp_weaklistoffset */
+    PyObject_SelfIter,                /* tp_iter        */
+    (iternextfunc)modesfeediter_next, /* tp_iternext    */
+    0,                                /* tp_methods     */
+    modesfeediterMembers,             /* tp_members     */
+    0,                                /* tp_getset      */
+};
+
+/* iter_feed(buffer, start=0, end=-1): decode buffer[start:end] on demand,
+ * returning an iterator over the messages and events it contains.
+ */
+static PyObject *modesreader_iter_feed(modesreader *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "buffer", "start", "end", NULL };
+    modesfeediter *iter;
+    Py_buffer buffer;
+    Py_ssize_t start = 0, end = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*|nn", kwlist, &buffer, &start, &end))
+        return NULL;
+
+    if (buffer.itemsize != 1) {
+        PyErr_SetString(PyExc_ValueError, "buffer itemsize is not 1");
+        goto err;
+    }
+
+    if (!PyBuffer_IsContiguous(&buffer, 'C')) {
+        PyErr_SetString(PyExc_ValueError, "buffer is not contiguous");
+        goto err;
+    }
+
+    if (end < 0)
+        end = buffer.len;
+
+    if (start < 0 || start > end || end > buffer.len) {
+        PyErr_SetString(PyExc_ValueError, "start/end offsets out of range");
+        goto err;
+    }
+
+    if (! (iter = PyObject_New(modesfeediter, &modesfeediterType)))
+        goto err;
+
+    Py_INCREF(self);
+    iter->reader = self;
+    iter->buffer = buffer;        /* the iterator releases it */
+    iter->has_buffer = 1;
+    iter->offset = start;
+    iter->end = end;
+    iter->results = NULL;
+    iter->next_result = 0;
+
+    sample_clock(self);
+    return (PyObject *)iter;
+
+ err:
+    PyBuffer_Release(&buffer);
+    return NULL;
+}
+
+/********** FILE DECODING **************/
+
+/*
+ * decode_file(path, mode, ...) maps a capture file into memory and returns
+ * an iterator that feeds it through a Reader a batch at a time. The whole
+ * file is visible to the parser at once, so there are no residuals to
+ * carry between chunks and nothing is copied before parsing.
+ */
+
+typedef struct {
+    PyObject_HEAD
+
+    modesreader *reader;          /* the reader doing the work; available to the caller for stats etc */
+    uint8_t *map;                 /* the mapped file, NULL once done */
+    Py_ssize_t len;
+    Py_ssize_t offset;            /* how far we have got */
+    int max_messages;
+    char columnar;
+} modesfiledecoder;
+
+static void modesfiledecoder_unmap(modesfiledecoder *self)
+{
+    if (self->map) {
+        munmap(self->map, self->len);
+        self->map = NULL;
+    }
+}
+
+static void modesfiledecoder_dealloc(modesfiledecoder *self)
+{
+    modesfiledecoder_unmap(self);
+    Py_CLEAR(self->reader);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+/* return the next non-empty batch: a tuple of messages, or (columns, events) when decoding to columns */
+static PyObject *modesfiledecoder_next(modesfiledecoder *self)
+{
+    Py_buffer buffer;
+    feed_output out;
+    PyObject *result = NULL, *batch = NULL;
+    Py_ssize_t offset;
+
+    output_clear(&out);
+
+    while (self->map && self->offset < self->len) {
+        if (PyBuffer_FillInfo(&buffer, NULL, self->map, self->len, 1, PyBUF_SIMPLE) < 0)
+            goto out;
+
+        if (output_init(&out, self->max_messages, self->columnar) < 0)
+            goto out;
+
+        sample_clock(self->reader);
+        result = feed_dispatch(self->reader, &buffer, self->offset, self->len, &out);
+        if (!result)
+            goto out;  /* a parse error; the file can't be decoded past this point */
+
+        offset = PyLong_AsSsize_t(PyTuple_GET_ITEM(result, 0));
+        if (offset == self->offset && out.count == 0) {
+            /* only a partial frame left at the end of the file */
+            Py_CLEAR(result);
+            break;
+        }
 
-    while (--message_count >= 0) {
-        PyTuple_SET_ITEM(message_tuple, message_count, messages[message_count]); /* steals ref */
+        self->offset = offset;
+        if (out.count > 0) {
+            if (self->columnar)
+                batch = PyTuple_Pack(2, PyTuple_GET_ITEM(result, 1), PyTuple_GET_ITEM(result, 2));
+            else {
+                batch = PyTuple_GET_ITEM(result, 1);
+                Py_INCREF(batch);
+            }
+            goto out;
+        }
+
+        /* everything in that batch was filtered out, go round again */
+        Py_CLEAR(result);
+        output_free(&out);
     }
 
-    rv = Py_BuildValue("(l,N,N)", (long) (p - buffer_start), message_tuple, PyBool_FromLong(error_pending));
+    /* finished; returning NULL with no exception set stops the iteration */
+    modesfiledecoder_unmap(self);
 
  out:
-    while (--message_count >= 0) {
-        Py_XDECREF(messages[message_count]);
+    Py_XDECREF(result);
+    output_free(&out);
+    return batch;
+}
+
+static PyMemberDef modesfiledecoderMembers[] = {
+    { "reader", T_OBJECT, offsetof(modesfiledecoder, reader), READONLY, "the Reader decoding the file" },
+    { "offset", T_PYSSIZET, offsetof(modesfiledecoder, offset), READONLY, "file offset of the next undecoded byte" },
+    { NULL, 0, 0, 0, NULL }
+};
+
+static PyTypeObject modesfiledecoderType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_modes.FileDecoder",             /* tp_name        */
+    sizeof(modesfiledecoder),         /* tp_basicsize   */
+    0,                                /* tp_itemsize    */
+    (destructor)modesfiledecoder_dealloc, /* tp_dealloc     */
+    0,                                /* tp_print       */
+    0,                                /* tp_getattr     */
+    0,                                /* tp_setattr     */
+    0,                                /* tp_reserved    */
+    0,                                /* tp_repr        */
+    0,                                /* tp_as_number   */
+    0,                                /* tp_as_sequence */
+    0,                                /* tp_as_mapping  */
+    0,                                /* tp_hash        */
+    0,                                /* tp_call        */
+    0,                                /* tp_str         */
+    PyObject_GenericGetAttr,          /* tp_getattro    */
+    0,                                /* tp_setattro    */
+    0,                                /* tp_as_buffer   */
+    Py_TPFLAGS_DEFAULT,               /* tp_flags       */
+    "An iterator over the decoded contents of a memory-mapped file; see decode_file().", /* tp_doc         */
+    0,                                /* tp_traverse    */
+    0,                                /* tp_clear       */
+    0,                                /* tp_richcompare */
+    0,                                /* tp_weaklistoffset */
+    PyObject_SelfIter,                /* tp_iter        */
+    (iternextfunc)modesfiledecoder_next, /* tp_iternext    */
+    0,                                /* tp_methods     */
+    modesfiledecoderMembers,          /* tp_members     */
+    0,                                /* tp_getset      */
+};
+
+/* decode_file(path, mode, filter=None, columns=False, max_messages=65536)
+ *
+ * Returns an iterator over batches of decoded messages from a file of raw
+ * receiver data. filter, if given, is a dict of set_filter() arguments.
+ * Timestamps are not checked against the system clock, as that has
+ * nothing to do with when the data was captured.
+ */
+PyObject *modesreader_decode_file(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "path", "mode", "filter", "columns", "max_messages", NULL };
+    PyObject *path = NULL, *mode, *filter = Py_None, *set_filter = NULL, *noargs = NULL, *rv;
+    int columns = 0, max_messages = 65536;
+    modesfiledecoder *decoder = NULL;
+    struct stat st;
+    int fd = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&O|Opi", kwlist, PyUnicode_FSConverter, &path, &mode, &filter, &columns, &max_messages))
+        return NULL;
+
+    if (max_messages < 16) {
+        PyErr_SetString(PyExc_ValueError, "max_messages must be at least 16");
+        goto err;
     }
-    free(messages);
-    return rv;
+
+    if (! (decoder = PyObject_New(modesfiledecoder, &modesfiledecoderType)))
+        goto err;
+    decoder->reader = NULL;
+    decoder->map = NULL;
+    decoder->len = decoder->offset = 0;
+    decoder->max_messages = max_messages;
+    decoder->columnar = columns;
+
+    if (! (decoder->reader = (modesreader *)PyObject_CallFunctionObjArgs((PyObject *)&modesreaderType, mode, NULL)))
+        goto err;
+    if (decoder->reader->decoder_mode == DECODER_NONE) {
+        PyErr_SetString(PyExc_ValueError, "a decoder mode is needed");
+        goto err;
+    }
+    decoder->reader->offline = 1;
+
+    if (filter != Py_None) {
+        if (!PyDict_Check(filter)) {
+            PyErr_SetString(PyExc_TypeError, "filter should be a dict of set_filter() arguments");
+            goto err;
+        }
+        if (! (set_filter = PyObject_GetAttrString((PyObject *)decoder->reader, "set_filter")))
+            goto err;
+        if (! (noargs = PyTuple_New(0)))
+            goto err;
+        if (! (rv = PyObject_Call(set_filter, noargs, filter)))
+            goto err;
+        Py_DECREF(rv);
+    }
+
+    if ((fd = open(PyBytes_AS_STRING(path), O_RDONLY)) < 0 || fstat(fd, &st) < 0) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, PyBytes_AS_STRING(path));
+        goto err;
+    }
+
+    if (st.st_size > 0) {
+        void *map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (map == MAP_FAILED) {
+            PyErr_SetFromErrnoWithFilename(PyExc_OSError, PyBytes_AS_STRING(path));
+            goto err;
+        }
+
+        madvise(map, st.st_size, MADV_SEQUENTIAL);
+        decoder->map = map;
+        decoder->len = st.st_size;
+    }
+
+    close(fd);
+    Py_DECREF(path);
+    Py_XDECREF(set_filter);
+    Py_XDECREF(noargs);
+    return (PyObject *)decoder;
+
+ err:
+    if (fd >= 0)
+        close(fd);
+    Py_XDECREF(path);
+    Py_XDECREF(set_filter);
+    Py_XDECREF(noargs);
+    Py_XDECREF(decoder);
+    return NULL;
 }
 
-/* inspect a message, update the seen set
- * return 1 if we should pass this message on to the caller
+/********** FORMAT DETECTION **************/
+
+/*
+ * detect_format(buffer) makes a single pass over the start of an input
+ * stream. Every offset that could start a frame of one of the supported
+ * formats is a candidate; from each candidate we count how many
+ * consecutive well-formed frames follow. The longest run wins. Once a run
+ * of a given format has been counted, later candidates of that format
+ * inside the run are skipped (they are just shorter suffixes of it) so the
+ * scan stays linear in the buffer size.
+ */
+
+/* length of one structurally valid Beast frame at p, 0 if more data is needed, -1 if not a frame */
+static Py_ssize_t detect_beast_frame(uint8_t *p, uint8_t *eod)
+{
+    uint8_t scratch[BEAST_MAX_PAYLOAD];
+    uint8_t type, *payload, *next;
+    int rv;
+
+    rv = modesbeast_frame(p, eod, scratch, &type, &payload, &next);
+    if (rv == BEAST_FRAME_OK)
+        return next - p;
+    return (rv == BEAST_FRAME_MORE ? 0 : -1);
+}
+
+/* skip one possibly DLE-stuffed SBS CRC byte; returns the following position, NULL if more data is needed or bad */
+static uint8_t *detect_sbs_crcbyte(uint8_t *m, uint8_t *eod)
+{
+    if (m >= eod)
+        return NULL;
+    if (*m++ != 0x10)
+        return m;
+    if (m >= eod || *m != 0x10)
+        return NULL;
+    return m + 1;
+}
+
+/* length of one structurally valid SBS frame at p, 0 if more data is needed, -1 if not a frame */
+static Py_ssize_t detect_sbs_frame(uint8_t *p, uint8_t *eod)
+{
+    uint8_t *m;
+
+    if (p + 2 > eod)
+        return 0;
+    if (p[0] != 0x10 || p[1] != 0x02)
+        return -1;
+
+    /* DLE STX <body with DLE DLE escapes> DLE ETX <2 CRC bytes> */
+    for (m = p + 2; ; m += 2) {
+        m = memchr(m, 0x10, eod - m);
+        if (!m || m + 1 >= eod)
+            return 0;
+        if (m[1] == 0x03)
+            break;
+        if (m[1] != 0x10)
+            return -1;
+    }
+
+    if (m - p < 7)
+        return -1;  /* no room for type, spare, timestamp, and some data */
+
+    if (!(m = detect_sbs_crcbyte(m + 2, eod)) || !(m = detect_sbs_crcbyte(m, eod)))
+        return 0;   /* don't distinguish short from bad; the next frame will tell */
+
+    return m - p;
+}
+
+/* length of one structurally valid AVR line at p, 0 if more data is needed, -1 if not a frame.
+ * With mlat set, only lines with timestamps are accepted, otherwise only lines without.
+ */
+static Py_ssize_t detect_avr_frame(uint8_t *p, uint8_t *eod, int mlat)
+{
+    uint8_t *m = p + 1;
+    int digits, n;
+
+    if (p >= eod)
+        return 0;
+
+    switch (p[0]) {
+    case '@': case '%':
+        digits = 12;
+        break;
+    case '<':
+        digits = 14;
+        break;
+    case '*': case ':':
+        digits = 0;
+        break;
+    default:
+        return -1;
+    }
+
+    if ((digits > 0) != mlat)
+        return -1;
+
+    /* timestamp (and signal) then 2, 7 or 14 bytes of data, then ';' */
+    for (n = 0; m < eod && n <= digits + 28 && hexvalue(*m) >= 0; ++m)
+        ++n;
+    if (m >= eod)
+        return 0;
+    if (*m != ';')
+        return -1;
+
+    n -= digits;
+    if (n != 4 && n != 14 && n != 28)
+        return -1;
+
+    /* the line ends with some combination of CR and LF */
+    if (++m >= eod)
+        return 0;
+    if (*m != '\r' && *m != '\n')
+        return -1;
+    while (m < eod && (*m == '\r' || *m == '\n'))
+        ++m;
+    if (m >= eod)
+        return 0;   /* might be partway through a line ending */
+
+    return m - p;
+}
+
+/* the formats we try to detect */
+typedef enum {
+    DETECT_BEAST,
+    DETECT_SBS,
+    DETECT_AVR,
+    DETECT_AVRMLAT,
+    DETECT_COUNT
+} detect_candidate;
+
+static const decoder_mode detect_modes[DETECT_COUNT] = { DECODER_BEAST, DECODER_SBS, DECODER_AVR, DECODER_AVRMLAT };
+
+static Py_ssize_t detect_frame(detect_candidate candidate, uint8_t *p, uint8_t *eod)
+{
+    switch (candidate) {
+    case DETECT_BEAST: return detect_beast_frame(p, eod);
+    case DETECT_SBS: return detect_sbs_frame(p, eod);
+    case DETECT_AVR: return detect_avr_frame(p, eod, 0);
+    case DETECT_AVRMLAT: return detect_avr_frame(p, eod, 1);
+    default: return -1;
+    }
+}
+
+/* detect_format(buffer): find the input format and the first frame in some data.
+ * Returns (offset, mode, confidence), where confidence is the number of
+ * consecutive well-formed frames found starting at offset; or (0, None, 0)
+ * if no complete frame was found.
+ */
+PyObject *modesreader_detect_format(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    uint8_t *buffer_start, *p, *eod;
+    uint8_t *resume[DETECT_COUNT];
+    Py_ssize_t best_offset = 0;
+    unsigned best_frames = 0;
+    decoder_mode best_mode = DECODER_NONE;
+    PyObject *mode = Py_None;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "y*", &buffer))
+        return NULL;
+
+    buffer_start = buffer.buf;
+    eod = buffer_start + buffer.len;
+    for (i = 0; i < DETECT_COUNT; ++i)
+        resume[i] = buffer_start;
+
+    for (p = buffer_start; p < eod; ++p) {
+        for (i = 0; i < DETECT_COUNT; ++i) {
+            unsigned frames = 0;
+            uint8_t *m = p;
+            Py_ssize_t len;
+
+            if (p < resume[i])
+                continue;
+
+            while ((len = detect_frame(i, m, eod)) > 0) {
+                ++frames;
+                m += len;
+            }
+
+            if (frames == 0)
+                continue;
+
+            resume[i] = m;
+            if (frames > best_frames) {
+                best_frames = frames;
+                best_offset = p - buffer_start;
+                best_mode = detect_modes[i];
+            }
+        }
+    }
+
+    PyBuffer_Release(&buffer);
+
+    for (i = 0; modetable[i].cstr != NULL; ++i) {
+        if (modetable[i].mode == best_mode) {
+            mode = modetable[i].pystr;
+            break;
+        }
+    }
+
+    return Py_BuildValue("(nOI)", best_offset, mode, best_frames);
+}
+
+/* inspect an undecoded frame
+ * return 1 if the frame needs to be decoded and passed to filter_message
  * return 0 if we should drop it
- * return -1 on internal error (exception has been raised)
  */
-static int filter_message(modesreader *self, PyObject *o)
+static int prefilter_message(modesreader *self, unsigned long long timestamp, uint8_t *data, int datalen)
 {
-    modesmessage *message = (modesmessage *)o;
+    unsigned df;
 
     // Check this, first.  We don't really want to use MLAT msgs...
-    if (message->timestamp == MAGIC_MLAT_TIMESTAMP && !self->want_mlat_messages) {
+    if (timestamp == MAGIC_MLAT_TIMESTAMP && !self->want_mlat_messages) {
         ++self->mlat_messages;
         return 0;
     }
 
     // Drop messages as long as timestamps are jumping.
-    if (self->outliers > 0)
+    if (self->outliers > 0) {
+        ++self->outlier_suppressed_messages;
         return 0;
+    }
 
     // Ignore messages that jump backwards
-    if (self->last_timestamp > message->timestamp)
+    if (self->last_timestamp > timestamp) {
+        ++self->backwards_messages;
         return 0;
+    }
 
-    if (message->df == DF_MODEAC) {
-        if (self->modeac_filter != NULL && self->modeac_filter != Py_None) {
-            return PySequence_Contains(self->modeac_filter, message->address);
-        }
+    if (datalen == 2) {
+        /* Mode A/C, the code is the raw data */
+        if (modesfilter_want_modeac(&self->filter, (data[0] << 8) | data[1]))
+            return 1;
+        ++self->prefiltered_messages;
+        return 0;
+    }
+
+    if (self->want_invalid_messages || datalen < 1)
+        return 1;
+
+    /* drop DFs that no filter could possibly want, unless we need them to update the seen table */
+    df = (data[0] >> 3) & 31;
+    if (modesfilter_maybe_df(&self->filter, df))
+        return 1;
+    if (self->track_seen && (df == 11 || df == 17 || df == 18))
+        return 1;
+    if (self->track_adsb && df == 17)
+        return 1;
+    ++self->prefiltered_messages;
+    return 0;
+}
 
+/* inspect a decoded frame that passed prefilter_message, update the seen table
+ * return 1 if we should pass this message on to the caller
+ * return 0 if we should drop it
+ * return -1 on internal error (exception has been raised)
+ */
+static int filter_message(modesreader *self, unsigned long long timestamp, modesfields *fields)
+{
+    if (fields->df == DF_MODEAC) {
+        /* already checked by prefilter_message */
         return 1;
     }
 
-    if (!message->valid) {
-        return self->want_invalid_messages; /* don't process further, contents are dubious */
+    if (!fields->valid) {
+        /* don't process further, contents are dubious */
+        if (self->want_invalid_messages)
+            return 1;
+        ++self->invalid_messages;
+        return 0;
     }
 
-    if (self->seen != NULL && self->seen != Py_None) {
-        if (message->df == 11 || message->df == 17 || message->df == 18) {
+    if (self->track_seen) {
+        if (fields->df == 11 || fields->df == 17 || fields->df == 18) {
             /* note that we saw this aircraft, even if the message is filtered.
              * only do this for CRC-checked messages as we get a lot of noise
              * otherwise.
              */
-            if (PySet_Add(self->seen, message->address) < 0) {
+            if (modesseen_add(&self->seen, fields->address, fields->df, timestamp) < 0)
                 return -1;
-            }
         }
     }
 
-    if (message->timestamp == 0 && !self->want_zero_timestamps) {
+    if (timestamp == 0 && !self->want_zero_timestamps) {
+        ++self->zero_timestamp_messages;
         return 0;
     }
 
-    if ((self->default_filter == NULL || self->default_filter == Py_None) &&
-        (self->specific_filter == NULL || self->specific_filter == Py_None)) {
-        /* no filters installed, match everything */
+    /* DF17 positions are handled by track_position */
+    if (self->track_adsb && fields->df == 17)
         return 1;
-    }
 
     /* check per-type filters */
-    if (self->default_filter != NULL && self->default_filter != Py_None) {
-        int rv;
-        PyObject *entry = PySequence_GetItem(self->default_filter, message->df);
-        if (entry == NULL)
-            return -1;
-
-        rv = PyObject_IsTrue(entry);
-        Py_DECREF(entry);
-        if (rv != 0)
-            return rv;
-    }
+    if (modesfilter_want(&self->filter, fields->df, fields->address))
+        return 1;
+    ++self->filtered_messages;
+    return 0;
+}
 
-    if (self->specific_filter != NULL && self->specific_filter != Py_None) {
-        int rv;
-        PyObject *entry = PySequence_GetItem(self->specific_filter, message->df);
-        if (entry == NULL)
-            return -1;
+/* update the ADS-B position state for a valid DF17 frame that passed filter_message
+ * return 1 if it is a sync candidate that should be passed on to the caller,
+ *   with *sync_entry set to the aircraft state holding the other half of the pair
+ * return 0 if we should drop it
+ * return -1 on internal error (exception has been raised)
+ */
+static int track_position(modesreader *self, unsigned long long timestamp, unsigned signal, uint8_t *data, modesfields *fields, modesadsbentry **sync_entry)
+{
+    modesadsbentry *entry;
+    int rv;
 
-        if (entry == Py_None) {
-            rv = 0;
-        } else {
-            rv = PySequence_Contains(entry, message->address);
-        }
+    rv = modesadsb_update(&self->adsb, fields, timestamp, signal, data, 5 * self->frequency, self->monotonic, &entry);
+    if (rv < 0)
+        return -1;
 
-        Py_DECREF(entry);
-        if (rv != 0)
-            return rv;
+    if (rv == 0 || !modesfilter_want_sync(&self->filter, fields->address)) {
+        ++self->adsb_messages;
+        return 0;
     }
 
-    return 0;
+    *sync_entry = entry;
+    return 1;
 }
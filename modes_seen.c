@@ -0,0 +1,196 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+/********** SEEN AIRCRAFT ****************/
+
+/*
+ * The reader notes every aircraft it sees a valid DF11/17/18 frame from,
+ * even if the frame is then filtered. Rather than adding each address to
+ * a Python set, we keep a native table of per-address counters that the
+ * caller collects (and resets) periodically via Reader.take_seen().
+ */
+
+/* columns returned by modesseen_take */
+static struct {
+    const char *name;
+    const char *format;
+    size_t size;
+    size_t offset;
+} seencolumns[] = {
+    { "address",         "I", sizeof(uint32_t),           offsetof(modesseenentry, address) },
+    { "count",           "I", sizeof(uint32_t),           offsetof(modesseenentry, count) },
+    { "df_mask",         "I", sizeof(uint32_t),           offsetof(modesseenentry, df_mask) },
+    { "first_timestamp", "Q", sizeof(unsigned long long), offsetof(modesseenentry, first_timestamp) },
+    { "last_timestamp",  "Q", sizeof(unsigned long long), offsetof(modesseenentry, last_timestamp) },
+    { NULL, NULL, 0, 0 }
+};
+
+void modesseen_init(modesseen *seen)
+{
+    memset(seen, 0, sizeof(*seen));
+}
+
+void modesseen_free(modesseen *seen)
+{
+    free(seen->entries);
+    free(seen->index);
+    modesseen_init(seen);
+}
+
+static inline uint32_t seen_hash(modesseen *seen, uint32_t address)
+{
+    return (uint32_t)(address * 2654435761U) >> seen->shift;
+}
+
+/* (re)build the hash index with room for at least 2*n_entries entries */
+static int seen_reindex(modesseen *seen, uint32_t size, int bits)
+{
+    int32_t *index;
+    uint32_t i, j;
+
+    if (! (index = malloc(size * sizeof(int32_t)))) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for (i = 0; i < size; ++i)
+        index[i] = -1;
+
+    free(seen->index);
+    seen->index = index;
+    seen->mask = size - 1;
+    seen->shift = 32 - bits;
+
+    for (i = 0; i < seen->n_entries; ++i) {
+        for (j = seen_hash(seen, seen->entries[i].address); index[j] >= 0; j = (j + 1) & seen->mask)
+            ;
+        index[j] = (int32_t)i;
+    }
+
+    return 0;
+}
+
+/* record one frame; returns 0 on success, -1 (with an exception set) on error */
+int modesseen_add(modesseen *seen, uint32_t address, unsigned df, unsigned long long timestamp)
+{
+    modesseenentry *entry;
+    uint32_t i;
+
+    if (seen->index) {
+        for (i = seen_hash(seen, address); seen->index[i] >= 0; i = (i + 1) & seen->mask) {
+            entry = &seen->entries[seen->index[i]];
+            if (entry->address == address) {
+                ++entry->count;
+                entry->df_mask |= (1U << df);
+                entry->last_timestamp = timestamp;
+                return 0;
+            }
+        }
+    }
+
+    /* new aircraft */
+    if (seen->n_entries == seen->allocated) {
+        uint32_t allocated = (seen->allocated ? seen->allocated * 2 : 64);
+        modesseenentry *entries = realloc(seen->entries, allocated * sizeof(modesseenentry));
+        if (!entries) {
+            PyErr_NoMemory();
+            return -1;
+        }
+
+        seen->entries = entries;
+        seen->allocated = allocated;
+    }
+
+    entry = &seen->entries[seen->n_entries++];
+    entry->address = address;
+    entry->count = 1;
+    entry->df_mask = (1U << df);
+    entry->first_timestamp = entry->last_timestamp = timestamp;
+
+    /* keep the index load factor at or below 50% */
+    if (seen->n_entries * 2 > seen->mask + 1 || !seen->index) {
+        uint32_t size;
+        int bits;
+
+        for (bits = 7, size = 128; size < seen->n_entries * 2; ++bits, size <<= 1)
+            ;
+        if (seen_reindex(seen, size, bits) < 0) {
+            --seen->n_entries;
+            return -1;
+        }
+    } else {
+        for (i = seen_hash(seen, address); seen->index[i] >= 0; i = (i + 1) & seen->mask)
+            ;
+        seen->index[i] = (int32_t)(seen->n_entries - 1);
+    }
+
+    return 0;
+}
+
+/* return the contents of the table as a dict of typed memoryviews, and empty the table */
+PyObject *modesseen_take(modesseen *seen)
+{
+    PyObject *columns = NULL;
+    uint32_t i, row;
+
+    if (! (columns = PyDict_New()))
+        return NULL;
+
+    for (i = 0; seencolumns[i].name != NULL; ++i) {
+        PyObject *array, *view, *cast;
+        uint8_t *p;
+        int rv;
+
+        if (! (array = PyByteArray_FromStringAndSize(NULL, (Py_ssize_t)seen->n_entries * seencolumns[i].size)))
+            goto err;
+
+        p = (uint8_t*)PyByteArray_AS_STRING(array);
+        for (row = 0; row < seen->n_entries; ++row, p += seencolumns[i].size)
+            memcpy(p, (uint8_t*)&seen->entries[row] + seencolumns[i].offset, seencolumns[i].size);
+
+        view = PyMemoryView_FromObject(array);
+        Py_DECREF(array);
+        if (!view)
+            goto err;
+
+        cast = PyObject_CallMethod(view, "cast", "s", seencolumns[i].format);
+        Py_DECREF(view);
+        if (!cast)
+            goto err;
+
+        rv = PyDict_SetItemString(columns, seencolumns[i].name, cast);
+        Py_DECREF(cast);
+        if (rv < 0)
+            goto err;
+    }
+
+    /* reset, keeping the allocations for the next round */
+    seen->n_entries = 0;
+    if (seen->index) {
+        for (i = 0; i <= seen->mask; ++i)
+            seen->index[i] = -1;
+    }
+
+    return columns;
+
+ err:
+    Py_DECREF(columns);
+    return NULL;
+}
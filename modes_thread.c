@@ -0,0 +1,580 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <pthread.h>
+#include <signal.h>
+#include <unistd.h>
+#include <sys/socket.h>
+
+/********** READER THREAD ****************/
+
+/*
+ * A ReaderThread owns a native thread that reads Beast-format data from
+ * a socket and splits it into frames, without ever taking the GIL. The
+ * frames are put on a queue; a file descriptor (see fileno()) becomes
+ * readable when there is something on the queue, and the main thread
+ * then calls Reader.drain(thread) to process the queued frames.
+ *
+ * The queue is a single-producer, single-consumer ring. The producer
+ * fills slots between tail and head+QUEUE_SIZE without holding the lock,
+ * then publishes them by advancing tail under the lock; the consumer
+ * works the same way from head.
+ */
+
+#define QUEUE_SIZE 4096            /* frames; must be a power of two */
+#define RXBUF_SIZE 65536
+
+/* thread status */
+#define THREAD_RUNNING 0
+#define THREAD_EOF 1
+#define THREAD_SYNC_LOST 2
+#define THREAD_SOCKET_ERROR 3
+
+typedef struct {
+    PyObject_HEAD
+
+    int fd;                        /* socket to read; owned by the caller */
+    pthread_t thread;
+    int started;
+    int joined;
+    int wake_pipe[2];              /* readable when there is something to drain */
+    int stop_pipe[2];              /* written to ask the thread to exit */
+    modesrawframe *queue;
+
+    /* everything below is protected by lock */
+    pthread_mutex_t lock;
+    pthread_cond_t not_full;
+    unsigned head, tail;
+    int stopping;
+    int wake_pending;
+    int status;
+    int error;                     /* errno, or BEAST_FRAME_* code */
+    unsigned long long received_bytes;
+} modesthread;
+
+/* methods / type behaviour */
+static PyObject *modesthread_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static int modesthread_init(modesthread *self, PyObject *args, PyObject *kwds);
+static void modesthread_dealloc(modesthread *self);
+static PyObject *modesthread_start(modesthread *self);
+static PyObject *modesthread_stop(modesthread *self);
+static PyObject *modesthread_fileno(modesthread *self);
+static PyObject *modesthread_getreceived(modesthread *self, void *closure);
+static PyObject *modesthread_getrunning(modesthread *self, void *closure);
+
+/* internal helpers */
+static void *reader_thread(void *arg);
+static void stop_thread(modesthread *self);
+
+static PyGetSetDef modesthreadGetSet[] = {
+    { "received_bytes", (getter)modesthread_getreceived, NULL, "total bytes read from the socket", NULL },
+    { "running", (getter)modesthread_getrunning, NULL, "is the thread still reading from the socket?", NULL },
+    { NULL, NULL, NULL, NULL, NULL }
+};
+
+static PyMethodDef modesthreadMethods[] = {
+    { "start", (PyCFunction)modesthread_start, METH_NOARGS, "Start reading from the socket." },
+    { "stop", (PyCFunction)modesthread_stop, METH_NOARGS, "Stop reading from the socket and wait for the thread to exit." },
+    { "fileno", (PyCFunction)modesthread_fileno, METH_NOARGS, "Return a file descriptor that is readable when there are frames to drain." },
+    { NULL, NULL, 0, NULL }
+};
+
+static PyTypeObject modesthreadType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_modes.ReaderThread",             /* tp_name        */
+    sizeof(modesthread),               /* tp_basicsize   */
+    0,                                 /* tp_itemsize    */
+    (destructor)modesthread_dealloc,   /* tp_dealloc     */
+    0,                                 /* tp_print       */
+    0,                                 /* tp_getattr     */
+    0,                                 /* tp_setattr     */
+    0,                                 /* tp_reserved    */
+    0,                                 /* tp_repr        */
+    0,                                 /* tp_as_number   */
+    0,                                 /* tp_as_sequence */
+    0,                                 /* tp_as_mapping  */
+    0,                                 /* tp_hash        */
+    0,                                 /* tp_call        */
+    0,                                 /* tp_str         */
+    0,                                 /* tp_getattro    */
+    0,                                 /* tp_setattro    */
+    0,                                 /* tp_as_buffer   */
+    Py_TPFLAGS_DEFAULT,                /* tp_flags       */
+    "A native thread that reads and frames Beast data from a socket.", /* tp_doc */
+    0,                                 /* tp_traverse    */
+    0,                                 /* tp_clear       */
+    0,                                 /* tp_richcompare */
+    0,                                 /* tp_weaklistoffset */
+    0,                                 /* tp_iter        */
+    0,                                 /* tp_iternext    */
+    modesthreadMethods,                /* tp_methods     */
+    0,                                 /* tp_members     */
+    modesthreadGetSet,                 /* tp_getset      */
+    0,                                 /* tp_base        */
+    0,                                 /* tp_dict        */
+    0,                                 /* tp_descr_get   */
+    0,                                 /* tp_descr_set   */
+    0,                                 /* tp_dictoffset  */
+    (initproc)modesthread_init,        /* tp_init        */
+    0,                                 /* tp_alloc       */
+    modesthread_new,                   /* tp_new         */
+};
+
+/*
+ * module setup
+ */
+int modesthread_module_init(PyObject *m)
+{
+    if (PyType_Ready(&modesthreadType) < 0)
+        return -1;
+
+    Py_INCREF(&modesthreadType);
+    if (PyModule_AddObject(m, "ReaderThread", (PyObject *)&modesthreadType) < 0) {
+        Py_DECREF(&modesthreadType);
+        return -1;
+    }
+
+    return 0;
+}
+
+void modesthread_module_free(PyObject *m)
+{
+}
+
+static PyObject *modesthread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    modesthread *self;
+
+    self = (modesthread *)type->tp_alloc(type, 0);
+    if (!self)
+        return NULL;
+
+    /* minimal init so deallocation works */
+    self->fd = -1;
+    self->started = self->joined = 0;
+    self->wake_pipe[0] = self->wake_pipe[1] = -1;
+    self->stop_pipe[0] = self->stop_pipe[1] = -1;
+    self->queue = NULL;
+    self->head = self->tail = 0;
+    self->stopping = self->wake_pending = 0;
+    self->status = THREAD_RUNNING;
+    self->error = 0;
+    self->received_bytes = 0;
+
+    if (!(self->queue = malloc(QUEUE_SIZE * sizeof(modesrawframe)))) {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+
+    pthread_mutex_init(&self->lock, NULL);
+    pthread_cond_init(&self->not_full, NULL);
+
+    if (pipe(self->wake_pipe) < 0 || pipe(self->stop_pipe) < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    fcntl(self->wake_pipe[0], F_SETFL, O_NONBLOCK);
+    fcntl(self->wake_pipe[1], F_SETFL, O_NONBLOCK);
+    fcntl(self->wake_pipe[0], F_SETFD, FD_CLOEXEC);
+    fcntl(self->wake_pipe[1], F_SETFD, FD_CLOEXEC);
+    fcntl(self->stop_pipe[0], F_SETFD, FD_CLOEXEC);
+    fcntl(self->stop_pipe[1], F_SETFD, FD_CLOEXEC);
+
+    return (PyObject *)self;
+}
+
+/* ReaderThread(sock): sock is a socket object or file descriptor; the caller keeps it open until stop() */
+static int modesthread_init(modesthread *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "sock", NULL };
+    PyObject *sock = NULL;
+    int fd;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O", kwlist, &sock))
+        return -1;
+
+    if (self->started) {
+        PyErr_SetString(PyExc_ValueError, "thread already started");
+        return -1;
+    }
+
+    if ((fd = PyObject_AsFileDescriptor(sock)) < 0)
+        return -1;
+
+    self->fd = fd;
+    return 0;
+}
+
+static void modesthread_dealloc(modesthread *self)
+{
+    int i;
+
+    if (self->queue) {
+        stop_thread(self);
+        pthread_mutex_destroy(&self->lock);
+        pthread_cond_destroy(&self->not_full);
+    }
+
+    for (i = 0; i < 2; ++i) {
+        if (self->wake_pipe[i] >= 0)
+            close(self->wake_pipe[i]);
+        if (self->stop_pipe[i] >= 0)
+            close(self->stop_pipe[i]);
+    }
+
+    free(self->queue);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *modesthread_start(modesthread *self)
+{
+    sigset_t all, old;
+    int rv;
+
+    if (self->fd < 0) {
+        PyErr_SetString(PyExc_ValueError, "no socket to read from");
+        return NULL;
+    }
+
+    if (self->started) {
+        PyErr_SetString(PyExc_ValueError, "thread already started");
+        return NULL;
+    }
+
+    /* leave signal handling to the main thread */
+    sigfillset(&all);
+    pthread_sigmask(SIG_SETMASK, &all, &old);
+    rv = pthread_create(&self->thread, NULL, reader_thread, self);
+    pthread_sigmask(SIG_SETMASK, &old, NULL);
+
+    if (rv != 0) {
+        errno = rv;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    self->started = 1;
+    Py_RETURN_NONE;
+}
+
+/* ask the thread to exit and wait for it; safe to call more than once */
+static void stop_thread(modesthread *self)
+{
+    if (!self->started || self->joined)
+        return;
+
+    pthread_mutex_lock(&self->lock);
+    self->stopping = 1;
+    pthread_cond_broadcast(&self->not_full);
+    pthread_mutex_unlock(&self->lock);
+
+    if (write(self->stop_pipe[1], "", 1) < 0) {
+        /* nothing useful to do; the thread also checks stopping */
+    }
+
+    pthread_join(self->thread, NULL);
+    self->joined = 1;
+}
+
+static PyObject *modesthread_stop(modesthread *self)
+{
+    Py_BEGIN_ALLOW_THREADS
+    stop_thread(self);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+static PyObject *modesthread_fileno(modesthread *self)
+{
+    return PyLong_FromLong(self->wake_pipe[0]);
+}
+
+static PyObject *modesthread_getreceived(modesthread *self, void *closure)
+{
+    unsigned long long received;
+
+    pthread_mutex_lock(&self->lock);
+    received = self->received_bytes;
+    pthread_mutex_unlock(&self->lock);
+
+    return PyLong_FromUnsignedLongLong(received);
+}
+
+static PyObject *modesthread_getrunning(modesthread *self, void *closure)
+{
+    int running;
+
+    pthread_mutex_lock(&self->lock);
+    running = (self->started && !self->joined && self->status == THREAD_RUNNING);
+    pthread_mutex_unlock(&self->lock);
+
+    return PyBool_FromLong(running);
+}
+
+/* call with the lock held: make sure the wakeup pipe is readable */
+static void wake_consumer(modesthread *self)
+{
+    if (!self->wake_pending) {
+        self->wake_pending = 1;
+        if (write(self->wake_pipe[1], "", 1) < 0) {
+            /* pipe full: the consumer will be woken anyway */
+        }
+    }
+}
+
+/* the thread itself; this never touches any Python objects */
+static void *reader_thread(void *arg)
+{
+    modesthread *self = arg;
+    uint8_t *buf;
+    size_t used = 0;
+    int status = THREAD_RUNNING, error = 0;
+
+    if (!(buf = malloc(RXBUF_SIZE))) {
+        status = THREAD_SOCKET_ERROR;
+        error = ENOMEM;
+        goto done;
+    }
+
+    for (;;) {
+        struct pollfd fds[2];
+        ssize_t n;
+        uint8_t *p, *eod;
+        int rc = BEAST_FRAME_MORE;
+
+        fds[0].fd = self->fd;
+        fds[0].events = POLLIN;
+        fds[1].fd = self->stop_pipe[0];
+        fds[1].events = POLLIN;
+
+        if (poll(fds, 2, -1) < 0) {
+            if (errno == EINTR)
+                continue;
+            status = THREAD_SOCKET_ERROR;
+            error = errno;
+            goto done;
+        }
+
+        if (fds[1].revents)
+            goto done;
+
+        n = recv(self->fd, buf + used, RXBUF_SIZE - used, 0);
+        if (n < 0) {
+            if (errno == EINTR || errno == EAGAIN || errno == EWOULDBLOCK)
+                continue;
+            status = THREAD_SOCKET_ERROR;
+            error = errno;
+            goto done;
+        }
+
+        if (n == 0) {
+            status = THREAD_EOF;
+            goto done;
+        }
+
+        pthread_mutex_lock(&self->lock);
+        self->received_bytes += n;
+        pthread_mutex_unlock(&self->lock);
+
+        used += n;
+        p = buf;
+        eod = buf + used;
+
+        /* frame as much as we can, waiting for queue space as needed */
+        do {
+            unsigned tail, space, queued = 0;
+            int stopping;
+
+            pthread_mutex_lock(&self->lock);
+            while (self->tail - self->head == QUEUE_SIZE && !self->stopping)
+                pthread_cond_wait(&self->not_full, &self->lock);
+            tail = self->tail;
+            space = QUEUE_SIZE - (self->tail - self->head);
+            stopping = self->stopping;
+            pthread_mutex_unlock(&self->lock);
+
+            if (stopping)
+                goto done;
+
+            while (queued < space) {
+                uint8_t scratch[BEAST_MAX_PAYLOAD];
+                uint8_t type, *payload, *next;
+                modesrawframe *frame;
+
+                rc = modesbeast_frame(p, eod, scratch, &type, &payload, &next);
+                if (rc != BEAST_FRAME_OK)
+                    break;
+
+                frame = &self->queue[(tail + queued) & (QUEUE_SIZE - 1)];
+                frame->type = type;
+                memcpy(frame->payload, payload, modesbeast_payload_len(type));
+                ++queued;
+                p = next;
+            }
+
+            pthread_mutex_lock(&self->lock);
+            self->tail += queued;
+            if (queued)
+                wake_consumer(self);
+            pthread_mutex_unlock(&self->lock);
+
+            if (rc < 0) {
+                status = THREAD_SYNC_LOST;
+                error = rc;
+                goto done;
+            }
+        } while (rc == BEAST_FRAME_OK);
+
+        /* keep the partial frame for next time */
+        used = eod - p;
+        memmove(buf, p, used);
+    }
+
+ done:
+    free(buf);
+
+    pthread_mutex_lock(&self->lock);
+    self->status = status;
+    self->error = error;
+    wake_consumer(self);
+    pthread_mutex_unlock(&self->lock);
+    return NULL;
+}
+
+/*
+ * helpers for Reader.drain(); these are called with the GIL held
+ */
+
+int modesthread_check(PyObject *o)
+{
+    return PyObject_TypeCheck(o, &modesthreadType);
+}
+
+/* consume any pending wakeups; call before looking at the queue */
+void modesthread_clear_wakeup(PyObject *o)
+{
+    modesthread *self = (modesthread *)o;
+    char discard[64];
+
+    pthread_mutex_lock(&self->lock);
+    while (read(self->wake_pipe[0], discard, sizeof(discard)) > 0)
+        ;
+    self->wake_pending = 0;
+    pthread_mutex_unlock(&self->lock);
+}
+
+/* number of queued frames */
+unsigned modesthread_available(PyObject *o)
+{
+    modesthread *self = (modesthread *)o;
+    unsigned available;
+
+    pthread_mutex_lock(&self->lock);
+    available = self->tail - self->head;
+    pthread_mutex_unlock(&self->lock);
+
+    return available;
+}
+
+/* find the next contiguous run of queued frames; returns its length */
+unsigned modesthread_take(PyObject *o, modesrawframe **frames)
+{
+    modesthread *self = (modesthread *)o;
+    unsigned head, available, contiguous;
+
+    pthread_mutex_lock(&self->lock);
+    head = self->head;
+    available = self->tail - self->head;
+    pthread_mutex_unlock(&self->lock);
+
+    contiguous = QUEUE_SIZE - (head & (QUEUE_SIZE - 1));
+    *frames = &self->queue[head & (QUEUE_SIZE - 1)];
+    return (available < contiguous ? available : contiguous);
+}
+
+/* hand n frames from the front of the queue back to the thread */
+void modesthread_release(PyObject *o, unsigned n)
+{
+    modesthread *self = (modesthread *)o;
+
+    if (!n)
+        return;
+
+    pthread_mutex_lock(&self->lock);
+    self->head += n;
+    pthread_cond_signal(&self->not_full);
+    pthread_mutex_unlock(&self->lock);
+}
+
+/* has the thread stopped reading, with nothing left on the queue? */
+int modesthread_finished(PyObject *o)
+{
+    modesthread *self = (modesthread *)o;
+    int finished;
+
+    pthread_mutex_lock(&self->lock);
+    finished = (self->status != THREAD_RUNNING && self->tail == self->head);
+    pthread_mutex_unlock(&self->lock);
+
+    return finished;
+}
+
+/* if modesthread_finished(), raise the reason the thread stopped and
+ * return -1; otherwise return 0
+ */
+int modesthread_raise_if_stopped(PyObject *o)
+{
+    modesthread *self = (modesthread *)o;
+    int status, error;
+
+    if (!modesthread_finished(o))
+        return 0;
+
+    pthread_mutex_lock(&self->lock);
+    status = self->status;
+    error = self->error;
+    pthread_mutex_unlock(&self->lock);
+
+    switch (status) {
+    case THREAD_EOF:
+        PyErr_SetString(PyExc_EOFError, "Input connection closed");
+        break;
+
+    case THREAD_SYNC_LOST:
+        if (error == BEAST_FRAME_BAD_ESCAPE)
+            PyErr_SetString(PyExc_ValueError, "Lost sync with input stream: expected 0x1A after 0x1A escape");
+        else if (error == BEAST_FRAME_BAD_TYPE)
+            PyErr_SetString(PyExc_ValueError, "Lost sync with input stream: unexpected message type after 0x1A marker");
+        else
+            PyErr_SetString(PyExc_ValueError, "Lost sync with input stream: expected a 0x1A marker");
+        break;
+
+    default:
+        errno = error;
+        PyErr_SetFromErrno(PyExc_OSError);
+        break;
+    }
+
+    return -1;
+}
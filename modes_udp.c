@@ -0,0 +1,544 @@
+/*
+ * Part of mlat-client - an ADS-B multilateration client.
+ * Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ *  the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "_modes.h"
+
+#include <stdlib.h>
+
+/********** UDP ENCODER ****************/
+
+/*
+ * A UdpEncoder builds the datagrams of the UDP mlat/sync transport.
+ * Records are appended to a datagram until it grows past the MTU, at
+ * which point the finished datagram is handed back to the caller to send.
+ *
+ * Each datagram starts with a header:
+ *   key:u32 seq:u16 base_timestamp:u64
+ * followed by records, all big-endian, each starting with a type byte.
+ * Most records carry a signed 32-bit timestamp delta from the base
+ * timestamp; a REBASE record moves the base when the delta would not fit.
+ *
+ * In "addresses" mode (the FlightAware variant of the protocol) the sync
+ * and mlat records carry the 24-bit ICAO address after the type byte, and
+ * Mode A/C messages get their own record type.
+ */
+
+#define TYPE_SYNC 1
+#define TYPE_MLAT_SHORT 2
+#define TYPE_MLAT_LONG 3
+#define TYPE_SSYNC 4
+#define TYPE_REBASE 5
+#define TYPE_ABS_SYNC 6
+#define TYPE_MLAT_MODEAC 7
+
+#define HEADER_SIZE (4 + 2 + 8)
+#define MAX_WRITE_SIZE ((1 + 8) + (1 + 3 + 4 + 4 + 14 + 14))    /* REBASE, then SYNC with an address */
+#define MAX_DELTA 0x7FFFFFF0LL
+#define MAX_SYNC_SPREAD 0xFFFFFFF0ULL
+
+typedef struct {
+    PyObject_HEAD
+
+    uint32_t key;
+    unsigned short seq;
+    char addresses;                /* include ICAO addresses in records? */
+    Py_ssize_t mtu;                /* finish the datagram once it is longer than this */
+
+    unsigned long long base_timestamp;
+    Py_ssize_t used;               /* 0 if there is no datagram in progress */
+    uint8_t *buf;                  /* mtu + MAX_WRITE_SIZE bytes */
+} modesudpencoder;
+
+/* methods / type behaviour */
+static PyObject *modesudpencoder_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static int modesudpencoder_init(modesudpencoder *self, PyObject *args, PyObject *kwds);
+static void modesudpencoder_dealloc(modesudpencoder *self);
+static PyObject *modesudpencoder_getmtu(modesudpencoder *self, void *closure);
+static int modesudpencoder_setmtu(modesudpencoder *self, PyObject *value, void *closure);
+static PyObject *modesudpencoder_mlat(modesudpencoder *self, PyObject *message);
+static PyObject *modesudpencoder_mlat_many(modesudpencoder *self, PyObject *messages);
+static PyObject *modesudpencoder_sync(modesudpencoder *self, PyObject *args);
+static PyObject *modesudpencoder_split_sync(modesudpencoder *self, PyObject *message);
+static PyObject *modesudpencoder_flush(modesudpencoder *self);
+static PyObject *modesudpencoder_clear(modesudpencoder *self);
+
+static PyMemberDef modesudpencoderMembers[] = {
+    { "key",       T_UINT,      offsetof(modesudpencoder, key),       READONLY, "datagram key given by the server" },
+    { "seq",       T_USHORT,    offsetof(modesudpencoder, seq),       READONLY, "sequence number of the next datagram" },
+    { "addresses", T_BOOL,      offsetof(modesudpencoder, addresses), READONLY, "do records include ICAO addresses?" },
+    { "used",      T_PYSSIZET,  offsetof(modesudpencoder, used),      READONLY, "size of the datagram in progress" },
+    { NULL, 0, 0, 0, NULL }
+};
+
+static PyGetSetDef modesudpencoderGetSet[] = {
+    { "mtu", (getter)modesudpencoder_getmtu, (setter)modesudpencoder_setmtu, "datagrams are finished once they are longer than this", NULL },
+    { NULL, NULL, NULL, NULL, NULL }
+};
+
+static PyMethodDef modesudpencoderMethods[] = {
+    { "mlat", (PyCFunction)modesudpencoder_mlat, METH_O, "Add an mlat record; return a finished datagram, or None." },
+    { "mlat_many", (PyCFunction)modesudpencoder_mlat_many, METH_O, "Add mlat records for a sequence of messages; return a list of finished datagrams." },
+    { "sync", (PyCFunction)modesudpencoder_sync, METH_VARARGS, "Add a sync record for an even/odd message pair; return a finished datagram, or None." },
+    { "split_sync", (PyCFunction)modesudpencoder_split_sync, METH_O, "Add a split sync record; return a finished datagram, or None." },
+    { "flush", (PyCFunction)modesudpencoder_flush, METH_NOARGS, "Finish and return the datagram in progress, or None if it is empty." },
+    { "clear", (PyCFunction)modesudpencoder_clear, METH_NOARGS, "Discard the datagram in progress." },
+    { NULL, NULL, 0, NULL }
+};
+
+static PyTypeObject modesudpencoderType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_modes.UdpEncoder",               /* tp_name        */
+    sizeof(modesudpencoder),           /* tp_basicsize   */
+    0,                                 /* tp_itemsize    */
+    (destructor)modesudpencoder_dealloc, /* tp_dealloc   */
+    0,                                 /* tp_print       */
+    0,                                 /* tp_getattr     */
+    0,                                 /* tp_setattr     */
+    0,                                 /* tp_reserved    */
+    0,                                 /* tp_repr        */
+    0,                                 /* tp_as_number   */
+    0,                                 /* tp_as_sequence */
+    0,                                 /* tp_as_mapping  */
+    0,                                 /* tp_hash        */
+    0,                                 /* tp_call        */
+    0,                                 /* tp_str         */
+    0,                                 /* tp_getattro    */
+    0,                                 /* tp_setattro    */
+    0,                                 /* tp_as_buffer   */
+    Py_TPFLAGS_DEFAULT,                /* tp_flags       */
+    "Builds UDP mlat/sync datagrams from messages.", /* tp_doc */
+    0,                                 /* tp_traverse    */
+    0,                                 /* tp_clear       */
+    0,                                 /* tp_richcompare */
+    0,                                 /* tp_weaklistoffset */
+    0,                                 /* tp_iter        */
+    0,                                 /* tp_iternext    */
+    modesudpencoderMethods,            /* tp_methods     */
+    modesudpencoderMembers,            /* tp_members     */
+    modesudpencoderGetSet,             /* tp_getset      */
+    0,                                 /* tp_base        */
+    0,                                 /* tp_dict        */
+    0,                                 /* tp_descr_get   */
+    0,                                 /* tp_descr_set   */
+    0,                                 /* tp_dictoffset  */
+    (initproc)modesudpencoder_init,    /* tp_init        */
+    0,                                 /* tp_alloc       */
+    modesudpencoder_new,               /* tp_new         */
+};
+
+/*
+ * module setup
+ */
+int modesudp_module_init(PyObject *m)
+{
+    if (PyType_Ready(&modesudpencoderType) < 0)
+        return -1;
+
+    Py_INCREF(&modesudpencoderType);
+    if (PyModule_AddObject(m, "UdpEncoder", (PyObject *)&modesudpencoderType) < 0) {
+        Py_DECREF(&modesudpencoderType);
+        return -1;
+    }
+
+    return 0;
+}
+
+void modesudp_module_free(PyObject *m)
+{
+}
+
+static PyObject *modesudpencoder_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    modesudpencoder *self;
+
+    self = (modesudpencoder *)type->tp_alloc(type, 0);
+    if (!self)
+        return NULL;
+
+    /* minimal init so deallocation works */
+    self->key = 0;
+    self->seq = 0;
+    self->addresses = 0;
+    self->mtu = 0;
+    self->base_timestamp = 0;
+    self->used = 0;
+    self->buf = NULL;
+
+    return (PyObject *)self;
+}
+
+/* resize the buffer for a new MTU; any datagram in progress is kept,
+ * so the new MTU can't be smaller than it.
+ *
+ * Records are only added while the datagram is no longer than the MTU,
+ * and one call adds at most MAX_WRITE_SIZE bytes (plus the header, if the
+ * datagram was empty), so mtu + MAX_WRITE_SIZE is always enough as long as
+ * mtu >= HEADER_SIZE.
+ */
+static int set_mtu(modesudpencoder *self, Py_ssize_t mtu)
+{
+    uint8_t *buf;
+
+    if (mtu < HEADER_SIZE) {
+        PyErr_Format(PyExc_ValueError, "mtu must be at least %d", HEADER_SIZE);
+        return -1;
+    }
+
+    if (self->used > mtu) {
+        PyErr_SetString(PyExc_ValueError, "mtu is too small for the datagram in progress; flush() it first");
+        return -1;
+    }
+
+    if (! (buf = realloc(self->buf, mtu + MAX_WRITE_SIZE))) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    self->buf = buf;
+    self->mtu = mtu;
+    return 0;
+}
+
+/* UdpEncoder(key, addresses=False, mtu=1400) */
+static int modesudpencoder_init(modesudpencoder *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = { "key", "addresses", "mtu", NULL };
+    unsigned long key;
+    int addresses = 0;
+    Py_ssize_t mtu = 1400;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "k|pn", kwlist, &key, &addresses, &mtu))
+        return -1;
+
+    if (set_mtu(self, mtu) < 0)
+        return -1;
+
+    self->key = (uint32_t)key;
+    self->addresses = addresses;
+    self->seq = 0;
+    self->used = 0;
+    return 0;
+}
+
+static void modesudpencoder_dealloc(modesudpencoder *self)
+{
+    free(self->buf);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *modesudpencoder_getmtu(modesudpencoder *self, void *closure)
+{
+    return PyLong_FromSsize_t(self->mtu);
+}
+
+static int modesudpencoder_setmtu(modesudpencoder *self, PyObject *value, void *closure)
+{
+    Py_ssize_t mtu;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError, "cannot delete mtu");
+        return -1;
+    }
+
+    mtu = PyLong_AsSsize_t(value);
+    if (mtu == -1 && PyErr_Occurred())
+        return -1;
+
+    return set_mtu(self, mtu);
+}
+
+/*
+ * record building
+ */
+
+static inline void put8(modesudpencoder *self, unsigned v)
+{
+    self->buf[self->used++] = v;
+}
+
+static inline void put32(modesudpencoder *self, uint32_t v)
+{
+    uint8_t *p = self->buf + self->used;
+    p[0] = v >> 24;
+    p[1] = v >> 16;
+    p[2] = v >> 8;
+    p[3] = v;
+    self->used += 4;
+}
+
+static inline void put64(modesudpencoder *self, unsigned long long v)
+{
+    put32(self, (uint32_t)(v >> 32));
+    put32(self, (uint32_t)v);
+}
+
+static inline void put_address(modesudpencoder *self, modesmessage *message)
+{
+    uint32_t address = (message->has_address ? message->address : 0);
+    uint8_t *p = self->buf + self->used;
+    p[0] = address >> 16;
+    p[1] = address >> 8;
+    p[2] = address;
+    self->used += 3;
+}
+
+/* the message data, truncated or zero-padded to n bytes */
+static inline void put_data(modesudpencoder *self, modesmessage *message, int n)
+{
+    int copy = (message->datalen < n ? message->datalen : n);
+    if (copy > 0)
+        memcpy(self->buf + self->used, message->data, copy);
+    memset(self->buf + self->used + copy, 0, n - copy);
+    self->used += n;
+}
+
+static void start_datagram(modesudpencoder *self, unsigned long long timestamp)
+{
+    if (self->used)
+        return;
+
+    self->base_timestamp = timestamp;
+    put32(self, self->key);
+    put8(self, self->seq >> 8);
+    put8(self, self->seq & 255);
+    put64(self, timestamp);
+}
+
+static void rebase(modesudpencoder *self, unsigned long long timestamp)
+{
+    self->base_timestamp = timestamp;
+    put8(self, TYPE_REBASE);
+    put64(self, timestamp);
+}
+
+static inline long long delta(modesudpencoder *self, unsigned long long timestamp)
+{
+    return (long long)(timestamp - self->base_timestamp);
+}
+
+/* a timestamp delta, rebasing first if it would not fit */
+static long long delta_or_rebase(modesudpencoder *self, unsigned long long timestamp)
+{
+    long long d = delta(self, timestamp);
+    if (llabs(d) > MAX_DELTA) {
+        rebase(self, timestamp);
+        d = 0;
+    }
+    return d;
+}
+
+static void encode_mlat(modesudpencoder *self, modesmessage *message)
+{
+    long long d;
+
+    start_datagram(self, message->timestamp);
+    d = delta_or_rebase(self, message->timestamp);
+
+    if (!self->addresses) {
+        put8(self, message->datalen == 7 ? TYPE_MLAT_SHORT : TYPE_MLAT_LONG);
+        put32(self, (uint32_t)d);
+        put_data(self, message, message->datalen == 7 ? 7 : 14);
+        return;
+    }
+
+    switch (message->datalen) {
+    case 2:
+        put8(self, TYPE_MLAT_MODEAC);
+        put32(self, (uint32_t)d);
+        put_data(self, message, 2);
+        break;
+    case 7:
+        put8(self, TYPE_MLAT_SHORT);
+        put_address(self, message);
+        put32(self, (uint32_t)d);
+        put_data(self, message, 7);
+        break;
+    case 14:
+        put8(self, TYPE_MLAT_LONG);
+        put_address(self, message);
+        put32(self, (uint32_t)d);
+        put_data(self, message, 14);
+        break;
+    default:
+        /* nothing we can send */
+        break;
+    }
+}
+
+static void encode_sync(modesudpencoder *self, modesmessage *em, modesmessage *om)
+{
+    unsigned long long mid = (em->timestamp + om->timestamp) / 2;
+    unsigned long long spread = (em->timestamp > om->timestamp ? em->timestamp - om->timestamp : om->timestamp - em->timestamp);
+
+    start_datagram(self, mid);
+
+    if (spread > MAX_SYNC_SPREAD) {
+        /* too far apart for deltas, use absolute timestamps */
+        put8(self, TYPE_ABS_SYNC);
+        if (self->addresses)
+            put_address(self, em);
+        put64(self, em->timestamp);
+        put64(self, om->timestamp);
+    } else {
+        if (llabs(delta(self, em->timestamp)) > MAX_DELTA || llabs(delta(self, om->timestamp)) > MAX_DELTA)
+            rebase(self, mid);
+
+        put8(self, TYPE_SYNC);
+        if (self->addresses)
+            put_address(self, em);
+        put32(self, (uint32_t)delta(self, em->timestamp));
+        put32(self, (uint32_t)delta(self, om->timestamp));
+    }
+
+    put_data(self, em, 14);
+    put_data(self, om, 14);
+}
+
+static void encode_split_sync(modesudpencoder *self, modesmessage *message)
+{
+    long long d;
+
+    start_datagram(self, message->timestamp);
+    d = delta_or_rebase(self, message->timestamp);
+
+    put8(self, TYPE_SSYNC);
+    put32(self, (uint32_t)d);
+    put_data(self, message, 14);
+}
+
+/* finish the datagram in progress, returning it as bytes (or None if there isn't one) */
+static PyObject *finish(modesudpencoder *self)
+{
+    PyObject *datagram;
+
+    if (!self->used)
+        Py_RETURN_NONE;
+
+    if (! (datagram = PyBytes_FromStringAndSize((char*)self->buf, self->used)))
+        return NULL;
+
+    self->used = 0;
+    self->seq = (self->seq + 1) & 0xffff;
+    return datagram;
+}
+
+/* return the finished datagram if we've gone past the MTU, otherwise None */
+static PyObject *finish_if_full(modesudpencoder *self)
+{
+    if (self->used > self->mtu)
+        return finish(self);
+    Py_RETURN_NONE;
+}
+
+static modesmessage *check_message(PyObject *o)
+{
+    if (!modesmessage_check(o)) {
+        PyErr_Format(PyExc_TypeError, "expected a Message, not %.100s", Py_TYPE(o)->tp_name);
+        return NULL;
+    }
+    return (modesmessage *)o;
+}
+
+static PyObject *modesudpencoder_mlat(modesudpencoder *self, PyObject *message)
+{
+    modesmessage *m;
+
+    if (! (m = check_message(message)))
+        return NULL;
+
+    encode_mlat(self, m);
+    return finish_if_full(self);
+}
+
+static PyObject *modesudpencoder_mlat_many(modesudpencoder *self, PyObject *messages)
+{
+    PyObject *seq, *datagrams = NULL;
+    Py_ssize_t i, n;
+
+    if (! (seq = PySequence_Fast(messages, "expected a sequence of Messages")))
+        return NULL;
+
+    if (! (datagrams = PyList_New(0)))
+        goto err;
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    for (i = 0; i < n; ++i) {
+        modesmessage *m;
+
+        if (! (m = check_message(PySequence_Fast_GET_ITEM(seq, i))))
+            goto err;
+
+        encode_mlat(self, m);
+        if (self->used > self->mtu) {
+            PyObject *datagram;
+            int rv;
+
+            if (! (datagram = finish(self)))
+                goto err;
+            rv = PyList_Append(datagrams, datagram);
+            Py_DECREF(datagram);
+            if (rv < 0)
+                goto err;
+        }
+    }
+
+    Py_DECREF(seq);
+    return datagrams;
+
+ err:
+    Py_DECREF(seq);
+    Py_XDECREF(datagrams);
+    return NULL;
+}
+
+static PyObject *modesudpencoder_sync(modesudpencoder *self, PyObject *args)
+{
+    PyObject *even, *odd;
+    modesmessage *em, *om;
+
+    if (!PyArg_ParseTuple(args, "OO", &even, &odd))
+        return NULL;
+
+    if (! (em = check_message(even)) || ! (om = check_message(odd)))
+        return NULL;
+
+    encode_sync(self, em, om);
+    return finish_if_full(self);
+}
+
+static PyObject *modesudpencoder_split_sync(modesudpencoder *self, PyObject *message)
+{
+    modesmessage *m;
+
+    if (! (m = check_message(message)))
+        return NULL;
+
+    encode_split_sync(self, m);
+    return finish_if_full(self);
+}
+
+static PyObject *modesudpencoder_flush(modesudpencoder *self)
+{
+    return finish(self);
+}
+
+static PyObject *modesudpencoder_clear(modesudpencoder *self)
+{
+    self->used = 0;
+    Py_RETURN_NONE;
+}
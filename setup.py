@@ -34,16 +34,21 @@ exec(open('mlat/client/version.py').read())
 
 more_warnings = False
 extra_compile_args = []
+libraries = []
 if platform.system() == 'Linux':
     extra_compile_args.append('-O3')
+    libraries.append('pthread')
 
     if more_warnings:
         # let's assume this is GCC
         extra_compile_args.append('-Wpointer-arith')
 
 modes_ext = Extension('_modes',
-                      sources=['_modes.c', 'modes_reader.c', 'modes_message.c', 'modes_crc.c'],
-                      extra_compile_args=extra_compile_args)
+                      sources=['_modes.c', 'modes_reader.c', 'modes_message.c', 'modes_crc.c',
+                               'modes_filter.c', 'modes_seen.c', 'modes_thread.c', 'modes_adsb.c', 'modes_udp.c',
+                               'modes_dedup.c', 'modes_json.c', 'modes_batch.c'],
+                      extra_compile_args=extra_compile_args,
+                      libraries=libraries)
 
 setup(name='MlatClient',
       version=CLIENT_VERSION,
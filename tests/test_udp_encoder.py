@@ -0,0 +1,59 @@
+# -*- mode: python; indent-tabs-mode: nil -*-
+
+# Part of mlat-client - an ADS-B multilateration client.
+# Copyright 2015, Oliver Jowett <oliver@mutability.co.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import _modes
+
+DF17 = bytes.fromhex('8D4840D6202CC371C32CE0576098')
+
+
+def message(timestamp):
+    return _modes.Message(DF17, timestamp, 0)
+
+
+class UdpEncoderTestCase(unittest.TestCase):
+    def test_mtu_below_datagram_in_progress(self):
+        encoder = _modes.UdpEncoder(1, addresses=True)
+        for i in range(6):
+            self.assertIsNone(encoder.mlat(message(1000 + i)))
+
+        with self.assertRaises(ValueError):
+            encoder.mtu = 100
+        self.assertEqual(encoder.mtu, 1400)
+
+        m = message(2000)
+        self.assertIsNone(encoder.sync(m, m))
+        datagram = encoder.flush()
+        encoder.mtu = 100
+        self.assertEqual(encoder.mtu, 100)
+        self.assertEqual(len(datagram), 14 + 6 * 22 + 40)
+
+    def test_rebase_and_sync_at_mtu(self):
+        # fill a datagram to exactly the mtu, then add a sync that needs a rebase
+        encoder = _modes.UdpEncoder(1, addresses=True, mtu=14 + 63 * 22)
+        for i in range(63):
+            self.assertIsNone(encoder.mlat(message(1000 + i)))
+
+        far = message(1000 + 0x100000000)
+        datagram = encoder.sync(far, far)
+        self.assertEqual(len(datagram), 14 + 63 * 22 + 9 + 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,8 +26,9 @@ class Receiver(object):
         self.port = port
 
         self.parser = _modes.Reader(_modes.BEAST)
-        self.parser.default_filter = [False] * 32
-        self.parser.default_filter[17] = True
+        default_filter = [False] * 32
+        default_filter[17] = True
+        self.parser.default_filter = default_filter
 
         self.frequency = None
         self.task = asyncio.async(self.handle_connection())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+#   Serve a receiver capture back over TCP, as if it were the receiver.
+#
+#   record a capture with mlat-client (or fa-mlat-client):
+#    $ mlat-client --input-connect receiver:30005 --input-capture feed.cap ...
+#
+#   then replay it, and point a client at the replay port:
+#    $ PYTHONPATH=. ./tools/replay-capture.py feed.cap --port 30105 --speed 1
+#    $ mlat-client --input-connect localhost:30105 ...
+#
+#   --speed 1 reproduces the original arrival times, --speed N plays N
+#   times faster, and --speed 0 sends the data as fast as the client will
+#   take it. Each receiver connection in the capture is replayed on its own
+#   client connection: when the capture moves on to a new connection, the
+#   current client is disconnected and the next client to connect gets the
+#   rest.
+
+import argparse
+import socket
+import sys
+import time
+
+from mlat.client.capture import read_capture
+
+
+def serve(listener, records, speed):
+    """Replay records to clients accepted on listener; returns (records, bytes) sent."""
+    client = None
+    sent_records = sent_bytes = 0
+    start_arrival = start_wall = None
+
+    try:
+        for arrival, data in records:
+            if not data:
+                # start of a new receiver connection
+                if client is not None:
+                    print('end of connection, disconnecting client', file=sys.stderr)
+                    client.close()
+                    client = None
+                continue
+
+            if client is None:
+                print('waiting for a client on port {0}'.format(listener.getsockname()[1]), file=sys.stderr)
+                client, addr = listener.accept()
+                print('client connected from {0}:{1}'.format(addr[0], addr[1]), file=sys.stderr)
+                start_arrival = arrival
+                start_wall = time.monotonic()
+
+            if speed > 0:
+                # don't let wall-clock steps in the capture stall or rush the replay
+                if arrival < start_arrival:
+                    start_arrival = arrival
+                delay = start_wall + (arrival - start_arrival) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            try:
+                client.sendall(data)
+            except OSError as e:
+                print('client connection lost: {0!s}'.format(e), file=sys.stderr)
+                client.close()
+                client = None
+                continue
+
+            sent_records += 1
+            sent_bytes += len(data)
+    finally:
+        if client is not None:
+            client.close()
+
+    return sent_records, sent_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a receiver capture over TCP.")
+    parser.add_argument('capture', help="capture file written with --input-capture")
+    parser.add_argument('--listen', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=30105, help="port to listen on")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay speed relative to the original arrival times; 0 means as fast as possible")
+    args = parser.parse_args()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.listen, args.port))
+    listener.listen(1)
+
+    with open(args.capture, 'rb') as f:
+        start = time.monotonic()
+        try:
+            records, nbytes = serve(listener, read_capture(f), args.speed)
+        except KeyboardInterrupt:
+            return
+        elapsed = time.monotonic() - start
+
+    print('replayed {0} reads, {1} bytes in {2:.1f} seconds'.format(records, nbytes, elapsed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()